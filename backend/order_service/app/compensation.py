@@ -0,0 +1,169 @@
+# week08/backend/order_service/app/compensation.py
+
+import asyncio
+import logging
+import os
+import random
+from datetime import timedelta
+from typing import Iterable
+
+import httpx
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import SessionLocal
+from .models import StockCompensation
+
+logger = logging.getLogger(__name__)
+
+STOCK_COMPENSATION_BATCH_SIZE = int(os.getenv("STOCK_COMPENSATION_BATCH_SIZE", "50"))
+STOCK_COMPENSATION_POLL_INTERVAL_SECONDS = float(
+    os.getenv("STOCK_COMPENSATION_POLL_INTERVAL_SECONDS", "5")
+)
+STOCK_COMPENSATION_BASE_BACKOFF_SECONDS = float(
+    os.getenv("STOCK_COMPENSATION_BASE_BACKOFF_SECONDS", "2")
+)
+STOCK_COMPENSATION_MAX_BACKOFF_SECONDS = float(
+    os.getenv("STOCK_COMPENSATION_MAX_BACKOFF_SECONDS", "600")
+)
+
+BATCH_RESTOCK_PATH = "/products/restock:batch"
+
+
+async def enqueue_stock_compensations(db: AsyncSession, items: Iterable) -> int:
+    """
+    Stores one pending compensation per deducted item and commits.
+    Items only need product_id and quantity (OrderItemCreate or OrderItem).
+    """
+    compensations = [
+        StockCompensation(product_id=item.product_id, quantity=item.quantity)
+        for item in items
+    ]
+    if not compensations:
+        return 0
+    db.add_all(compensations)
+    await db.commit()
+    return len(compensations)
+
+
+def _backoff_seconds(attempts: int) -> float:
+    # Exponential backoff with jitter, capped so a failing row is still retried regularly
+    ceiling = min(
+        STOCK_COMPENSATION_MAX_BACKOFF_SECONDS,
+        STOCK_COMPENSATION_BASE_BACKOFF_SECONDS * (2 ** max(attempts - 1, 0)),
+    )
+    return random.uniform(ceiling / 2, ceiling)
+
+
+async def process_compensation_batch(
+    db: AsyncSession,
+    client: httpx.AsyncClient,
+    batch_size: int = STOCK_COMPENSATION_BATCH_SIZE,
+) -> int:
+    """
+    Claims up to batch_size due compensations and restocks them with one batch call.
+    Rows are claimed with FOR UPDATE SKIP LOCKED so several order-service replicas can
+    drain the queue concurrently without handing out the same row twice.
+    Each item carries its compensation's idempotency key, so a batch retried after a
+    lost answer does not restock the compensations that were already applied.
+    Returns the number of compensations processed.
+    """
+    due = (
+        (
+            await db.execute(
+                select(StockCompensation)
+                .where(
+                    StockCompensation.status == "pending",
+                    StockCompensation.next_attempt_at <= func.now(),
+                )
+                .order_by(StockCompensation.compensation_id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+        )
+        .scalars()
+        .all()
+    )
+    if not due:
+        await db.commit()
+        return 0
+
+    logger.info(f"Order Service: Processing {len(due)} pending stock compensations.")
+    try:
+        response = await client.post(
+            BATCH_RESTOCK_PATH,
+            json={
+                "items": [
+                    {
+                        "product_id": c.product_id,
+                        "quantity_to_add": c.quantity,
+                        "idempotency_key": c.idempotency_key,
+                    }
+                    for c in due
+                ]
+            },
+        )
+        response.raise_for_status()
+        missing_ids = set(response.json().get("missing_product_ids", []))
+        for compensation in due:
+            compensation.attempts += 1
+            if compensation.product_id in missing_ids:
+                compensation.status = "failed"
+                compensation.last_error = "Product no longer exists."
+            else:
+                compensation.status = "completed"
+                compensation.last_error = None
+        logger.info(
+            f"Order Service: Restocked {len(due) - len(missing_ids)} compensations; {len(missing_ids)} products no longer exist."
+        )
+    except httpx.HTTPStatusError as e:
+        permanent = e.response.status_code < 500
+        for compensation in due:
+            compensation.attempts += 1
+            compensation.last_error = (
+                f"HTTP {e.response.status_code}: {e.response.text[:500]}"
+            )
+            if permanent:
+                compensation.status = "failed"
+            else:
+                compensation.next_attempt_at = func.now() + timedelta(
+                    seconds=_backoff_seconds(compensation.attempts)
+                )
+        logger.error(
+            f"Order Service: Batch restock rejected by Product Service (status {e.response.status_code}). {'Marked as failed' if permanent else 'Will retry'}."
+        )
+    except httpx.RequestError as e:
+        for compensation in due:
+            compensation.attempts += 1
+            compensation.last_error = str(e)[:500]
+            compensation.next_attempt_at = func.now() + timedelta(
+                seconds=_backoff_seconds(compensation.attempts)
+            )
+        logger.warning(
+            f"Order Service: Product Service unavailable for stock compensation, will retry: {e}"
+        )
+
+    await db.commit()
+    return len(due)
+
+
+async def run_compensation_worker(client: httpx.AsyncClient):
+    """
+    Background task that keeps draining the compensation queue until cancelled.
+    """
+    logger.info("Order Service: Stock compensation worker started.")
+    while True:
+        processed = 0
+        try:
+            async with SessionLocal() as db:
+                processed = await process_compensation_batch(db, client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(
+                f"Order Service: Stock compensation worker iteration failed: {e}",
+                exc_info=True,
+            )
+        # A full batch means more work is probably waiting, so poll again immediately
+        if processed < STOCK_COMPENSATION_BATCH_SIZE:
+            await asyncio.sleep(STOCK_COMPENSATION_POLL_INTERVAL_SECONDS)
@@ -0,0 +1,54 @@
+# week08/backend/order_service/app/deadline.py
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# Remaining time budget of a request in milliseconds. Relative rather than absolute so
+# clock differences between services do not matter.
+REQUEST_DEADLINE_HEADER = "X-Request-Deadline-Ms"
+# Budget of an incoming request; a smaller budget sent by the caller wins
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "10"))
+
+# Monotonic deadline of the request being handled; unset in background workers
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def parse_deadline_header(value: Optional[str]) -> Optional[float]:
+    """Budget in seconds from an X-Request-Deadline-Ms value, or None if absent or invalid."""
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0) / 1000
+    except ValueError:
+        return None
+
+
+def start_deadline(budget_seconds: float):
+    """
+    Sets the deadline of the current request. Tasks created afterwards inherit it.
+    """
+    _deadline.set(time.monotonic() + budget_seconds)
+
+
+def remaining_seconds() -> Optional[float]:
+    """Time left before the current request's deadline, or None without a deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+@contextmanager
+def deadline_suspended():
+    """
+    Runs a block without the current request's deadline, for cleanup that must reach
+    the Product Service even after the deadline has passed.
+    """
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
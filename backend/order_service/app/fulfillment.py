@@ -0,0 +1,286 @@
+# week08/backend/order_service/app/fulfillment.py
+
+import asyncio
+import logging
+import os
+import random
+from datetime import timedelta
+from typing import Awaitable, Callable, List
+
+import httpx
+from fastapi import HTTPException
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from .compensation import enqueue_stock_compensations
+from .db import SessionLocal
+from .models import Order
+from .outbox import ORDER_STATUS_CHANGED, add_order_event
+from .schemas import OrderItemCreate
+
+logger = logging.getLogger(__name__)
+
+ORDER_FULFILLMENT_BATCH_SIZE = int(os.getenv("ORDER_FULFILLMENT_BATCH_SIZE", "10"))
+ORDER_FULFILLMENT_POLL_INTERVAL_SECONDS = float(
+    os.getenv("ORDER_FULFILLMENT_POLL_INTERVAL_SECONDS", "1")
+)
+# A claimed order is hidden from other workers for this long, counted again from when
+# its worker starts on it; if the worker dies, the order becomes due again and is
+# retried with the same downstream idempotency key
+ORDER_FULFILLMENT_LEASE_SECONDS = int(
+    os.getenv("ORDER_FULFILLMENT_LEASE_SECONDS", "60")
+)
+ORDER_FULFILLMENT_MAX_ATTEMPTS = int(os.getenv("ORDER_FULFILLMENT_MAX_ATTEMPTS", "5"))
+ORDER_FULFILLMENT_BASE_BACKOFF_SECONDS = float(
+    os.getenv("ORDER_FULFILLMENT_BASE_BACKOFF_SECONDS", "2")
+)
+ORDER_FULFILLMENT_MAX_BACKOFF_SECONDS = float(
+    os.getenv("ORDER_FULFILLMENT_MAX_BACKOFF_SECONDS", "300")
+)
+
+# (client, db, items, idempotency_key, compensate_unknown_outcome=False): deducts
+# stock or raises HTTPException; DeductionOutcomeUnknown if it may have been applied
+DeductStock = Callable[..., Awaitable[None]]
+
+
+class DeductionOutcomeUnknown(HTTPException):
+    """
+    The deduction request may have reached the Product Service, but no answer says
+    whether it was applied: a timeout, a dropped connection, a 5xx, or a 409 while
+    a request with the same Idempotency-Key is still being processed.
+    """
+
+
+def fulfillment_idempotency_key(order_id: int) -> str:
+    """Idempotency-Key sent with an order's stock deduction, the same on every attempt."""
+    return f"order-{order_id}"
+
+
+def _backoff_seconds(attempts: int) -> float:
+    ceiling = min(
+        ORDER_FULFILLMENT_MAX_BACKOFF_SECONDS,
+        ORDER_FULFILLMENT_BASE_BACKOFF_SECONDS * (2 ** max(attempts - 1, 0)),
+    )
+    return random.uniform(ceiling / 2, ceiling)
+
+
+async def claim_pending_orders(
+    db: AsyncSession, batch_size: int = ORDER_FULFILLMENT_BATCH_SIZE
+) -> List[Order]:
+    """
+    Claims up to batch_size due orders and returns them with their items.
+    Rows are picked with FOR UPDATE SKIP LOCKED and leased by moving next_fulfillment_at
+    forward, then committed, so no lock is held while the Product Service is called.
+    """
+    due = (
+        select(Order.order_id)
+        .where(
+            Order.fulfillment_pending.is_(True),
+            Order.status == "pending",
+            Order.next_fulfillment_at <= func.now(),
+        )
+        .order_by(Order.next_fulfillment_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    claimed_ids = (
+        (
+            await db.execute(
+                update(Order)
+                .where(Order.order_id.in_(due.scalar_subquery()))
+                .values(
+                    next_fulfillment_at=func.now()
+                    + timedelta(seconds=ORDER_FULFILLMENT_LEASE_SECONDS),
+                    fulfillment_attempts=Order.fulfillment_attempts + 1,
+                )
+                .returning(Order.order_id)
+                .execution_options(synchronize_session=False)
+            )
+        )
+        .scalars()
+        .all()
+    )
+    await db.commit()
+    if not claimed_ids:
+        return []
+    result = await db.execute(
+        select(Order)
+        .options(selectinload(Order.items))
+        .where(Order.order_id.in_(claimed_ids))
+        .order_by(Order.order_id)
+    )
+    return list(result.scalars().all())
+
+
+async def _renew_lease(db: AsyncSession, order_id: int, attempts: int) -> bool:
+    """
+    Restarts the lease of a claimed order right before it is processed, so every order
+    of a batch gets the full lease however long the orders before it took. Returns
+    False if the order was finished meanwhile, or claimed again by another worker
+    after the lease ran out (which bumped fulfillment_attempts).
+    """
+    result = await db.execute(
+        update(Order)
+        .where(
+            Order.order_id == order_id,
+            Order.fulfillment_pending.is_(True),
+            Order.status == "pending",
+            Order.fulfillment_attempts == attempts,
+        )
+        .values(
+            next_fulfillment_at=func.now()
+            + timedelta(seconds=ORDER_FULFILLMENT_LEASE_SECONDS)
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def fulfill_order(
+    db: AsyncSession, client: httpx.AsyncClient, order: Order, deduct_stock: DeductStock
+) -> str:
+    """
+    Deducts stock for one claimed order and records the outcome: confirmed, failed
+    (rejected by the Product Service or out of attempts), retrying (unavailable),
+    cancelled (stock given back because the order went away meanwhile) or skipped
+    (no longer this worker's order).
+    """
+    # Plain copies: the deduction may commit or roll back the session on the way
+    order_id, attempts = order.order_id, order.fulfillment_attempts
+    items = [
+        OrderItemCreate.model_validate(item, from_attributes=True)
+        for item in order.items
+    ]
+    if not await _renew_lease(db, order_id, attempts):
+        logger.info(
+            f"Order Service: Order {order_id} is no longer leased to this worker. Skipping it."
+        )
+        return "skipped"
+    last_attempt = attempts >= ORDER_FULFILLMENT_MAX_ATTEMPTS
+    try:
+        # On the last attempt a lost answer is confirmed and compensated before giving
+        # up; an outcome that still cannot be settled keeps the order retrying
+        await deduct_stock(
+            client,
+            db,
+            items,
+            fulfillment_idempotency_key(order_id),
+            compensate_unknown_outcome=last_attempt,
+        )
+    except HTTPException as e:
+        if e.status_code < 500 or (
+            last_attempt and not isinstance(e, DeductionOutcomeUnknown)
+        ):
+            outcome = "failed"
+            values = {
+                "status": "failed",
+                "fulfillment_pending": False,
+                "fulfillment_error": str(e.detail),
+            }
+        else:
+            outcome = "retrying"
+            values = {
+                "fulfillment_error": str(e.detail),
+                "next_fulfillment_at": func.now()
+                + timedelta(seconds=_backoff_seconds(attempts)),
+            }
+    else:
+        outcome = "confirmed"
+        values = {
+            "status": "confirmed",
+            "fulfillment_pending": False,
+            "fulfillment_error": None,
+        }
+
+    result = await db.execute(
+        update(Order)
+        .where(
+            Order.order_id == order_id,
+            Order.fulfillment_pending.is_(True),
+            Order.status == "pending",
+            Order.fulfillment_attempts == attempts,
+        )
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount and outcome != "retrying":
+        add_order_event(
+            db,
+            order_id,
+            ORDER_STATUS_CHANGED,
+            {
+                "order_id": order_id,
+                "status": outcome,
+                "previous_status": "pending",
+                "fulfillment_error": values["fulfillment_error"],
+            },
+        )
+    await db.commit()
+    if result.rowcount == 0 and outcome == "confirmed":
+        # Another worker that claimed the order after this lease ran out replays the
+        # same deduction and may have confirmed it already: only give the stock back
+        # if the order is really gone
+        current_status = (
+            await db.execute(select(Order.status).where(Order.order_id == order_id))
+        ).scalar_one_or_none()
+        await db.commit()
+        if current_status not in (None, "cancelled", "failed"):
+            logger.info(
+                f"Order Service: Order {order_id} was settled by another worker ({current_status})."
+            )
+            return "skipped"
+        logger.warning(
+            f"Order Service: Order {order_id} was {current_status or 'deleted'} during fulfillment. Queueing stock compensations."
+        )
+        await enqueue_stock_compensations(db, items)
+        return "cancelled"
+
+    log = logger.info if outcome == "confirmed" else logger.warning
+    log(
+        f"Order Service: Fulfillment of order {order_id} (attempt {attempts}): {outcome}."
+    )
+    return outcome
+
+
+async def process_order_fulfillment_batch(
+    db: AsyncSession,
+    client: httpx.AsyncClient,
+    deduct_stock: DeductStock,
+    batch_size: int = ORDER_FULFILLMENT_BATCH_SIZE,
+) -> int:
+    """
+    Claims and fulfills up to batch_size pending orders. Returns the number processed.
+    """
+    orders = await claim_pending_orders(db, batch_size)
+    for order in orders:
+        await fulfill_order(db, client, order, deduct_stock)
+    return len(orders)
+
+
+async def run_fulfillment_worker(
+    client: httpx.AsyncClient, deduct_stock: DeductStock, worker_number: int = 1
+):
+    """
+    Background task that keeps fulfilling pending orders until cancelled.
+    Several of these run side by side; SKIP LOCKED keeps them from claiming the same order.
+    """
+    logger.info(f"Order Service: Order fulfillment worker {worker_number} started.")
+    while True:
+        processed = 0
+        try:
+            async with SessionLocal() as db:
+                processed = await process_order_fulfillment_batch(
+                    db, client, deduct_stock
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(
+                f"Order Service: Order fulfillment worker {worker_number} iteration failed: {e}",
+                exc_info=True,
+            )
+        # A full batch means more orders are probably waiting, so poll again immediately
+        if processed < ORDER_FULFILLMENT_BATCH_SIZE:
+            await asyncio.sleep(ORDER_FULFILLMENT_POLL_INTERVAL_SECONDS)
@@ -1,21 +1,78 @@
 # week08/backend/order_service/app/main.py
 
+import asyncio
+import json
 import logging
 import os
 import sys
 import time
+import uuid
+from datetime import datetime
 from decimal import Decimal
-from typing import List, Optional
+from typing import List, Optional, Union
 
 import httpx
-from fastapi import Depends, FastAPI, HTTPException, Query, Response, status
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import func, select, text, tuple_
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from sqlalchemy.schema import CreateIndex
 
-from .db import Base, engine, get_db
-from .models import Order, OrderItem
-from .schemas import OrderCreate, OrderItemResponse, OrderResponse, OrderUpdate
+from .compensation import enqueue_stock_compensations, run_compensation_worker
+from .db import Base, engine, get_db, pool_diagnostics, start_query_stats
+from .deadline import (
+    REQUEST_DEADLINE_HEADER,
+    REQUEST_DEADLINE_SECONDS,
+    deadline_suspended,
+    parse_deadline_header,
+    start_deadline,
+)
+from .fulfillment import DeductionOutcomeUnknown, run_fulfillment_worker
+from .idempotency import (
+    IDEMPOTENCY_KEY_HEADER,
+    IDEMPOTENCY_REPLAYED_HEADER,
+    begin_idempotent_request,
+    release_idempotency_key,
+    run_idempotency_key_cleanup,
+    save_idempotent_response,
+)
+from .metrics import register_collectors, track_request_metrics
+from .models import Order, OrderItem, StockCompensation
+from .outbox import (
+    ORDER_CREATED,
+    ORDER_DELETED,
+    ORDER_STATUS_CHANGED,
+    add_order_event,
+    create_outbox_sink,
+    run_outbox_publisher,
+)
+from .pagination import decode_cursor, encode_cursor
+from .product_client import (
+    PRODUCT_SERVICE_URL,
+    create_product_client,
+    get_product_client,
+)
+from .resilience import DeadlineExceededError, ProductServiceUnavailable
+from .schemas import (
+    OrderCreate,
+    OrderItemCreate,
+    OrderItemResponse,
+    OrderResponse,
+    OrderSummaryResponse,
+    OrderUpdate,
+)
 
 # --- Standard Logging Configuration ---
 logging.basicConfig(
@@ -29,11 +86,62 @@ logger = logging.getLogger(__name__)
 logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
 logging.getLogger("uvicorn.error").setLevel(logging.INFO)
 
-PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", "http://localhost:8000")
 logger.info(
     f"Order Service: Configured to communicate with Product Service at: {PRODUCT_SERVICE_URL}"
 )
 
+# Stock deduction settings: prefer the all-or-nothing batch endpoint; otherwise deduct
+# line items concurrently with a bounded number of calls in flight.
+USE_BATCH_STOCK_DEDUCTION = (
+    os.getenv("USE_BATCH_STOCK_DEDUCTION", "true").lower() == "true"
+)
+STOCK_DEDUCTION_CONCURRENCY = int(os.getenv("STOCK_DEDUCTION_CONCURRENCY", "10"))
+BATCH_DEDUCT_STOCK_PATH = "/products/deduct-stock:batch"
+# Older Product Service versions answer the batch path with 405 (or 501 behind some proxies)
+BATCH_DEDUCTION_UNAVAILABLE_STATUSES = (
+    status.HTTP_405_METHOD_NOT_ALLOWED,
+    status.HTTP_501_NOT_IMPLEMENTED,
+)
+# After such an answer the batch endpoint is skipped, then probed again once this
+# long has passed, so an upgraded Product Service is picked up without a restart
+BATCH_DEDUCTION_REPROBE_SECONDS = float(
+    os.getenv("BATCH_DEDUCTION_REPROBE_SECONDS", "300")
+)
+_batch_deduction_unavailable_until = 0.0  # time.monotonic() value
+# Deductions refused for now rather than for good: 409 while a request with the same
+# Idempotency-Key is still in progress, 429 when the Product Service sheds load
+RETRYABLE_DEDUCTION_STATUSES = (
+    status.HTTP_409_CONFLICT,
+    status.HTTP_429_TOO_MANY_REQUESTS,
+)
+
+# Sort key recorded in order list cursors
+ORDER_LIST_SORT = "order_date_desc"
+
+# Background worker that drains the stock compensation queue
+STOCK_COMPENSATION_WORKER_ENABLED = (
+    os.getenv("STOCK_COMPENSATION_WORKER_ENABLED", "true").lower() == "true"
+)
+
+# Background task deleting expired idempotency keys
+IDEMPOTENCY_KEY_CLEANUP_ENABLED = (
+    os.getenv("IDEMPOTENCY_KEY_CLEANUP_ENABLED", "true").lower() == "true"
+)
+CREATE_ORDER_IDEMPOTENCY_SCOPE = "create-order"
+
+# Asynchronous intake: orders are stored as pending, answered with 202 and fulfilled
+# by a pool of background workers. Clients opt in per request with
+# "Prefer: respond-async", or it becomes the default with ASYNC_ORDER_INTAKE=true.
+ASYNC_ORDER_INTAKE = os.getenv("ASYNC_ORDER_INTAKE", "false").lower() == "true"
+ORDER_FULFILLMENT_WORKERS = int(os.getenv("ORDER_FULFILLMENT_WORKERS", "2"))
+
+# Background task publishing order events from the outbox table (see outbox.py)
+OUTBOX_PUBLISHER_ENABLED = (
+    os.getenv("OUTBOX_PUBLISHER_ENABLED", "true").lower() == "true"
+)
+
+register_collectors(engine)
+
 # --- FastAPI Application Setup ---
 app = FastAPI(
     title="Order Service API",
@@ -48,9 +156,79 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "Link",
+        "X-Next-Cursor",
+        "X-DB-Queries",
+        "Server-Timing",
+        "Location",
+        "Preference-Applied",
+        IDEMPOTENCY_REPLAYED_HEADER,
+    ],
 )
 
 
+@app.middleware("http")
+async def request_deadline_middleware(request: Request, call_next):
+    """
+    Starts the request's deadline: REQUEST_DEADLINE_SECONDS, or less if the caller sent
+    a smaller X-Request-Deadline-Ms budget. Product Service calls made while handling
+    the request are capped at the time left and pass the rest on. The handler itself is
+    not cancelled, so a late request still finishes or compensates its stock changes.
+    """
+    budget = parse_deadline_header(request.headers.get(REQUEST_DEADLINE_HEADER))
+    start_deadline(
+        REQUEST_DEADLINE_SECONDS
+        if budget is None
+        else min(budget, REQUEST_DEADLINE_SECONDS)
+    )
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def db_query_stats_middleware(request: Request, call_next):
+    """
+    Reports how many SQL statements a request ran and their total DB time in the
+    X-DB-Queries and Server-Timing headers, so N+1 patterns and slow queries show up
+    in browser dev tools and tests.
+    """
+    stats = start_query_stats()
+    response = await call_next(request)
+    response.headers["X-DB-Queries"] = str(stats.count)
+    response.headers["Server-Timing"] = (
+        f'db;dur={stats.duration_seconds * 1000:.1f};desc="{stats.count} queries"'
+    )
+    return response
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    # Added last so it is the outermost middleware and times the whole request
+    return await track_request_metrics(request, call_next)
+
+
+def _upgrade_existing_schema(connection):
+    """
+    create_all only creates missing tables, so columns and indexes added after an
+    orders or compensations table was first created are added here. Every statement
+    is idempotent.
+    """
+    for table, column_definition in (
+        (Order, "fulfillment_pending BOOLEAN NOT NULL DEFAULT false"),
+        (Order, "fulfillment_attempts INTEGER NOT NULL DEFAULT 0"),
+        (Order, "next_fulfillment_at TIMESTAMP WITH TIME ZONE"),
+        (Order, "fulfillment_error TEXT"),
+        (StockCompensation, "idempotency_key UUID NOT NULL DEFAULT gen_random_uuid()"),
+    ):
+        connection.execute(
+            text(
+                f"ALTER TABLE {table.__tablename__} ADD COLUMN IF NOT EXISTS {column_definition}"
+            )
+        )
+    for index in Order.__table__.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+
 # --- FastAPI Event Handlers ---
 @app.on_event("startup")
 async def startup_event():
@@ -61,18 +239,21 @@ async def startup_event():
             logger.info(
                 f"Order Service: Attempting to connect to PostgreSQL and create tables (attempt {i+1}/{max_retries})..."
             )
-            Base.metadata.create_all(bind=engine)
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+                await connection.run_sync(_upgrade_existing_schema)
             logger.info(
                 "Order Service: Successfully connected to PostgreSQL and ensured tables exist."
             )
             break  # Exit loop if successful
-        except OperationalError as e:
+        except (OperationalError, OSError) as e:
+            # asyncpg reports refused connections as OSError rather than a DBAPI error
             logger.warning(f"Order Service: Failed to connect to PostgreSQL: {e}")
             if i < max_retries - 1:
                 logger.info(
                     f"Order Service: Retrying in {retry_delay_seconds} seconds..."
                 )
-                time.sleep(retry_delay_seconds)
+                await asyncio.sleep(retry_delay_seconds)
             else:
                 logger.critical(
                     f"Order Service: Failed to connect to PostgreSQL after {max_retries} attempts. Exiting application."
@@ -86,6 +267,69 @@ async def startup_event():
             sys.exit(1)
 
 
+@app.on_event("startup")
+async def startup_product_client():
+    # One pooled client per process so connections to the Product Service are reused
+    app.state.product_client = create_product_client()
+    app.state.compensation_worker = None
+    if STOCK_COMPENSATION_WORKER_ENABLED:
+        app.state.compensation_worker = asyncio.create_task(
+            run_compensation_worker(app.state.product_client)
+        )
+    app.state.fulfillment_workers = [
+        asyncio.create_task(
+            run_fulfillment_worker(app.state.product_client, _deduct_stock, number)
+        )
+        for number in range(1, ORDER_FULFILLMENT_WORKERS + 1)
+    ]
+    app.state.outbox_sink = None
+    app.state.outbox_publisher = None
+    if OUTBOX_PUBLISHER_ENABLED:
+        app.state.outbox_sink = create_outbox_sink()
+        app.state.outbox_publisher = asyncio.create_task(
+            run_outbox_publisher(app.state.outbox_sink)
+        )
+    app.state.idempotency_key_cleanup_task = None
+    if IDEMPOTENCY_KEY_CLEANUP_ENABLED:
+        app.state.idempotency_key_cleanup_task = asyncio.create_task(
+            run_idempotency_key_cleanup()
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if app.state.compensation_worker is not None:
+        app.state.compensation_worker.cancel()
+        try:
+            await app.state.compensation_worker
+        except asyncio.CancelledError:
+            pass
+        logger.info("Order Service: Stock compensation worker stopped.")
+    for worker in app.state.fulfillment_workers:
+        worker.cancel()
+    if app.state.fulfillment_workers:
+        await asyncio.gather(*app.state.fulfillment_workers, return_exceptions=True)
+        logger.info("Order Service: Order fulfillment workers stopped.")
+    if app.state.outbox_publisher is not None:
+        app.state.outbox_publisher.cancel()
+        try:
+            await app.state.outbox_publisher
+        except asyncio.CancelledError:
+            pass
+        await app.state.outbox_sink.aclose()
+        logger.info("Order Service: Outbox publisher stopped.")
+    if app.state.idempotency_key_cleanup_task is not None:
+        app.state.idempotency_key_cleanup_task.cancel()
+        try:
+            await app.state.idempotency_key_cleanup_task
+        except asyncio.CancelledError:
+            pass
+        logger.info("Order Service: Idempotency key cleanup stopped.")
+    await app.state.product_client.aclose()
+    logger.info("Order Service: Product Service client closed.")
+    await engine.dispose()
+
+
 # --- Root Endpoint ---
 @app.get("/", status_code=status.HTTP_200_OK, summary="Root endpoint")
 async def read_root():
@@ -98,195 +342,732 @@ async def health_check():
     return {"status": "ok", "service": "order-service"}
 
 
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get(
+    "/diagnostics/db-pool",
+    status_code=status.HTTP_200_OK,
+    summary="DB connection pool usage and checkout wait times",
+)
+async def db_pool_diagnostics():
+    return pool_diagnostics()
+
+
 @app.post(
     "/orders/",
     response_model=OrderResponse,
     status_code=status.HTTP_201_CREATED,
     summary="Create a new order",
+    responses={
+        status.HTTP_202_ACCEPTED: {
+            "model": OrderResponse,
+            "description": "Order stored as pending; poll the Location URL for its status.",
+        }
+    },
 )
-async def create_order(order: OrderCreate, db: Session = Depends(get_db)):
+async def create_order(
+    order: OrderCreate,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    client: httpx.AsyncClient = Depends(get_product_client),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER),
+    prefer: Optional[str] = Header(None),
+):
+    """
+    Deducts stock for all items and stores the order.
+    With "Prefer: respond-async" (or ASYNC_ORDER_INTAKE) the order is only stored as
+    pending and 202 is returned; a background worker deducts the stock later and
+    moves it to confirmed or failed.
+    A retry with the same Idempotency-Key gets the first response back without
+    deducting stock or creating another order. Failed attempts release the key,
+    except those whose stock was deducted under it and given back: their error is
+    stored and replayed, so a new attempt needs a new key.
+    """
     if not order.items:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Order must contain at least one item.",
         )
 
-    # List to store successfully deducted items in case of partial failures
-    successfully_deducted_items = []
-    logger.info(f"Order Service: Creating new order for user_id: {order.user_id}")
+    if _wants_async_intake(prefer):
+        return await _accept_order(order, response, db, idempotency_key)
 
-    # Use an httpx client for synchronous calls to the Product Service
-    async with httpx.AsyncClient() as client:
-        for item in order.items:
-            product_id = item.product_id
-            quantity = item.quantity
+    if idempotency_key is None:
+        return await _place_order(order, db, client, None)
 
-            deduct_stock_url = (
-                f"{PRODUCT_SERVICE_URL}/products/{product_id}/deduct-stock"
-            )
-            logger.info(
-                f"Order Service: Attempting to deduct stock for product {product_id} (qty: {quantity}) via Product Service at {deduct_stock_url}"
+    replay = await begin_idempotent_request(
+        db, CREATE_ORDER_IDEMPOTENCY_SCOPE, idempotency_key, order.model_dump()
+    )
+    if replay is not None:
+        return replay
+    # Committed before calling the Product Service, so a retry arriving while this
+    # request is still running gets 409 instead of deducting stock a second time
+    await db.commit()
+    try:
+        return await _place_order(order, db, client, idempotency_key)
+    except _DeductionCompensated as e:
+        await _store_failed_order_response(db, idempotency_key, e)
+        raise
+    except Exception:
+        await _release_idempotency_key(db, idempotency_key)
+        raise
+
+
+async def _store_failed_order_response(
+    db: AsyncSession, idempotency_key: str, error: HTTPException
+):
+    """
+    Completes the key with the error instead of releasing it. The stock deduction
+    keyed by it was given back, and the Product Service would replay it as successful
+    to a retry with the same key.
+    """
+    try:
+        await db.rollback()
+        await save_idempotent_response(
+            db,
+            CREATE_ORDER_IDEMPOTENCY_SCOPE,
+            idempotency_key,
+            error.status_code,
+            json.dumps({"detail": error.detail}),
+        )
+        await db.commit()
+    except Exception as e:
+        logger.error(
+            f"Order Service: Could not store failed response for {IDEMPOTENCY_KEY_HEADER} '{idempotency_key}': {e}"
+        )
+
+
+async def _release_idempotency_key(db: AsyncSession, idempotency_key: str):
+    try:
+        await db.rollback()
+        await release_idempotency_key(
+            db, CREATE_ORDER_IDEMPOTENCY_SCOPE, idempotency_key
+        )
+        await db.commit()
+    except Exception as e:
+        # The key is reclaimable once IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS have passed
+        logger.error(
+            f"Order Service: Could not release {IDEMPOTENCY_KEY_HEADER} '{idempotency_key}': {e}"
+        )
+
+
+def _wants_async_intake(prefer: Optional[str]) -> bool:
+    if ASYNC_ORDER_INTAKE or prefer is None:
+        return ASYNC_ORDER_INTAKE
+    return "respond-async" in {p.strip().lower() for p in prefer.split(",")}
+
+
+def _build_order(order: OrderCreate, order_status: str) -> Order:
+    # Items are attached through the relationship, so the order and its items are
+    # inserted in one flush and stay loaded for the response after commit
+    return Order(
+        user_id=order.user_id,
+        shipping_address=order.shipping_address,
+        total_amount=sum(
+            Decimal(str(item.quantity)) * Decimal(str(item.price_at_purchase))
+            for item in order.items
+        ),
+        status=order_status,
+        items=[
+            OrderItem(
+                product_id=item.product_id,
+                quantity=item.quantity,
+                price_at_purchase=item.price_at_purchase,
+                item_total=Decimal(str(item.quantity))
+                * Decimal(str(item.price_at_purchase)),
             )
-            # kubectl exec -it order-service-w04e2-64585d75f9-bt5rv -n ecomm-w04e2-local-k8s -- curl -X POST -H "Content-Type: application/json" -d '{"quantity_to_deduct": 2}' http://product-service-w04e2:8000/products/1/deduct_stock_url
-            try:
-                # Synchronous call to Product Service to deduct stock
-                response = await client.patch(
-                    deduct_stock_url,
-                    json={"quantity_to_deduct": quantity},
-                    timeout=5,  # Set a timeout for the external API call
-                )
-                response.raise_for_status()  # Raise an exception for 4xx/5xx responses
+            for item in order.items
+        ],
+    )
 
-                logger.info(
-                    f"Order Service: Stock deduction successful for product {product_id}."
-                )
-                successfully_deducted_items.append(item)
-
-            except httpx.HTTPStatusError as e:
-                # Handle specific HTTP errors from Product Service
-                error_detail = "Unknown error during stock deduction."
-                if e.response.status_code == status.HTTP_404_NOT_FOUND:
-                    error_detail = f"Product {product_id} not found."
-                elif e.response.status_code == status.HTTP_400_BAD_REQUEST:
-                    response_json = e.response.json()
-                    error_detail = response_json.get(
-                        "detail", "Insufficient stock or invalid request."
-                    )
-
-                logger.error(
-                    f"Order Service: Stock deduction failed for product {product_id}: {error_detail}. Status: {e.response.status_code}"
-                )
-                # Rollback any previously successful deductions in case of failure
-                await _rollback_stock_deductions(client, successfully_deducted_items)
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,  # Or appropriate status
-                    detail=f"Failed to deduct stock for product {product_id}: {error_detail}",
-                )
-            except httpx.RequestError as e:
-                # Handle network errors (e.g., Product Service is down)
-                logger.critical(
-                    f"Order Service: Network error communicating with Product Service for product {product_id}: {e}"
-                )
-                await _rollback_stock_deductions(client, successfully_deducted_items)
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Product Service is currently unavailable. Please try again later. Error: {e}",
-                )
-            except Exception as e:
-                # Catch any other unexpected errors during deduction
-                logger.error(
-                    f"Order Service: An unexpected error occurred during stock deduction for product {product_id}: {e}",
-                    exc_info=True,
-                )
-                await _rollback_stock_deductions(client, successfully_deducted_items)
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"An unexpected error occurred during order creation: {e}",
-                )
 
-    # If all stock deductions are successful, proceed with order creation
+async def _accept_order(
+    order: OrderCreate,
+    response: Response,
+    db: AsyncSession,
+    idempotency_key: Optional[str],
+):
+    """
+    Stores the order as pending for the fulfillment workers in one transaction and
+    answers 202 with its status URL. No Product Service call is made here.
+    """
     logger.info(
-        "Order Service: All product stock deductions successful. Proceeding to create order."
+        f"Order Service: Accepting order for user_id {order.user_id} for background fulfillment."
     )
+    if idempotency_key is not None:
+        replay = await begin_idempotent_request(
+            db, CREATE_ORDER_IDEMPOTENCY_SCOPE, idempotency_key, order.model_dump()
+        )
+        if replay is not None:
+            return replay
 
-    total_amount = sum(
-        Decimal(str(item.quantity)) * Decimal(str(item.price_at_purchase))
-        for item in order.items
+    db_order = _build_order(order, "pending")
+    db_order.fulfillment_pending = True
+    db_order.next_fulfillment_at = func.now()
+    try:
+        db.add(db_order)
+        await db.flush()
+        order_response = OrderResponse.model_validate(db_order)
+        add_order_event(
+            db,
+            order_response.order_id,
+            ORDER_CREATED,
+            order_response.model_dump(mode="json"),
+        )
+        if idempotency_key is not None:
+            await save_idempotent_response(
+                db,
+                CREATE_ORDER_IDEMPOTENCY_SCOPE,
+                idempotency_key,
+                status.HTTP_202_ACCEPTED,
+                order_response.model_dump_json(),
+            )
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Order Service: Error accepting order: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not accept order.",
+        )
+
+    logger.info(
+        f"Order Service: Order {order_response.order_id} accepted as pending for user {order.user_id}."
     )
+    response.status_code = status.HTTP_202_ACCEPTED
+    response.headers["Location"] = f"/orders/{order_response.order_id}"
+    response.headers["Preference-Applied"] = "respond-async"
+    return order_response
 
-    db_order = Order(
-        user_id=order.user_id,
-        shipping_address=order.shipping_address,
-        total_amount=total_amount,
-        status="pending",  # Initial status
+
+async def _place_order(
+    order: OrderCreate,
+    db: AsyncSession,
+    client: httpx.AsyncClient,
+    idempotency_key: Optional[str],
+):
+    logger.info(f"Order Service: Creating new order for user_id: {order.user_id}")
+
+    # Synchronous call to the Product Service over the shared, pooled client. The key
+    # lets a lost answer be confirmed without deducting twice; derived from the
+    # client's key, it also covers a client retry after the confirmation failed.
+    await _deduct_stock(
+        client,
+        db,
+        order.items,
+        f"create-order-{idempotency_key or uuid.uuid4()}",
+        compensate_unknown_outcome=True,
     )
 
-    db.add(db_order)
-    db.flush()  # Use flush to get order_id before committing, needed for order items
+    # If all stock deductions are successful, proceed with order creation
+    logger.info(
+        "Order Service: All product stock deductions successful. Proceeding to create order."
+    )
 
-    for item in order.items:
-        db_order_item = OrderItem(
-            order_id=db_order.order_id,
-            product_id=item.product_id,
-            quantity=item.quantity,
-            price_at_purchase=item.price_at_purchase,
-            item_total=Decimal(str(item.quantity))
-            * Decimal(str(item.price_at_purchase)),
-        )
-        db.add(db_order_item)
+    db_order = _build_order(order, "pending")  # Initial status
 
     try:
+        db.add(db_order)
         # After successful stock deductions and before final commit, update status to 'confirmed'
         db_order.status = "confirmed"  # Set status to confirmed here
-        db.commit()
-        db.refresh(db_order)
-        # Ensure order items are loaded for the response model
-        db.add(db_order)  # Re-add to session if detached by refresh or commit
-        db.refresh(db_order, attribute_names=["items"])
+        await db.flush()
+        order_response = OrderResponse.model_validate(db_order)
+        # Event and stored response are in the order's transaction: all commit or none do
+        add_order_event(
+            db,
+            order_response.order_id,
+            ORDER_CREATED,
+            order_response.model_dump(mode="json"),
+        )
+        if idempotency_key is not None:
+            await save_idempotent_response(
+                db,
+                CREATE_ORDER_IDEMPOTENCY_SCOPE,
+                idempotency_key,
+                status.HTTP_201_CREATED,
+                order_response.model_dump_json(),
+            )
+        await db.commit()
         logger.info(
             f"Order Service: Order {db_order.order_id} created and confirmed successfully for user {db_order.user_id}."
         )
         return db_order
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Order Service: Error creating order after successful stock deductions: {e}",
             exc_info=True,
         )
-        # CRITICAL: If DB commit fails here, you have a mismatch.
-        # In a real system, you'd likely need a compensation transaction or alerting.
-        # For this example, we log the severe error.
-        raise HTTPException(
+        # CRITICAL: If DB commit fails here, the deducted stock must be given back.
+        await _rollback_stock_deductions(db, order.items)
+        raise _DeductionCompensated(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Order created but failed to save to database. Manual intervention required.",
         )
 
 
-async def _rollback_stock_deductions(client: httpx.AsyncClient, items: List[OrderItem]):
-    if not items:
-        return
+class _BatchDeductionUnavailable(Exception):
+    """Raised when the Product Service does not expose the batch deduction endpoint."""
+
+
+class _DeductionCompensated(HTTPException):
+    """The stock deduction was applied, then queued to be given back."""
+
+
+# Network errors raised before a request was sent, so nothing can have been deducted
+_REQUEST_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
 
+async def _deduct_stock(
+    client: httpx.AsyncClient,
+    db: AsyncSession,
+    items: List[OrderItemCreate],
+    idempotency_key: Optional[str] = None,
+    compensate_unknown_outcome: bool = False,
+):
+    """
+    Deducts stock for all order items, preferring the all-or-nothing batch endpoint.
+    Falls back to concurrent per-item deductions when the batch endpoint is disabled
+    or was not available on the Product Service within BATCH_DEDUCTION_REPROBE_SECONDS.
+    idempotency_key is sent with the batch call, so retrying it never deducts twice.
+    With compensate_unknown_outcome, a batch call whose answer is lost is confirmed
+    and compensated before the error is raised; DeductionOutcomeUnknown is only raised
+    if that fails too. Callers that retry with the same key (the fulfillment workers)
+    turn it on for their last attempt only. Per-item deductions are compensated on
+    failure instead, and are sent without a key since Product Services old enough to
+    lack the batch endpoint do not support one.
+    """
+    global _batch_deduction_unavailable_until
+    if (
+        USE_BATCH_STOCK_DEDUCTION
+        and time.monotonic() >= _batch_deduction_unavailable_until
+    ):
+        try:
+            await _deduct_stock_batch(
+                client, db, items, idempotency_key, compensate_unknown_outcome
+            )
+            return
+        except _BatchDeductionUnavailable:
+            _batch_deduction_unavailable_until = (
+                time.monotonic() + BATCH_DEDUCTION_REPROBE_SECONDS
+            )
+            logger.warning(
+                f"Order Service: Product Service has no batch stock deduction endpoint. Falling back to per-item deductions for {BATCH_DEDUCTION_REPROBE_SECONDS:g}s."
+            )
+    await _deduct_stock_concurrently(client, db, items)
+
+
+async def _deduct_stock_batch(
+    client: httpx.AsyncClient,
+    db: AsyncSession,
+    items: List[OrderItemCreate],
+    idempotency_key: Optional[str] = None,
+    compensate_unknown_outcome: bool = False,
+):
+    """
+    Deducts stock for all order items with one all-or-nothing call to the Product Service.
+    Raises HTTPException on failure; in that case no stock has been deducted, or it
+    has been queued for compensation (see _compensate_unknown_deduction).
+    """
+    target = f"products {[item.product_id for item in items]}"
+    payload = {
+        "items": [
+            {"product_id": item.product_id, "quantity_to_deduct": item.quantity}
+            for item in items
+        ]
+    }
+    try:
+        await _request_stock_deduction(
+            client,
+            "POST",
+            BATCH_DEDUCT_STOCK_PATH,
+            payload,
+            target,
+            headers=(
+                {IDEMPOTENCY_KEY_HEADER: idempotency_key}
+                if idempotency_key is not None
+                else None
+            ),
+        )
+    except DeductionOutcomeUnknown as e:
+        if not compensate_unknown_outcome or idempotency_key is None:
+            raise
+        applied = await _compensate_unknown_deduction(
+            client, db, items, payload, target, idempotency_key
+        )
+        if applied is None:
+            raise
+        # Settled: nothing is left deducted, so the failure is a plain one
+        error_class = _DeductionCompensated if applied else HTTPException
+        raise error_class(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
+
+async def _compensate_unknown_deduction(
+    client: httpx.AsyncClient,
+    db: AsyncSession,
+    items: List[OrderItemCreate],
+    payload: dict,
+    target: str,
+    idempotency_key: str,
+) -> Optional[bool]:
+    """
+    Finds out whether a batch deduction whose answer was lost was applied by sending it
+    again with the same Idempotency-Key: the Product Service replays the stored result,
+    or deducts now if the first request never committed. A success therefore means the
+    stock was deducted exactly once, and it is queued for compensation.
+    Returns whether the deduction was applied, or None if that is still unknown.
+    """
     logger.warning(
-        "Order Service: Attempting to rollback stock deductions due to order creation failure."
+        f"Order Service: Outcome of stock deduction for {target} unknown. Confirming with {IDEMPOTENCY_KEY_HEADER} '{idempotency_key}'."
     )
-    for item in items:
-        product_id = item.product_id
-        quantity = item.quantity
-        add_stock_url = f"{PRODUCT_SERVICE_URL}/products/{product_id}/deduct-stock"  # Assuming -ve quantity adds stock
+    error = None
+    # The request's deadline has usually passed by now, but the stock must be settled
+    with deadline_suspended():
+        try:
+            response = await client.request(
+                "POST",
+                BATCH_DEDUCT_STOCK_PATH,
+                json=payload,
+                headers={IDEMPOTENCY_KEY_HEADER: idempotency_key},
+            )
+        except httpx.RequestError as e:
+            response, error = None, e
 
+    if response is not None and response.status_code < 300:
         logger.warning(
-            f"Order Service: Cannot automatically rollback stock for product {product_id} quantity {quantity}. Manual stock adjustment may be required in Product Service."
+            f"Order Service: Stock deduction for {target} was applied. Compensating it."
         )
+        await _rollback_stock_deductions(db, items)
+        return True
+    if (
+        response is not None
+        and response.status_code < 500
+        and response.status_code not in RETRYABLE_DEDUCTION_STATUSES
+    ):
+        logger.info(f"Order Service: Stock deduction for {target} was not applied.")
+        return False
+    logger.critical(
+        f"Order Service: Could not confirm stock deduction for {target} with {IDEMPOTENCY_KEY_HEADER} '{idempotency_key}': {error or f'status {response.status_code}'}. Manual stock adjustment may be required in Product Service."
+    )
+    return None
+
+
+async def _deduct_stock_concurrently(
+    client: httpx.AsyncClient, db: AsyncSession, items: List[OrderItemCreate]
+):
+    """
+    Deducts stock item by item, with at most STOCK_DEDUCTION_CONCURRENCY calls in flight.
+    On the first failure, deductions still waiting for a slot are cancelled. Calls already
+    in flight are allowed to finish so that every successful deduction is known and
+    handed to _rollback_stock_deductions before the error is raised.
+    """
+    semaphore = asyncio.Semaphore(STOCK_DEDUCTION_CONCURRENCY)
+    failed = asyncio.Event()
+
+    async def deduct_item(item: OrderItemCreate) -> bool:
+        async with semaphore:
+            if failed.is_set():
+                return False  # Cancelled: another item already failed
+            try:
+                await _request_stock_deduction(
+                    client,
+                    "PATCH",
+                    f"/products/{item.product_id}/deduct-stock",
+                    {"quantity_to_deduct": item.quantity},
+                    f"product {item.product_id}",
+                )
+            except BaseException:
+                failed.set()
+                raise
+            return True
+
+    results = await asyncio.gather(
+        *(deduct_item(item) for item in items), return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        deducted_items = [
+            item for item, result in zip(items, results) if result is True
+        ]
+        await _rollback_stock_deductions(db, deducted_items)
+        error = errors[0]
+        if isinstance(error, DeductionOutcomeUnknown):
+            # Per-item deductions carry no key, so a lost answer cannot be confirmed
+            # and retrying could deduct twice: fail like any other error instead
+            raise HTTPException(
+                status_code=error.status_code,
+                detail=error.detail,
+                headers=error.headers,
+            )
+        raise error
+
+
+async def _request_stock_deduction(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    payload: dict,
+    target: str,
+    headers: Optional[dict] = None,
+) -> httpx.Response:
+    """
+    Sends one stock deduction request to the Product Service and translates failures
+    into the HTTPException returned to the caller of create_order.
+    """
+    logger.info(
+        f"Order Service: Attempting to deduct stock for {target} via Product Service at {PRODUCT_SERVICE_URL}{url}"
+    )
+    try:
+        # Synchronous call to Product Service to deduct stock
+        request_options = {"json": payload}
+        if headers:
+            request_options["headers"] = headers
+        response = await client.request(method, url, **request_options)
+        if (
+            url == BATCH_DEDUCT_STOCK_PATH
+            and response.status_code in BATCH_DEDUCTION_UNAVAILABLE_STATUSES
+        ):
+            raise _BatchDeductionUnavailable()
+        response.raise_for_status()  # Raise an exception for 4xx/5xx responses
+
+        logger.info(f"Order Service: Stock deduction successful for {target}.")
+        return response
+
+    except _BatchDeductionUnavailable:
+        raise
+    except ProductServiceUnavailable as e:
+        # Circuit open or bulkhead full: rejected without calling the Product Service
+        logger.warning(
+            f"Order Service: Stock deduction for {target} rejected without calling Product Service: {e}"
+        )
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Product Service is currently unavailable. Please try again later. Error: {e}",
+            headers={"Retry-After": str(e.retry_after_seconds)},
+        )
+    except DeadlineExceededError as e:
+        logger.error(
+            f"Order Service: Request deadline exceeded while deducting stock for {target}: {e}"
+        )
+        raise DeductionOutcomeUnknown(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Product Service did not answer within the request deadline. Error: {e}",
+        )
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code >= 500:
+            # Kept as a 5xx so callers (and fulfillment workers) treat it as transient
+            logger.error(
+                f"Order Service: Product Service failed to deduct stock for {target}. Status: {e.response.status_code}"
+            )
+            raise DeductionOutcomeUnknown(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Product Service is currently unavailable. Please try again later. Status: {e.response.status_code}",
+            )
+        if e.response.status_code in RETRYABLE_DEDUCTION_STATUSES:
+            # Kept as a 503 so fulfillment workers retry instead of failing the order;
+            # a 409 means the earlier request with this key may still commit
+            logger.warning(
+                f"Order Service: Product Service cannot deduct stock for {target} right now. Status: {e.response.status_code}"
+            )
+            error_class = (
+                DeductionOutcomeUnknown
+                if e.response.status_code == status.HTTP_409_CONFLICT
+                else HTTPException
+            )
+            retry_after = e.response.headers.get("Retry-After")
+            raise error_class(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Product Service is busy. Please try again later. Status: {e.response.status_code}",
+                headers={"Retry-After": retry_after} if retry_after else None,
+            )
+        # Handle specific HTTP errors from Product Service
+        error_detail = "Unknown error during stock deduction."
+        if e.response.status_code in (
+            status.HTTP_404_NOT_FOUND,
+            status.HTTP_400_BAD_REQUEST,
+        ):
+            response_json = e.response.json()
+            error_detail = response_json.get(
+                "detail", "Product not found, insufficient stock or invalid request."
+            )
+
+        logger.error(
+            f"Order Service: Stock deduction failed for {target}: {error_detail}. Status: {e.response.status_code}"
+        )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,  # Or appropriate status
+            detail=f"Failed to deduct stock for {target}: {error_detail}",
+        )
+    except httpx.RequestError as e:
+        # Handle network errors (e.g., Product Service is down)
+        logger.critical(
+            f"Order Service: Network error communicating with Product Service for {target}: {e}"
+        )
+        error_class = (
+            HTTPException
+            if isinstance(e, _REQUEST_NOT_SENT_ERRORS)
+            else DeductionOutcomeUnknown
+        )
+        raise error_class(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Product Service is currently unavailable. Please try again later. Error: {e}",
+        )
+    except Exception as e:
+        # Catch any other unexpected errors during deduction
+        logger.error(
+            f"Order Service: An unexpected error occurred during stock deduction for {target}: {e}",
+            exc_info=True,
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred during order creation: {e}",
+        )
+
+
+async def _rollback_stock_deductions(db: AsyncSession, items: List[OrderItemCreate]):
+    """
+    Queues compensations that give deducted stock back to the Product Service.
+    The queue lives in the order database and is drained by the compensation worker.
+    """
+    if not items:
+        return
+
+    logger.warning(
+        "Order Service: Queueing stock compensations due to order creation failure."
+    )
+    try:
+        queued = await enqueue_stock_compensations(db, items)
+        logger.info(f"Order Service: Queued {queued} stock compensations.")
+    except Exception as e:
+        await db.rollback()
+        for item in items:
+            logger.critical(
+                f"Order Service: Could not queue stock compensation for product {item.product_id} quantity {item.quantity}: {e}. Manual stock adjustment may be required in Product Service."
+            )
+
+
+def _order_query():
+    """
+    Orders with their items eager-loaded in one extra SELECT ... IN query, since
+    items cannot be lazy-loaded on an AsyncSession and the responses include them.
+    """
+    return select(Order).options(selectinload(Order.items))
+
+
+async def _get_order(db: AsyncSession, order_id: int) -> Optional[Order]:
+    return (
+        await db.execute(_order_query().where(Order.order_id == order_id))
+    ).scalar_one_or_none()
+
+
+def _order_summary_columns():
+    """
+    Columns of the include_items=false projection: the order row plus a correlated
+    item count, so no order item rows are read or sent.
+    """
+    item_count = (
+        select(func.count(OrderItem.order_item_id))
+        .where(OrderItem.order_id == Order.order_id)
+        .correlate(Order)
+        .scalar_subquery()
+    )
+    return [*Order.__table__.columns, item_count.label("item_count")]
 
 
 @app.get(
     "/orders/",
-    response_model=List[OrderResponse],
+    response_model=List[Union[OrderResponse, OrderSummaryResponse]],
     summary="Retrieve a list of all orders",
 )
-def list_orders(
-    db: Session = Depends(get_db),
+async def list_orders(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=100),
     user_id: Optional[int] = Query(None, ge=1, description="Filter orders by user ID."),
-    status: Optional[str] = Query(
+    order_status: Optional[str] = Query(
         None,
+        alias="status",
         max_length=50,
         description="Filter orders by status (e.g., pending, shipped).",
     ),
+    cursor: Optional[str] = Query(
+        None,
+        max_length=1024,
+        description="Opaque cursor from a previous page's X-Next-Cursor/Link header.",
+    ),
+    include_items: bool = Query(
+        True,
+        description="Include line items; false returns a lighter summary with an item_count.",
+    ),
 ):
-
+    """
+    Lists orders newest first, ordered by (order_date DESC, order_id DESC).
+    Pages can be fetched with skip/limit or with keyset cursors: when more rows may
+    follow, the response carries X-Next-Cursor and a Link rel="next" header.
+    Items of the whole page are loaded with one extra query; include_items=false
+    answers with a single query and no item rows.
+    """
     logger.info(
-        f"Order Service: Listing orders (skip={skip}, limit={limit}, user_id={user_id}, status='{status}')"
+        f"Order Service: Listing orders (skip={skip}, limit={limit}, user_id={user_id}, status='{order_status}', cursor={'yes' if cursor else 'no'}, include_items={include_items})"
     )
-    query = db.query(Order)
+    if cursor and skip:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either skip or cursor, not both.",
+        )
+
+    if include_items:
+        query = _order_query()
+    else:
+        query = select(*_order_summary_columns())
 
     if user_id:
-        query = query.filter(Order.user_id == user_id)
-    if status:
-        query = query.filter(Order.status == status)
+        query = query.where(Order.user_id == user_id)
+    if order_status:
+        query = query.where(Order.status == order_status)
+
+    if cursor:
+        try:
+            last_order_date, last_order_id = decode_cursor(
+                cursor, ORDER_LIST_SORT, (str, int)
+            )
+            last_order_date = datetime.fromisoformat(last_order_date)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Malformed cursor."
+            )
+        # Row-value comparison keeps a user's history page an index range scan
+        query = query.where(
+            tuple_(Order.order_date, Order.order_id)
+            < tuple_(last_order_date, last_order_id)
+        )
+
+    result = await db.execute(
+        query.order_by(Order.order_date.desc(), Order.order_id.desc())
+        .offset(skip)
+        .limit(limit)
+    )
+    if include_items:
+        orders = result.scalars().all()
+    else:
+        orders = [OrderSummaryResponse.model_validate(row) for row in result]
+
+    if len(orders) == limit:
+        last = orders[-1]
+        next_cursor = encode_cursor(
+            ORDER_LIST_SORT, [last.order_date.isoformat(), last.order_id]
+        )
+        next_url = request.url.remove_query_params("skip").include_query_params(
+            cursor=next_cursor
+        )
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
 
-    orders = query.offset(skip).limit(limit).all()
     logger.info(f"Order Service: Retrieved {len(orders)} orders.")
     return orders
 
@@ -296,9 +1077,9 @@ def list_orders(
     response_model=OrderResponse,
     summary="Retrieve a single order by ID",
 )
-def get_order(order_id: int, db: Session = Depends(get_db)):
+async def get_order(order_id: int, db: AsyncSession = Depends(get_db)):
     logger.info(f"Order Service: Fetching order with ID: {order_id}")
-    order = db.query(Order).filter(Order.order_id == order_id).first()
+    order = await _get_order(db, order_id)
     if not order:
         logger.warning(f"Order Service: Order with ID {order_id} not found.")
         raise HTTPException(
@@ -321,12 +1102,12 @@ async def update_order_status(
     new_status: str = Query(
         ..., min_length=1, max_length=50, description="New status for the order."
     ),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     logger.info(
         f"Order Service: Updating status for order {order_id} to '{new_status}'"
     )
-    db_order = db.query(Order).filter(Order.order_id == order_id).first()
+    db_order = await _get_order(db, order_id)
     if not db_order:
         logger.warning(
             f"Order Service: Order with ID {order_id} not found for status update."
@@ -335,18 +1116,31 @@ async def update_order_status(
             status_code=status.HTTP_404_NOT_FOUND, detail="Order not found"
         )
 
+    previous_status = db_order.status
     db_order.status = new_status
 
     try:
         db.add(db_order)
-        db.commit()
-        db.refresh(db_order)
+        await db.flush()
+        add_order_event(
+            db,
+            order_id,
+            ORDER_STATUS_CHANGED,
+            {
+                "order_id": order_id,
+                "status": new_status,
+                "previous_status": previous_status,
+            },
+        )
+        await db.commit()
+        # updated_at is set by the database; reload just that column
+        await db.refresh(db_order, attribute_names=["updated_at"])
         logger.info(
             f"Order Service: Order {order_id} status updated to '{new_status}'."
         )
         return db_order
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Order Service: Error updating status for order {order_id}: {e}",
             exc_info=True,
@@ -362,9 +1156,9 @@ async def update_order_status(
     status_code=status.HTTP_204_NO_CONTENT,
     summary="Delete an order by ID",
 )
-def delete_order(order_id: int, db: Session = Depends(get_db)):
+async def delete_order(order_id: int, db: AsyncSession = Depends(get_db)):
     logger.info(f"Order Service: Attempting to delete order with ID: {order_id}")
-    order = db.query(Order).filter(Order.order_id == order_id).first()
+    order = await _get_order(db, order_id)
     if not order:
         logger.warning(
             f"Order Service: Order with ID: {order_id} not found for deletion."
@@ -374,11 +1168,13 @@ def delete_order(order_id: int, db: Session = Depends(get_db)):
         )
 
     try:
-        db.delete(order)
-        db.commit()
+        await db.delete(order)
+        await db.flush()
+        add_order_event(db, order_id, ORDER_DELETED, {"order_id": order_id})
+        await db.commit()
         logger.info(f"Order Service: Order (ID: {order_id}) deleted successfully.")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Order Service: Error deleting order {order_id}: {e}", exc_info=True
         )
@@ -394,9 +1190,9 @@ def delete_order(order_id: int, db: Session = Depends(get_db)):
     response_model=List[OrderItemResponse],
     summary="Retrieve all items for a specific order",
 )
-def get_order_items(order_id: int, db: Session = Depends(get_db)):
+async def get_order_items(order_id: int, db: AsyncSession = Depends(get_db)):
     logger.info(f"Order Service: Fetching items for order ID: {order_id}")
-    order = db.query(Order).filter(Order.order_id == order_id).first()
+    order = await _get_order(db, order_id)
     if not order:
         logger.warning(
             f"Order Service: Order with ID {order_id} not found when fetching items."
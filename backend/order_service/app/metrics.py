@@ -0,0 +1,190 @@
+# week08/backend/order_service/app/metrics.py
+
+import re
+import time
+
+import httpx
+from fastapi import Request
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests by route template.",
+    ["method", "route", "status_code"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests currently being handled.", ["method"]
+)
+REQUEST_EXCEPTIONS = Counter(
+    "http_request_exceptions_total",
+    "Requests that ended in an unhandled exception.",
+    ["method", "route"],
+)
+
+PRODUCT_SERVICE_REQUEST_LATENCY = Histogram(
+    "product_service_request_duration_seconds",
+    "Latency of outbound calls to the Product Service.",
+    ["method", "endpoint", "status_code"],
+)
+PRODUCT_SERVICE_REQUEST_ERRORS = Counter(
+    "product_service_request_errors_total",
+    "Outbound Product Service calls that failed with a network error or a 5xx response.",
+    ["method", "endpoint", "error"],
+)
+PRODUCT_SERVICE_CIRCUIT_STATE = Gauge(
+    "product_service_circuit_state",
+    "Product Service circuit breaker state (1 for the current state).",
+    ["state"],
+)
+PRODUCT_SERVICE_CIRCUIT_REJECTIONS = Counter(
+    "product_service_circuit_rejections_total",
+    "Product Service calls rejected because the circuit breaker was open.",
+)
+PRODUCT_SERVICE_BULKHEAD_IN_FLIGHT = Gauge(
+    "product_service_bulkhead_in_flight",
+    "Product Service calls currently holding a bulkhead slot.",
+)
+PRODUCT_SERVICE_BULKHEAD_REJECTIONS = Counter(
+    "product_service_bulkhead_rejections_total",
+    "Product Service calls rejected because all bulkhead slots were busy.",
+)
+PRODUCT_SERVICE_HEDGED_REQUESTS = Counter(
+    "product_service_hedged_requests_total",
+    "Product Service requests sent a second time because the first was slow.",
+    ["method"],
+)
+PRODUCT_SERVICE_RETRIES = Counter(
+    "product_service_retries_total",
+    "Product Service requests retried after a network error or 5xx response.",
+    ["method"],
+)
+
+OUTBOX_EVENTS_PUBLISHED = Counter(
+    "order_outbox_events_published_total",
+    "Order events delivered from the outbox, by sink.",
+    ["sink"],
+)
+OUTBOX_PUBLISH_FAILURES = Counter(
+    "order_outbox_publish_failures_total",
+    "Outbox batches the sink failed to accept; they are retried.",
+    ["sink"],
+)
+
+
+def _route_template(request: Request) -> str:
+    # The matched route's path keeps label cardinality bounded (/products/{product_id})
+    route = request.scope.get("route")
+    return getattr(route, "path", "<unmatched>")
+
+
+async def track_request_metrics(request: Request, call_next):
+    """
+    HTTP middleware body recording latency per route template and in-flight requests.
+    """
+    method = request.method
+    REQUESTS_IN_PROGRESS.labels(method).inc()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        REQUEST_EXCEPTIONS.labels(method, _route_template(request)).inc()
+        raise
+    finally:
+        REQUESTS_IN_PROGRESS.labels(method).dec()
+    REQUEST_LATENCY.labels(
+        method, _route_template(request), str(response.status_code)
+    ).observe(time.perf_counter() - start)
+    return response
+
+
+class DatabasePoolCollector:
+    """
+    Reads the SQLAlchemy pool counters at scrape time, so no bookkeeping runs per checkout.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def collect(self):
+        pool = self.engine.pool
+        for name, documentation, value in (
+            ("db_pool_size", "Configured size of the DB pool.", pool.size()),
+            (
+                "db_pool_checked_out_connections",
+                "DB connections currently checked out of the pool.",
+                pool.checkedout(),
+            ),
+            (
+                "db_pool_checked_in_connections",
+                "Idle DB connections held in the pool.",
+                pool.checkedin(),
+            ),
+            (
+                "db_pool_overflow_connections",
+                "DB connections open beyond the pool size (negative while the pool is not yet full).",
+                pool.overflow(),
+            ),
+        ):
+            yield GaugeMetricFamily(name, documentation, value=value)
+        wait_stats = pool.wait_stats
+        yield CounterMetricFamily(
+            "db_pool_checkouts",
+            "DB connections checked out of the pool.",
+            value=wait_stats.checkouts,
+        )
+        yield CounterMetricFamily(
+            "db_pool_checkout_wait_seconds",
+            "Total time spent waiting to check out DB connections.",
+            value=wait_stats.total_wait_seconds,
+        )
+        yield CounterMetricFamily(
+            "db_pool_checkout_timeouts",
+            "Checkouts that gave up after the pool timeout.",
+            value=wait_stats.timeouts,
+        )
+
+
+def register_collectors(engine):
+    REGISTRY.register(DatabasePoolCollector(engine))
+
+
+def _product_service_endpoint(path: str) -> str:
+    # /products/42/deduct-stock -> /products/{product_id}/deduct-stock
+    return re.sub(r"/products/\d+", "/products/{product_id}", path)
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the Product Service client's transport to time every outbound call and
+    count network errors and 5xx responses, whichever code path made the call.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        method = request.method
+        endpoint = _product_service_endpoint(request.url.path)
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.TransportError as e:
+            PRODUCT_SERVICE_REQUEST_LATENCY.labels(method, endpoint, "error").observe(
+                time.perf_counter() - start
+            )
+            PRODUCT_SERVICE_REQUEST_ERRORS.labels(
+                method, endpoint, type(e).__name__
+            ).inc()
+            raise
+        PRODUCT_SERVICE_REQUEST_LATENCY.labels(
+            method, endpoint, str(response.status_code)
+        ).observe(time.perf_counter() - start)
+        if response.status_code >= 500:
+            PRODUCT_SERVICE_REQUEST_ERRORS.labels(
+                method, endpoint, f"http_{response.status_code}"
+            ).inc()
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
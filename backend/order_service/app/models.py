@@ -1,6 +1,18 @@
 # week08/backend/order_service/app/models.py
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, Numeric, String, Text
+from sqlalchemy import (
+    UUID,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    Numeric,
+    String,
+    Text,
+    false,
+)
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -20,10 +32,40 @@ class Order(Base):
     shipping_address = Column(Text, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    # Orders accepted with 202 wait here until a fulfillment worker deducts their stock
+    fulfillment_pending = Column(
+        Boolean, nullable=False, default=False, server_default=false()
+    )
+    fulfillment_attempts = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    next_fulfillment_at = Column(DateTime(timezone=True), nullable=True)
+    fulfillment_error = Column(Text, nullable=True)
 
-    # Define a relationship to OrderItem for easy access to order items from an Order object
+    # Define a relationship to OrderItem for easy access to order items from an Order object.
+    # lazy="raise": items must be loaded explicitly (selectinload), so a per-order
+    # lazy load (N+1 queries when serializing a list) fails loudly instead.
     items = relationship(
-        "OrderItem", back_populates="order", cascade="all, delete-orphan"
+        "OrderItem",
+        back_populates="order",
+        cascade="all, delete-orphan",
+        lazy="raise",
+    )
+
+    __table_args__ = (
+        # Serves a user's order history ordered by (order_date, order_id), in either direction
+        Index(
+            "ix_orders_week08_example_01_user_date_id",
+            "user_id",
+            "order_date",
+            "order_id",
+        ),
+        # Small partial index: only orders still waiting for fulfillment are in it
+        Index(
+            "ix_orders_week08_example_01_fulfillment_due",
+            "next_fulfillment_at",
+            postgresql_where=fulfillment_pending,
+        ),
     )
 
     def __repr__(self):
@@ -54,3 +96,98 @@ class OrderItem(Base):
 
     def __repr__(self):
         return f"<OrderItem(id={self.order_item_id}, order_id={self.order_id}, product_id={self.product_id}, qty={self.quantity})>"
+
+
+class StockCompensation(Base):
+    """
+    Durable retry queue of stock that must be given back to the Product Service
+    because an order failed after some of its stock was already deducted.
+    """
+
+    __tablename__ = "stock_compensations_week08_example_01"
+
+    compensation_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    product_id = Column(Integer, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    # pending -> completed, or failed when the Product Service rejects it permanently
+    status = Column(String(20), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    last_error = Column(Text, nullable=True)
+    # Sent with every restock attempt, so the Product Service applies it only once
+    idempotency_key = Column(
+        UUID(as_uuid=False), nullable=False, server_default=func.gen_random_uuid()
+    )
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    __table_args__ = (
+        Index(
+            "ix_stock_compensations_week08_example_01_due",
+            "status",
+            "next_attempt_at",
+        ),
+    )
+
+    def __repr__(self):
+        return f"<StockCompensation(id={self.compensation_id}, product_id={self.product_id}, qty={self.quantity}, status='{self.status}', attempts={self.attempts})>"
+
+
+class IdempotencyKey(Base):
+    """
+    Responses stored per client-supplied Idempotency-Key, so a retried request is
+    answered from here instead of being executed twice. Rows expire after a TTL.
+    """
+
+    __tablename__ = "idempotency_keys_week08_example_01"
+
+    # Endpoint the key was used on; the same key may be reused on other endpoints
+    scope = Column(String(50), primary_key=True)
+    idempotency_key = Column(String(255), primary_key=True)
+    # SHA-256 of the request, to reject a key reused with a different request
+    request_hash = Column(String(64), nullable=False)
+    # in_progress -> completed; in-progress rows are only visible while a request runs
+    status = Column(String(20), nullable=False, default="in_progress")
+    response_status_code = Column(Integer, nullable=True)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey(scope='{self.scope}', key='{self.idempotency_key}', status='{self.status}')>"
+
+
+class OrderOutboxEvent(Base):
+    """
+    Transactional outbox of order events. Rows are written in the same transaction as
+    the order change and published afterwards, in event_id order, by the outbox publisher.
+    """
+
+    __tablename__ = "order_outbox_week08_example_01"
+
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
+    # Not a foreign key: events about deleted orders must outlive the order
+    order_id = Column(Integer, nullable=False)
+    # order.created, order.status_changed or order.deleted
+    event_type = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False)  # JSON document
+    created_at = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    published_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Only unpublished events are indexed, so the publisher's scan stays small
+        Index(
+            "ix_order_outbox_week08_example_01_unpublished",
+            "event_id",
+            postgresql_where=published_at.is_(None),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<OrderOutboxEvent(id={self.event_id}, order_id={self.order_id}, type='{self.event_type}')>"
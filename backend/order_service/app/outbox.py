@@ -0,0 +1,230 @@
+# week08/backend/order_service/app/outbox.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Any, Dict, List
+
+import httpx
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import SessionLocal
+from .metrics import OUTBOX_EVENTS_PUBLISHED, OUTBOX_PUBLISH_FAILURES
+from .models import OrderOutboxEvent
+
+logger = logging.getLogger(__name__)
+
+# log, file or webhook
+OUTBOX_SINK = os.getenv("OUTBOX_SINK", "log").lower()
+OUTBOX_FILE_PATH = os.getenv("OUTBOX_FILE_PATH", "order_events.ndjson")
+OUTBOX_WEBHOOK_URL = os.getenv("OUTBOX_WEBHOOK_URL")
+OUTBOX_WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_WEBHOOK_TIMEOUT_SECONDS", "5"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "1"))
+OUTBOX_RETRY_INTERVAL_SECONDS = float(os.getenv("OUTBOX_RETRY_INTERVAL_SECONDS", "5"))
+# Published events are kept this long for inspection and replays, then deleted
+OUTBOX_RETENTION_SECONDS = int(os.getenv("OUTBOX_RETENTION_SECONDS", "604800"))
+OUTBOX_CLEANUP_INTERVAL_SECONDS = float(
+    os.getenv("OUTBOX_CLEANUP_INTERVAL_SECONDS", "3600")
+)
+# Only the replica holding this advisory lock publishes, which keeps events in order
+OUTBOX_PUBLISHER_LOCK_ID = 80801
+
+ORDER_CREATED = "order.created"
+ORDER_STATUS_CHANGED = "order.status_changed"
+ORDER_DELETED = "order.deleted"
+
+
+def add_order_event(
+    db: AsyncSession, order_id: int, event_type: str, payload: Dict[str, Any]
+):
+    """
+    Adds an event to the outbox in the caller's transaction, so it is stored if and
+    only if the order change it describes is committed. Callers flush the order change
+    first: the order row lock then serializes event IDs per order.
+    """
+    db.add(
+        OrderOutboxEvent(
+            order_id=order_id,
+            event_type=event_type,
+            payload=json.dumps(payload, default=str),
+        )
+    )
+
+
+def _event_message(event: OrderOutboxEvent) -> Dict[str, Any]:
+    # Consumers deduplicate redeliveries by event_id
+    return {
+        "event_id": event.event_id,
+        "event_type": event.event_type,
+        "order_id": event.order_id,
+        "occurred_at": event.created_at.isoformat(),
+        "data": json.loads(event.payload),
+    }
+
+
+class LogSink:
+    """Writes events to the service log; the default when no sink is configured."""
+
+    name = "log"
+
+    async def publish(self, messages: List[Dict[str, Any]]):
+        for message in messages:
+            logger.info(f"Order Service: Order event {json.dumps(message)}")
+
+    async def aclose(self):
+        pass
+
+
+class FileSink:
+    """Appends events as NDJSON lines to a local file, a stand-in for a queue."""
+
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _append(self, lines: str):
+        with open(self.path, "a", encoding="utf-8") as events_file:
+            events_file.write(lines)
+            events_file.flush()
+            os.fsync(events_file.fileno())
+
+    async def publish(self, messages: List[Dict[str, Any]]):
+        lines = "".join(json.dumps(message) + "\n" for message in messages)
+        await asyncio.to_thread(self._append, lines)
+
+    async def aclose(self):
+        pass
+
+
+class WebhookSink:
+    """POSTs each batch of events to a webhook as {"events": [...]}."""
+
+    name = "webhook"
+
+    def __init__(self, url: str, timeout_seconds: float):
+        self.url = url
+        self.client = httpx.AsyncClient(timeout=timeout_seconds)
+
+    async def publish(self, messages: List[Dict[str, Any]]):
+        response = await self.client.post(self.url, json={"events": messages})
+        response.raise_for_status()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def create_outbox_sink():
+    if OUTBOX_SINK == "webhook":
+        if not OUTBOX_WEBHOOK_URL:
+            raise ValueError("OUTBOX_WEBHOOK_URL must be set when OUTBOX_SINK=webhook.")
+        return WebhookSink(OUTBOX_WEBHOOK_URL, OUTBOX_WEBHOOK_TIMEOUT_SECONDS)
+    if OUTBOX_SINK == "file":
+        return FileSink(OUTBOX_FILE_PATH)
+    if OUTBOX_SINK != "log":
+        logger.warning(
+            f"Order Service: Unknown OUTBOX_SINK '{OUTBOX_SINK}'. Publishing order events to the log."
+        )
+    return LogSink()
+
+
+async def publish_outbox_batch(
+    db: AsyncSession, sink, batch_size: int = OUTBOX_BATCH_SIZE
+) -> int:
+    """
+    Publishes up to batch_size unpublished events, oldest first, in one sink call and
+    marks them published. Delivery is at least once: if the sink fails nothing is
+    marked and the same events are sent again, in the same order, on the next attempt.
+    Returns the number published, or 0 if another replica holds the publisher lock.
+    """
+    # Transaction-scoped, so the lock is released by the commit or rollback below
+    locked = (
+        await db.execute(
+            select(func.pg_try_advisory_xact_lock(OUTBOX_PUBLISHER_LOCK_ID))
+        )
+    ).scalar()
+    if not locked:
+        await db.rollback()
+        return 0
+
+    events = (
+        (
+            await db.execute(
+                select(OrderOutboxEvent)
+                .where(OrderOutboxEvent.published_at.is_(None))
+                .order_by(OrderOutboxEvent.event_id)
+                .limit(batch_size)
+            )
+        )
+        .scalars()
+        .all()
+    )
+    if not events:
+        await db.commit()
+        return 0
+
+    try:
+        await sink.publish([_event_message(event) for event in events])
+    except Exception:
+        await db.rollback()
+        OUTBOX_PUBLISH_FAILURES.labels(sink.name).inc()
+        raise
+
+    await db.execute(
+        update(OrderOutboxEvent)
+        .where(OrderOutboxEvent.event_id.in_([event.event_id for event in events]))
+        .values(published_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    OUTBOX_EVENTS_PUBLISHED.labels(sink.name).inc(len(events))
+    return len(events)
+
+
+async def delete_published_events(db: AsyncSession) -> int:
+    """Deletes published events older than OUTBOX_RETENTION_SECONDS and commits."""
+    result = await db.execute(
+        delete(OrderOutboxEvent).where(
+            OrderOutboxEvent.published_at
+            < func.now() - timedelta(seconds=OUTBOX_RETENTION_SECONDS)
+        )
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def run_outbox_publisher(sink):
+    """
+    Background task that keeps draining the outbox into sink until cancelled.
+    """
+    logger.info(f"Order Service: Outbox publisher started (sink: {sink.name}).")
+    next_cleanup = time.monotonic()
+    while True:
+        published = 0
+        delay = OUTBOX_POLL_INTERVAL_SECONDS
+        try:
+            async with SessionLocal() as db:
+                published = await publish_outbox_batch(db, sink)
+                if published == 0 and time.monotonic() >= next_cleanup:
+                    next_cleanup = time.monotonic() + OUTBOX_CLEANUP_INTERVAL_SECONDS
+                    deleted = await delete_published_events(db)
+                    if deleted:
+                        logger.info(
+                            f"Order Service: Deleted {deleted} published order events."
+                        )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            delay = OUTBOX_RETRY_INTERVAL_SECONDS
+            logger.error(
+                f"Order Service: Publishing order events failed, will retry: {e}",
+                exc_info=True,
+            )
+        # A full batch means more events are probably waiting, so publish again immediately
+        if published < OUTBOX_BATCH_SIZE:
+            await asyncio.sleep(delay)
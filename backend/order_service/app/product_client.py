@@ -0,0 +1,135 @@
+# week08/backend/order_service/app/product_client.py
+
+import importlib.util
+import logging
+import os
+
+import httpx
+from fastapi import Request
+
+from .metrics import InstrumentedTransport
+from .resilience import CircuitBreaker, ResilientTransport, RetryTransport
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", "http://localhost:8000")
+
+# Connection pool and timeout settings for calls to the Product Service
+PRODUCT_SERVICE_MAX_CONNECTIONS = int(
+    os.getenv("PRODUCT_SERVICE_MAX_CONNECTIONS", "100")
+)
+PRODUCT_SERVICE_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("PRODUCT_SERVICE_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+PRODUCT_SERVICE_KEEPALIVE_EXPIRY_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_KEEPALIVE_EXPIRY_SECONDS", "30")
+)
+PRODUCT_SERVICE_TIMEOUT_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_TIMEOUT_SECONDS", "5")
+)
+PRODUCT_SERVICE_CONNECT_TIMEOUT_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_CONNECT_TIMEOUT_SECONDS", "2")
+)
+PRODUCT_SERVICE_HTTP2 = os.getenv("PRODUCT_SERVICE_HTTP2", "true").lower() == "true"
+
+# Bulkhead: calls in flight at once, and how long a call may wait for a free slot
+PRODUCT_SERVICE_MAX_CONCURRENT_CALLS = int(
+    os.getenv("PRODUCT_SERVICE_MAX_CONCURRENT_CALLS", "50")
+)
+PRODUCT_SERVICE_BULKHEAD_WAIT_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_BULKHEAD_WAIT_SECONDS", "0.1")
+)
+# Circuit breaker over the last WINDOW_SIZE calls (see resilience.CircuitBreaker)
+PRODUCT_SERVICE_BREAKER_WINDOW_SIZE = int(
+    os.getenv("PRODUCT_SERVICE_BREAKER_WINDOW_SIZE", "20")
+)
+PRODUCT_SERVICE_BREAKER_MINIMUM_CALLS = int(
+    os.getenv("PRODUCT_SERVICE_BREAKER_MINIMUM_CALLS", "10")
+)
+PRODUCT_SERVICE_BREAKER_FAILURE_RATE = float(
+    os.getenv("PRODUCT_SERVICE_BREAKER_FAILURE_RATE", "0.5")
+)
+PRODUCT_SERVICE_BREAKER_SLOW_CALL_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_BREAKER_SLOW_CALL_SECONDS", "2")
+)
+PRODUCT_SERVICE_BREAKER_SLOW_CALL_RATE = float(
+    os.getenv("PRODUCT_SERVICE_BREAKER_SLOW_CALL_RATE", "0.8")
+)
+PRODUCT_SERVICE_BREAKER_OPEN_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_BREAKER_OPEN_SECONDS", "30")
+)
+PRODUCT_SERVICE_BREAKER_HALF_OPEN_CALLS = int(
+    os.getenv("PRODUCT_SERVICE_BREAKER_HALF_OPEN_CALLS", "3")
+)
+# Retries of idempotent calls after network errors or 5xx, with jittered backoff
+PRODUCT_SERVICE_MAX_RETRIES = int(os.getenv("PRODUCT_SERVICE_MAX_RETRIES", "2"))
+PRODUCT_SERVICE_RETRY_BASE_BACKOFF_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_RETRY_BASE_BACKOFF_SECONDS", "0.1")
+)
+PRODUCT_SERVICE_RETRY_MAX_BACKOFF_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_RETRY_MAX_BACKOFF_SECONDS", "1")
+)
+# An idempotent call still unanswered after this long is sent again; 0 disables hedging
+PRODUCT_SERVICE_HEDGE_DELAY_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_HEDGE_DELAY_SECONDS", "0.5")
+)
+
+# HTTP/2 needs the optional 'h2' package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def create_product_client() -> httpx.AsyncClient:
+    """
+    Creates the long-lived, connection-pooled client used for all Product Service calls.
+    """
+    http2 = PRODUCT_SERVICE_HTTP2 and HTTP2_AVAILABLE
+    if PRODUCT_SERVICE_HTTP2 and not HTTP2_AVAILABLE:
+        logger.info(
+            "Order Service: HTTP/2 requested but the 'h2' package is not installed. Using HTTP/1.1."
+        )
+    limits = httpx.Limits(
+        max_connections=PRODUCT_SERVICE_MAX_CONNECTIONS,
+        max_keepalive_connections=PRODUCT_SERVICE_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=PRODUCT_SERVICE_KEEPALIVE_EXPIRY_SECONDS,
+    )
+    timeout = httpx.Timeout(
+        PRODUCT_SERVICE_TIMEOUT_SECONDS, connect=PRODUCT_SERVICE_CONNECT_TIMEOUT_SECONDS
+    )
+    logger.info(
+        f"Order Service: Creating pooled Product Service client (max_connections={limits.max_connections}, max_keepalive={limits.max_keepalive_connections}, keepalive_expiry={limits.keepalive_expiry}s, http2={http2})."
+    )
+    breaker = CircuitBreaker(
+        window_size=PRODUCT_SERVICE_BREAKER_WINDOW_SIZE,
+        minimum_calls=PRODUCT_SERVICE_BREAKER_MINIMUM_CALLS,
+        failure_rate_threshold=PRODUCT_SERVICE_BREAKER_FAILURE_RATE,
+        slow_call_seconds=PRODUCT_SERVICE_BREAKER_SLOW_CALL_SECONDS,
+        slow_call_rate_threshold=PRODUCT_SERVICE_BREAKER_SLOW_CALL_RATE,
+        open_seconds=PRODUCT_SERVICE_BREAKER_OPEN_SECONDS,
+        half_open_max_calls=PRODUCT_SERVICE_BREAKER_HALF_OPEN_CALLS,
+    )
+    # Pool limits and HTTP/2 live on the inner transport once a transport is passed.
+    # Rejected calls never reach the instrumented transport, so its latency and error
+    # metrics only cover calls that were actually made. Retries and hedges sit outside
+    # the breaker and bulkhead, so each attempt counts against both.
+    transport = RetryTransport(
+        ResilientTransport(
+            InstrumentedTransport(httpx.AsyncHTTPTransport(limits=limits, http2=http2)),
+            breaker,
+            max_concurrent_calls=PRODUCT_SERVICE_MAX_CONCURRENT_CALLS,
+            bulkhead_wait_seconds=PRODUCT_SERVICE_BULKHEAD_WAIT_SECONDS,
+        ),
+        max_retries=PRODUCT_SERVICE_MAX_RETRIES,
+        base_backoff_seconds=PRODUCT_SERVICE_RETRY_BASE_BACKOFF_SECONDS,
+        max_backoff_seconds=PRODUCT_SERVICE_RETRY_MAX_BACKOFF_SECONDS,
+        hedge_delay_seconds=PRODUCT_SERVICE_HEDGE_DELAY_SECONDS,
+    )
+    return httpx.AsyncClient(
+        base_url=PRODUCT_SERVICE_URL, timeout=timeout, transport=transport
+    )
+
+
+def get_product_client(request: Request) -> httpx.AsyncClient:
+    """
+    FastAPI dependency returning the application-wide Product Service client.
+    """
+    return request.app.state.product_client
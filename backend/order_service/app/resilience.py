@@ -0,0 +1,366 @@
+# week08/backend/order_service/app/resilience.py
+
+import asyncio
+import logging
+import math
+import random
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import httpx
+
+from .deadline import REQUEST_DEADLINE_HEADER, remaining_seconds
+from .idempotency import IDEMPOTENCY_KEY_HEADER
+from .metrics import (
+    PRODUCT_SERVICE_BULKHEAD_IN_FLIGHT,
+    PRODUCT_SERVICE_BULKHEAD_REJECTIONS,
+    PRODUCT_SERVICE_CIRCUIT_REJECTIONS,
+    PRODUCT_SERVICE_CIRCUIT_STATE,
+    PRODUCT_SERVICE_HEDGED_REQUESTS,
+    PRODUCT_SERVICE_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProductServiceUnavailable(httpx.TransportError):
+    """
+    Raised without calling the Product Service. Being an httpx.RequestError, it is
+    handled like any other network error: 503 for requests, a later retry for workers.
+    """
+
+    def __init__(self, message: str, request: httpx.Request, retry_after_seconds: int):
+        super().__init__(message, request=request)
+        self.retry_after_seconds = retry_after_seconds
+
+
+class CircuitOpenError(ProductServiceUnavailable):
+    """The circuit breaker is open: recent calls failed or were too slow."""
+
+
+class BulkheadFullError(ProductServiceUnavailable):
+    """The maximum number of concurrent Product Service calls is already in flight."""
+
+
+class DeadlineExceededError(httpx.TimeoutException):
+    """The request's deadline passed before the Product Service answered."""
+
+
+class CircuitBreaker:
+    """
+    Closed: calls pass and their outcomes fill a window of the last window_size calls.
+    Once minimum_calls are recorded, the circuit opens when the share of failed calls
+    (network errors and 5xx) or of calls slower than slow_call_seconds reaches its
+    threshold. Open: calls are rejected for open_seconds. Half-open: up to
+    half_open_max_calls trial calls pass; all succeeding closes the circuit, any
+    failure opens it again.
+    """
+
+    def __init__(
+        self,
+        window_size: int,
+        minimum_calls: int,
+        failure_rate_threshold: float,
+        slow_call_seconds: float,
+        slow_call_rate_threshold: float,
+        open_seconds: float,
+        half_open_max_calls: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.clock = clock
+        self._outcomes = deque(maxlen=window_size)  # (failed, slow) per call
+        self._opened_at = 0.0
+        self._trial_calls = 0
+        self._trial_successes = 0
+        # Outcomes of calls admitted before the last state change are ignored
+        self._generation = 0
+        self.state = CLOSED
+        self._publish_state()
+
+    def _publish_state(self):
+        for state in (CLOSED, OPEN, HALF_OPEN):
+            PRODUCT_SERVICE_CIRCUIT_STATE.labels(state).set(
+                1 if state == self.state else 0
+            )
+
+    def _transition(self, state: str, reason: str = ""):
+        logger.warning(
+            f"Order Service: Product Service circuit breaker {self.state} -> {state}{reason}."
+        )
+        self.state = state
+        self._generation += 1
+        self._outcomes.clear()
+        self._trial_calls = 0
+        self._trial_successes = 0
+        if state == OPEN:
+            self._opened_at = self.clock()
+        self._publish_state()
+
+    def retry_after_seconds(self) -> int:
+        remaining = self.open_seconds - (self.clock() - self._opened_at)
+        return max(1, math.ceil(remaining))
+
+    def before_call(self) -> Optional[int]:
+        """
+        Returns None if the call must be rejected. Otherwise returns the generation to
+        pass to record() or abandon() when the call ends.
+        """
+        if self.state == OPEN:
+            if self.clock() - self._opened_at < self.open_seconds:
+                return None
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trial_calls >= self.half_open_max_calls:
+                return None
+            self._trial_calls += 1
+        return self._generation
+
+    def record(self, generation: int, failed: bool, duration_seconds: float):
+        if generation != self._generation:
+            return
+        slow = duration_seconds >= self.slow_call_seconds
+        if self.state == HALF_OPEN:
+            if failed or slow:
+                self._transition(OPEN, " (trial call failed)")
+                return
+            self._trial_successes += 1
+            if self._trial_successes >= self.half_open_max_calls:
+                self._transition(CLOSED)
+            return
+
+        self._outcomes.append((failed, slow))
+        if len(self._outcomes) < self.minimum_calls:
+            return
+        calls = len(self._outcomes)
+        failure_rate = sum(failed for failed, _ in self._outcomes) / calls
+        slow_rate = sum(slow for _, slow in self._outcomes) / calls
+        if failure_rate >= self.failure_rate_threshold:
+            self._transition(OPEN, f" ({failure_rate:.0%} of {calls} calls failed)")
+        elif slow_rate >= self.slow_call_rate_threshold:
+            self._transition(
+                OPEN,
+                f" ({slow_rate:.0%} of {calls} calls took over {self.slow_call_seconds}s)",
+            )
+
+    def abandon(self, generation: int):
+        """Ends a call that was cancelled, freeing its trial slot without an outcome."""
+        if generation == self._generation and self.state == HALF_OPEN:
+            self._trial_calls -= 1
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the Product Service client's transport with a bulkhead (at most
+    max_concurrent_calls in flight, waiting at most bulkhead_wait_seconds for a slot)
+    and a circuit breaker. Rejected calls fail fast instead of waiting for timeouts.
+    """
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        breaker: CircuitBreaker,
+        max_concurrent_calls: int,
+        bulkhead_wait_seconds: float,
+    ):
+        self.transport = transport
+        self.breaker = breaker
+        self.bulkhead_wait_seconds = bulkhead_wait_seconds
+        self._bulkhead = asyncio.Semaphore(max_concurrent_calls)
+
+    async def _enter_bulkhead(self, request: httpx.Request):
+        try:
+            if self._bulkhead.locked():
+                await asyncio.wait_for(
+                    self._bulkhead.acquire(), self.bulkhead_wait_seconds
+                )
+            else:
+                await self._bulkhead.acquire()
+        except asyncio.TimeoutError:
+            PRODUCT_SERVICE_BULKHEAD_REJECTIONS.inc()
+            raise BulkheadFullError(
+                "Too many concurrent Product Service calls.",
+                request=request,
+                retry_after_seconds=1,
+            )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._enter_bulkhead(request)
+        PRODUCT_SERVICE_BULKHEAD_IN_FLIGHT.inc()
+        try:
+            generation = self.breaker.before_call()
+            if generation is None:
+                PRODUCT_SERVICE_CIRCUIT_REJECTIONS.inc()
+                raise CircuitOpenError(
+                    "Product Service circuit breaker is open.",
+                    request=request,
+                    retry_after_seconds=self.breaker.retry_after_seconds(),
+                )
+            start = time.perf_counter()
+            try:
+                response = await self.transport.handle_async_request(request)
+            except Exception:
+                self.breaker.record(generation, True, time.perf_counter() - start)
+                raise
+            except BaseException:
+                self.breaker.abandon(generation)
+                raise
+            self.breaker.record(
+                generation,
+                response.status_code >= 500,
+                time.perf_counter() - start,
+            )
+            return response
+        finally:
+            PRODUCT_SERVICE_BULKHEAD_IN_FLIGHT.dec()
+            self._bulkhead.release()
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Outermost Product Service transport. Every attempt is bounded by the current
+    request's deadline, which is also sent along in the X-Request-Deadline-Ms header.
+    Requests that are safe to repeat (GET/HEAD, or carrying an Idempotency-Key) are
+    retried with jittered exponential backoff after network errors or 5xx responses.
+    Reads are also hedged, i.e. sent a second time if the first attempt has not
+    answered after hedge_delay_seconds; keyed writes are not, since the duplicate
+    would race the first one and be refused with 409 while it is still in progress.
+    Calls rejected by the breaker or bulkhead are not retried.
+    """
+
+    SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        max_retries: int,
+        base_backoff_seconds: float,
+        max_backoff_seconds: float,
+        hedge_delay_seconds: float,
+    ):
+        self.transport = transport
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.hedge_delay_seconds = hedge_delay_seconds
+
+    def _can_repeat(self, request: httpx.Request) -> bool:
+        return (
+            request.method in self.SAFE_METHODS
+            or IDEMPOTENCY_KEY_HEADER in request.headers
+        )
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        remaining = remaining_seconds()
+        if remaining is None:
+            return await self.transport.handle_async_request(request)
+        if remaining <= 0:
+            raise DeadlineExceededError(
+                "Request deadline passed before calling the Product Service.",
+                request=request,
+            )
+        request.headers[REQUEST_DEADLINE_HEADER] = str(int(remaining * 1000))
+        # Cap the client's per-call timeouts at the time the request has left
+        timeouts = request.extensions.get(
+            "timeout", dict.fromkeys(("connect", "read", "write", "pool"))
+        )
+        request.extensions["timeout"] = {
+            name: remaining if timeout is None else min(timeout, remaining)
+            for name, timeout in timeouts.items()
+        }
+        try:
+            return await self.transport.handle_async_request(request)
+        except httpx.TimeoutException as e:
+            if remaining_seconds() <= 0:
+                raise DeadlineExceededError(
+                    f"Request deadline passed while waiting for the Product Service: {e}",
+                    request=request,
+                )
+            raise
+
+    async def _send_hedged(self, request: httpx.Request) -> httpx.Response:
+        first = asyncio.ensure_future(self._send(request))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay_seconds)
+        remaining = remaining_seconds()
+        if done or (remaining is not None and remaining <= 0):
+            return await first
+
+        PRODUCT_SERVICE_HEDGED_REQUESTS.labels(request.method).inc()
+        pending = {first, asyncio.ensure_future(self._send(request))}
+        finished = []
+        try:
+            # The first usable answer wins; if both attempts fail, the last failure is kept
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                finished.extend(done)
+                if any(self._usable(attempt) for attempt in done):
+                    break
+        finally:
+            for attempt in pending:
+                attempt.cancel()
+
+        winner = next(
+            (attempt for attempt in finished if self._usable(attempt)), finished[-1]
+        )
+        for attempt in finished:
+            if attempt is not winner and attempt.exception() is None:
+                await attempt.result().aclose()
+        return winner.result()
+
+    @staticmethod
+    def _usable(attempt: asyncio.Future) -> bool:
+        return attempt.exception() is None and attempt.result().status_code < 500
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not self._can_repeat(request):
+            return await self._send(request)
+
+        for retry in range(self.max_retries + 1):
+            error, response = None, None
+            try:
+                if self.hedge_delay_seconds > 0 and request.method in self.SAFE_METHODS:
+                    response = await self._send_hedged(request)
+                else:
+                    response = await self._send(request)
+            except (ProductServiceUnavailable, DeadlineExceededError):
+                raise
+            except httpx.TransportError as e:
+                error = e
+            if response is not None and response.status_code < 500:
+                return response
+
+            # Full jitter keeps retries from many callers from arriving in lockstep
+            backoff = random.uniform(
+                0, min(self.max_backoff_seconds, self.base_backoff_seconds * 2**retry)
+            )
+            remaining = remaining_seconds()
+            if retry == self.max_retries or (
+                remaining is not None and backoff >= remaining
+            ):
+                break
+            if response is not None:
+                await response.aclose()
+            PRODUCT_SERVICE_RETRIES.labels(request.method).inc()
+            await asyncio.sleep(backoff)
+
+        if error is not None:
+            raise error
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -57,6 +57,22 @@ class OrderResponse(OrderBase):
     total_amount: float
     created_at: datetime
     updated_at: Optional[datetime] = None
+    # Why stock could not be deducted for an order accepted asynchronously
+    fulfillment_error: Optional[str] = None
     items: List[OrderItemResponse] = []  # Nested items for detailed order response
 
     model_config = ConfigDict(from_attributes=True)  # Enable ORM mode for Pydantic V2
+
+
+class OrderSummaryResponse(OrderBase):
+    """Order without its line items, returned by GET /orders/?include_items=false."""
+
+    order_id: int
+    order_date: datetime
+    total_amount: float
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    fulfillment_error: Optional[str] = None
+    item_count: int
+
+    model_config = ConfigDict(from_attributes=True)
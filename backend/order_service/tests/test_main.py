@@ -1,18 +1,54 @@
 # week08/backend/order_service/tests/test_main.py
 
+import asyncio
+import json
 import logging
 import time
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from unittest.mock import AsyncMock, patch
 
+import httpx
 import pytest
 
-from app.db import SessionLocal, engine, get_db
-from app.main import PRODUCT_SERVICE_URL, app
-from app.models import Base, Order, OrderItem
+from app.compensation import process_compensation_batch
+from app.db import ASYNC_DATABASE_URL, DATABASE_URL
+from app.deadline import start_deadline
+from app.fulfillment import process_order_fulfillment_batch
+from app.idempotency import delete_expired_idempotency_keys
+from app.main import _deduct_stock, _rollback_stock_deductions, app
+from app.metrics import InstrumentedTransport
+from app.models import (
+    Base,
+    IdempotencyKey,
+    Order,
+    OrderItem,
+    OrderOutboxEvent,
+    StockCompensation,
+)
+from app.outbox import FileSink, publish_outbox_batch
+from app.pagination import encode_cursor
+from app.product_client import (
+    PRODUCT_SERVICE_CONNECT_TIMEOUT_SECONDS,
+    PRODUCT_SERVICE_URL,
+    get_product_client,
+)
+from app.resilience import (
+    BulkheadFullError,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+    ResilientTransport,
+    RetryTransport,
+)
+from app.schemas import OrderItemCreate
 from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool
 
 # Suppress noisy logs from SQLAlchemy/FastAPI/Uvicorn during tests for cleaner output
 logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
@@ -21,6 +57,25 @@ logging.getLogger("uvicorn.error").setLevel(logging.WARNING)
 logging.getLogger("fastapi").setLevel(logging.WARNING)
 logging.getLogger("app.main").setLevel(logging.WARNING)  # Suppress app's own info logs
 
+# The app talks to Postgres through its async engine; tests set up and inspect the
+# database through a plain synchronous engine on the same database.
+engine = create_engine(DATABASE_URL)
+TestSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Helpers taking an AsyncSession run under asyncio.run with their own event loop,
+# so they get unpooled connections instead of sharing the app's pool.
+AsyncTestSessionLocal = async_sessionmaker(
+    bind=create_async_engine(ASYNC_DATABASE_URL, poolclass=NullPool),
+    expire_on_commit=False,
+)
+
+
+def run_with_async_session(func, *args):
+    async def runner():
+        async with AsyncTestSessionLocal() as db:
+            return await func(db, *args)
+
+    return asyncio.run(runner())
+
 
 @pytest.fixture(scope="session", autouse=True)
 def setup_database_for_tests():
@@ -63,38 +118,59 @@ def setup_database_for_tests():
 
 @pytest.fixture(scope="function")
 def db_session_for_test():
-    connection = engine.connect()
-    transaction = connection.begin()
-    db = SessionLocal(bind=connection)
-
-    def override_get_db():
-        yield db
-
-    app.dependency_overrides[get_db] = override_get_db
-
+    db = TestSessionLocal()
     try:
         yield db
     finally:
-        transaction.rollback()
         db.close()
-        connection.close()
-        app.dependency_overrides.pop(get_db, None)
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clean_database():
+    # Requests commit through the app's own sessions, so each test starts from empty
+    # tables instead of rolling back a wrapping transaction
+    yield
+    table_names = ", ".join(table.name for table in Base.metadata.sorted_tables)
+    with engine.begin() as connection:
+        connection.execute(text(f"TRUNCATE TABLE {table_names}"))
 
 
 @pytest.fixture(scope="module")
 def client():
-    with TestClient(app) as test_client:
+    # Orders accepted with 202 are fulfilled and order events published explicitly by
+    # the tests, not by background workers
+    with patch("app.main.ORDER_FULFILLMENT_WORKERS", 0), patch(
+        "app.main.OUTBOX_PUBLISHER_ENABLED", False
+    ), TestClient(app) as test_client:
         yield test_client
 
 
 @pytest.fixture(scope="function")
 def mock_httpx_client():
-    with patch("app.main.httpx.AsyncClient") as mock_async_client_cls:
-        mock_client_instance = AsyncMock()
-        mock_async_client_cls.return_value.__aenter__.return_value = (
-            mock_client_instance
-        )
+    mock_client_instance = AsyncMock()
+    app.dependency_overrides[get_product_client] = lambda: mock_client_instance
+    try:
         yield mock_client_instance
+    finally:
+        app.dependency_overrides.pop(get_product_client, None)
+
+
+@pytest.fixture(scope="function")
+def assert_max_queries():
+    """
+    Returns a checker that fails when a response ran more SQL statements than allowed,
+    using the X-DB-Queries header the app sets on every response.
+    """
+
+    def check(response, max_queries: int):
+        queries = int(response.headers["X-DB-Queries"])
+        assert queries <= max_queries, (
+            f"{response.request.method} {response.request.url.path} ran {queries} "
+            f"SQL statements, expected at most {max_queries}"
+        )
+        return queries
+
+    return check
 
 
 def test_read_root(client: TestClient):
@@ -109,3 +185,1041 @@ def test_health_check(client: TestClient):
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok", "service": "order-service"}
+
+
+def test_create_order_success(
+    client: TestClient, db_session_for_test: Session, mock_httpx_client: AsyncMock
+):
+    """
+    Tests that an order is created with a single batch stock deduction call.
+    """
+    deduct_url = "/products/deduct-stock:batch"
+    mock_httpx_client.request.return_value = httpx.Response(
+        200,
+        json=[],
+        request=httpx.Request("POST", f"http://product-service{deduct_url}"),
+    )
+    order_data = {
+        "user_id": 1,
+        "shipping_address": "1 Test Street",
+        "items": [
+            {"product_id": 1, "quantity": 2, "price_at_purchase": 10.0},
+            {"product_id": 2, "quantity": 1, "price_at_purchase": 5.5},
+        ],
+    }
+
+    response = client.post("/orders/", json=order_data)
+
+    assert response.status_code == 201
+    response_data = response.json()
+    assert response_data["status"] == "confirmed"
+    assert response_data["total_amount"] == 25.5
+    assert len(response_data["items"]) == 2
+
+    mock_httpx_client.request.assert_awaited_once()
+    call = mock_httpx_client.request.await_args
+    assert call.args == ("POST", deduct_url)
+    assert call.kwargs["json"] == {
+        "items": [
+            {"product_id": 1, "quantity_to_deduct": 2},
+            {"product_id": 2, "quantity_to_deduct": 1},
+        ]
+    }
+
+    db_order = (
+        db_session_for_test.query(Order)
+        .filter(Order.order_id == response_data["order_id"])
+        .first()
+    )
+    assert db_order is not None
+    assert db_order.total_amount == Decimal("25.50")
+
+
+def test_create_order_insufficient_stock(
+    client: TestClient, db_session_for_test: Session, mock_httpx_client: AsyncMock
+):
+    """
+    Tests that a rejected stock deduction returns 400 and no order is stored.
+    """
+    deduct_url = "/products/deduct-stock:batch"
+    mock_httpx_client.request.return_value = httpx.Response(
+        400,
+        json={"detail": "Insufficient stock for product 'Widget'. Only 1 available."},
+        request=httpx.Request("POST", f"http://product-service{deduct_url}"),
+    )
+    order_data = {
+        "user_id": 2,
+        "items": [{"product_id": 1, "quantity": 5, "price_at_purchase": 10.0}],
+    }
+
+    response = client.post("/orders/", json=order_data)
+
+    assert response.status_code == 400
+    assert "Only 1 available" in response.json()["detail"]
+    assert db_session_for_test.query(Order).filter(Order.user_id == 2).count() == 0
+
+
+def test_create_order_with_idempotency_key_runs_once(
+    client: TestClient, db_session_for_test: Session, mock_httpx_client: AsyncMock
+):
+    """
+    Tests that a retried order with the same Idempotency-Key is answered from the stored
+    response without deducting stock again, and that failed attempts release the key.
+    """
+    deduct_url = "/products/deduct-stock:batch"
+    ok = httpx.Response(
+        200,
+        json=[],
+        request=httpx.Request("POST", f"http://product-service{deduct_url}"),
+    )
+    insufficient = httpx.Response(
+        400,
+        json={"detail": "Insufficient stock"},
+        request=httpx.Request("POST", f"http://product-service{deduct_url}"),
+    )
+    order_data = {
+        "user_id": 7,
+        "items": [{"product_id": 1, "quantity": 2, "price_at_purchase": 10.0}],
+    }
+    headers = {"Idempotency-Key": "order-abc"}
+
+    mock_httpx_client.request.return_value = insufficient
+    failed = client.post("/orders/", json=order_data, headers=headers)
+    assert failed.status_code == 400
+
+    mock_httpx_client.request.return_value = ok
+    first = client.post("/orders/", json=order_data, headers=headers)
+    retry = client.post("/orders/", json=order_data, headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert (
+        mock_httpx_client.request.await_count == 2
+    )  # The failed attempt and the first
+    assert db_session_for_test.query(Order).count() == 1
+
+    mismatch = client.post(
+        "/orders/", json={**order_data, "user_id": 8}, headers=headers
+    )
+    assert mismatch.status_code == 422
+    assert mock_httpx_client.request.await_count == 2
+
+    db_session_for_test.query(IdempotencyKey).update(
+        {IdempotencyKey.expires_at: datetime.now(timezone.utc) - timedelta(seconds=1)}
+    )
+    db_session_for_test.commit()
+    assert run_with_async_session(delete_expired_idempotency_keys) == 1
+    assert db_session_for_test.query(IdempotencyKey).count() == 0
+
+
+def test_async_order_intake_and_fulfillment(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that "Prefer: respond-async" stores the order as pending and returns 202,
+    and that the fulfillment batch confirms, fails or reschedules pending orders.
+    Network errors and 5xx answers from the Product Service both reschedule.
+    """
+    deduct_url = "/products/deduct-stock:batch"
+
+    def product_service(method, url, json, headers):
+        request = httpx.Request(method, f"http://product-service{url}")
+        product_id = json["items"][0]["product_id"]
+        if product_id == 3:
+            raise httpx.ConnectError("Connection refused", request=request)
+        if product_id == 4:
+            return httpx.Response(503, json={"detail": "Busy"}, request=request)
+        if product_id == 2:
+            return httpx.Response(
+                400, json={"detail": "Insufficient stock"}, request=request
+            )
+        return httpx.Response(200, json=[], request=request)
+
+    product_client = AsyncMock()
+    product_client.request.side_effect = product_service
+
+    order_ids = []
+    for product_id in (1, 2, 3, 4):
+        response = client.post(
+            "/orders/",
+            json={
+                "user_id": 5,
+                "items": [
+                    {"product_id": product_id, "quantity": 1, "price_at_purchase": 4.0}
+                ],
+            },
+            headers={"Prefer": "respond-async"},
+        )
+        assert response.status_code == 202
+        assert response.json()["status"] == "pending"
+        assert response.headers["Location"] == f"/orders/{response.json()['order_id']}"
+        order_ids.append(response.json()["order_id"])
+    assert client.get(f"/orders/{order_ids[0]}").json()["status"] == "pending"
+
+    processed = run_with_async_session(
+        process_order_fulfillment_batch, product_client, _deduct_stock
+    )
+    assert processed == 4
+    for order_id, call in zip(order_ids, product_client.request.await_args_list):
+        assert call.args == ("POST", deduct_url)
+        assert call.kwargs["headers"] == {"Idempotency-Key": f"order-{order_id}"}
+
+    confirmed, failed, retrying, retrying_after_5xx = (
+        client.get(f"/orders/{order_id}").json() for order_id in order_ids
+    )
+    assert confirmed["status"] == "confirmed"
+    assert failed["status"] == "failed"
+    assert "Insufficient stock" in failed["fulfillment_error"]
+    assert retrying["status"] == "pending"
+    assert "unavailable" in retrying["fulfillment_error"]
+    assert retrying_after_5xx["status"] == "pending"
+    assert "Status: 503" in retrying_after_5xx["fulfillment_error"]
+
+    # The unavailable order is retried later, not claimed again right away
+    assert (
+        run_with_async_session(
+            process_order_fulfillment_batch, product_client, _deduct_stock
+        )
+        == 0
+    )
+    for order_id in order_ids[2:]:
+        db_order = db_session_for_test.get(Order, order_id)
+        assert db_order.fulfillment_pending is True
+        assert db_order.fulfillment_attempts == 1
+        assert db_order.next_fulfillment_at > datetime.now(timezone.utc)
+
+
+def test_fulfillment_gives_stock_back_only_for_orders_that_went_away(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that a worker whose order was confirmed by another worker meanwhile (after
+    its lease ran out) does not give the stock back, while stock deducted for an order
+    deleted during fulfillment is queued for compensation.
+    """
+    order_ids = [
+        client.post(
+            "/orders/",
+            json={
+                "user_id": 6,
+                "items": [
+                    {"product_id": product_id, "quantity": 1, "price_at_purchase": 2.0}
+                ],
+            },
+            headers={"Prefer": "respond-async"},
+        ).json()["order_id"]
+        for product_id in (41, 42)
+    ]
+    confirmed_elsewhere, deleted = order_ids
+
+    async def deduct_stock(product_client, db, items, idempotency_key, **options):
+        order_id = int(idempotency_key.removeprefix("order-"))
+        with engine.begin() as connection:
+            if order_id == confirmed_elsewhere:
+                connection.execute(
+                    text(
+                        f"UPDATE {Order.__tablename__} SET status = 'confirmed', "
+                        "fulfillment_pending = false WHERE order_id = :id"
+                    ),
+                    {"id": order_id},
+                )
+            else:
+                connection.execute(
+                    text(f"DELETE FROM {OrderItem.__tablename__} WHERE order_id = :id"),
+                    {"id": order_id},
+                )
+                connection.execute(
+                    text(f"DELETE FROM {Order.__tablename__} WHERE order_id = :id"),
+                    {"id": order_id},
+                )
+
+    processed = run_with_async_session(
+        process_order_fulfillment_batch, AsyncMock(), deduct_stock
+    )
+    assert processed == 2
+    assert db_session_for_test.get(Order, confirmed_elsewhere).status == "confirmed"
+    compensations = db_session_for_test.query(StockCompensation).all()
+    assert [(c.product_id, c.quantity) for c in compensations] == [(42, 1)]
+
+
+def test_fulfillment_retries_conflicts_and_settles_its_last_attempt(
+    client: TestClient, db_session_for_test: Session, monkeypatch
+):
+    """
+    Tests that 409 and 429 answers reschedule an order instead of failing it, and that
+    a last attempt whose answer is lost is confirmed with the same key and compensated
+    before the order is marked failed.
+    """
+    answers = {43: [409], 44: [429], 45: [503, 200]}
+
+    def product_service(method, url, json, headers):
+        request = httpx.Request(method, f"http://product-service{url}")
+        status_code = answers[json["items"][0]["product_id"]].pop(0)
+        return httpx.Response(status_code, json=[], request=request)
+
+    product_client = AsyncMock()
+    product_client.request.side_effect = product_service
+
+    def place_order(product_id: int) -> int:
+        return client.post(
+            "/orders/",
+            json={
+                "user_id": 7,
+                "items": [
+                    {"product_id": product_id, "quantity": 2, "price_at_purchase": 1.0}
+                ],
+            },
+            headers={"Prefer": "respond-async"},
+        ).json()["order_id"]
+
+    conflict, throttled = place_order(43), place_order(44)
+    assert (
+        run_with_async_session(
+            process_order_fulfillment_batch, product_client, _deduct_stock
+        )
+        == 2
+    )
+    for order_id in (conflict, throttled):
+        retrying = client.get(f"/orders/{order_id}").json()
+        assert retrying["status"] == "pending"
+        assert "busy" in retrying["fulfillment_error"]
+
+    monkeypatch.setattr("app.fulfillment.ORDER_FULFILLMENT_MAX_ATTEMPTS", 1)
+    lost_answer = place_order(45)
+    assert (
+        run_with_async_session(
+            process_order_fulfillment_batch, product_client, _deduct_stock
+        )
+        == 1
+    )
+    confirm = product_client.request.await_args_list[-1]
+    assert confirm.kwargs["headers"] == {"Idempotency-Key": f"order-{lost_answer}"}
+    assert client.get(f"/orders/{lost_answer}").json()["status"] == "failed"
+    compensations = db_session_for_test.query(StockCompensation).all()
+    assert [(c.product_id, c.quantity) for c in compensations] == [(45, 2)]
+
+
+def test_order_events_are_published_through_the_outbox(
+    client: TestClient,
+    db_session_for_test: Session,
+    mock_httpx_client: AsyncMock,
+    tmp_path,
+):
+    """
+    Tests that order changes write outbox events in their transaction and that the
+    publisher delivers them in order, at least once, marking them published.
+    """
+    mock_httpx_client.request.return_value = httpx.Response(
+        200,
+        json=[],
+        request=httpx.Request(
+            "POST", "http://product-service/products/deduct-stock:batch"
+        ),
+    )
+    order_id = client.post(
+        "/orders/",
+        json={
+            "user_id": 3,
+            "items": [{"product_id": 1, "quantity": 1, "price_at_purchase": 9.0}],
+        },
+    ).json()["order_id"]
+    client.patch(f"/orders/{order_id}/status", params={"new_status": "shipped"})
+    client.delete(f"/orders/{order_id}")
+    assert db_session_for_test.query(OrderOutboxEvent).count() == 3
+
+    class FailingSink:
+        name = "failing"
+
+        async def publish(self, messages):
+            raise httpx.ConnectError("Connection refused")
+
+    with pytest.raises(httpx.ConnectError):
+        run_with_async_session(publish_outbox_batch, FailingSink())
+    assert (
+        db_session_for_test.query(OrderOutboxEvent)
+        .filter(OrderOutboxEvent.published_at.is_(None))
+        .count()
+        == 3
+    )
+
+    sink = FileSink(str(tmp_path / "events.ndjson"))
+    assert run_with_async_session(publish_outbox_batch, sink) == 3
+    assert run_with_async_session(publish_outbox_batch, sink) == 0
+
+    with open(sink.path) as events_file:
+        events = [json.loads(line) for line in events_file]
+    assert [event["event_type"] for event in events] == [
+        "order.created",
+        "order.status_changed",
+        "order.deleted",
+    ]
+    assert {event["order_id"] for event in events} == {order_id}
+    assert events[0]["data"]["status"] == "confirmed"
+    assert events[1]["data"] == {
+        "order_id": order_id,
+        "status": "shipped",
+        "previous_status": "confirmed",
+    }
+    assert [event["event_id"] for event in events] == sorted(
+        event["event_id"] for event in events
+    )
+
+
+def test_product_client_is_pooled(client: TestClient):
+    """
+    Tests that the app holds one long-lived Product Service client created at startup.
+    """
+    product_client = app.state.product_client
+    assert isinstance(product_client, httpx.AsyncClient)
+    assert not product_client.is_closed
+    assert str(product_client.base_url).rstrip("/") == PRODUCT_SERVICE_URL
+    assert product_client.timeout.connect == PRODUCT_SERVICE_CONNECT_TIMEOUT_SECONDS
+
+
+def test_metrics_endpoint(client: TestClient):
+    """
+    Tests that /metrics exposes request latency per route template and pool gauges.
+    """
+    client.get("/orders/123")
+    body = client.get("/metrics").text
+    assert (
+        'http_request_duration_seconds_count{method="GET",route="/orders/{order_id}",status_code="404"}'
+        in body
+    )
+    assert "db_pool_checked_out_connections" in body
+
+
+def test_db_pool_diagnostics(client: TestClient):
+    """
+    Tests that the pool diagnostics report configuration, usage and checkout waits.
+    """
+    client.get("/orders/")
+    diagnostics = client.get("/diagnostics/db-pool").json()
+    assert diagnostics["checkouts"] >= 1
+    assert diagnostics["checked_out"] == 0
+    assert diagnostics["timeouts"] == 0
+    assert {"pool_size", "max_overflow", "max_wait_seconds"} <= diagnostics.keys()
+
+
+def test_product_service_calls_are_instrumented():
+    """
+    Tests that outbound Product Service calls record latency per endpoint and count errors.
+    """
+
+    def product_service(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/products/9/deduct-stock":
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(503, json={"detail": "unavailable"})
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    endpoint = "/products/{product_id}/deduct-stock"
+    latency_before = sample(
+        "product_service_request_duration_seconds_count",
+        method="PATCH",
+        endpoint=endpoint,
+        status_code="503",
+    )
+    errors_before = sample(
+        "product_service_request_errors_total",
+        method="PATCH",
+        endpoint=endpoint,
+        error="ConnectError",
+    )
+
+    async def call_product_service():
+        async with httpx.AsyncClient(
+            base_url="http://product-service",
+            transport=InstrumentedTransport(httpx.MockTransport(product_service)),
+        ) as product_client:
+            await product_client.patch("/products/8/deduct-stock", json={})
+            with pytest.raises(httpx.ConnectError):
+                await product_client.patch("/products/9/deduct-stock", json={})
+
+    asyncio.run(call_product_service())
+
+    assert (
+        sample(
+            "product_service_request_duration_seconds_count",
+            method="PATCH",
+            endpoint=endpoint,
+            status_code="503",
+        )
+        == latency_before + 1
+    )
+    assert (
+        sample(
+            "product_service_request_errors_total",
+            method="PATCH",
+            endpoint=endpoint,
+            error="ConnectError",
+        )
+        == errors_before + 1
+    )
+
+
+def test_circuit_breaker_and_bulkhead_fail_fast():
+    """
+    Tests that the breaker opens on failures and rejects calls without reaching the
+    Product Service, recovers through half-open trial calls, and that the bulkhead
+    rejects calls beyond its concurrency limit.
+    """
+    now = [0.0]
+    breaker = CircuitBreaker(
+        window_size=4,
+        minimum_calls=4,
+        failure_rate_threshold=0.5,
+        slow_call_seconds=10,
+        slow_call_rate_threshold=1.0,
+        open_seconds=30,
+        half_open_max_calls=2,
+        clock=lambda: now[0],
+    )
+    calls = []
+    healthy = [True]
+
+    async def product_service(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        if request.url.path == "/slow":
+            await asyncio.sleep(0.2)
+        return httpx.Response(200 if healthy[0] else 503, json={})
+
+    def state(name):
+        return REGISTRY.get_sample_value(
+            "product_service_circuit_state", {"state": name}
+        )
+
+    async def call_product_service():
+        async with httpx.AsyncClient(
+            base_url="http://product-service",
+            transport=ResilientTransport(
+                httpx.MockTransport(product_service),
+                breaker,
+                max_concurrent_calls=1,
+                bulkhead_wait_seconds=0.01,
+            ),
+        ) as product_client:
+            for _ in range(3):
+                await product_client.get("/products/1")
+            healthy[0] = False
+            await product_client.get("/products/1")
+            assert breaker.state == "closed"  # 1 of 4 calls failed
+            await product_client.get("/products/1")
+            assert breaker.state == "open"  # 2 of the last 4 calls failed
+            assert state("open") == 1
+
+            with pytest.raises(CircuitOpenError) as rejected:
+                await product_client.get("/products/1")
+            assert rejected.value.retry_after_seconds == 30
+            assert len(calls) == 5  # The rejected call never reached the service
+
+            now[0] = 31
+            healthy[0] = True
+            for _ in range(2):
+                await product_client.get("/products/1")
+            assert breaker.state == "closed"
+            assert state("closed") == 1 and state("open") == 0
+
+            slow_call = asyncio.create_task(product_client.get("/slow"))
+            await asyncio.sleep(0.05)
+            with pytest.raises(BulkheadFullError):
+                await product_client.get("/products/1")
+            await slow_call
+
+    asyncio.run(call_product_service())
+
+
+def test_create_order_fails_fast_while_circuit_is_open(
+    client: TestClient, mock_httpx_client: AsyncMock
+):
+    """
+    Tests that an open circuit turns into 503 with Retry-After for the order request.
+    """
+    request = httpx.Request(
+        "POST", "http://product-service/products/deduct-stock:batch"
+    )
+    mock_httpx_client.request.side_effect = CircuitOpenError(
+        "Product Service circuit breaker is open.",
+        request=request,
+        retry_after_seconds=12,
+    )
+
+    response = client.post(
+        "/orders/",
+        json={
+            "user_id": 1,
+            "items": [{"product_id": 1, "quantity": 1, "price_at_purchase": 2.0}],
+        },
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "12"
+
+
+def test_retry_transport_hedges_retries_and_propagates_deadline():
+    """
+    Tests that slow reads are hedged while keyed writes are not, failed keyed calls are
+    retried while unkeyed writes are not, and that the remaining deadline is sent downstream and
+    stops calls once it is spent.
+    """
+    calls = []
+    failures_left = [1]
+
+    async def product_service(request: httpx.Request) -> httpx.Response:
+        calls.append((request.method, request.url.path, dict(request.headers)))
+        if request.url.path == "/slow" and len(calls) == 1:
+            await asyncio.sleep(1)
+        if request.url.path == "/products/deduct-stock:batch":
+            await asyncio.sleep(0.2)
+        if request.method == "PATCH" and failures_left[0]:
+            failures_left[0] -= 1
+            return httpx.Response(503, json={})
+        return httpx.Response(200, json={"attempt": len(calls)})
+
+    def hedged_requests():
+        return REGISTRY.get_sample_value(
+            "product_service_hedged_requests_total", {"method": "GET"}
+        )
+
+    async def call_product_service():
+        async with httpx.AsyncClient(
+            base_url="http://product-service",
+            transport=RetryTransport(
+                httpx.MockTransport(product_service),
+                max_retries=2,
+                base_backoff_seconds=0.01,
+                max_backoff_seconds=0.01,
+                hedge_delay_seconds=0.05,
+            ),
+        ) as product_client:
+            hedged_before = hedged_requests() or 0
+            started = time.perf_counter()
+            response = await product_client.get("/slow")
+            assert response.json() == {"attempt": 2}  # The hedge answered first
+            assert time.perf_counter() - started < 0.5
+            assert hedged_requests() == hedged_before + 1
+
+            calls.clear()
+            response = await product_client.patch(
+                "/products/1/deduct-stock", headers={"Idempotency-Key": "order-1"}
+            )
+            assert response.status_code == 200 and len(calls) == 2
+
+            calls.clear()
+            response = await product_client.post(
+                "/products/deduct-stock:batch", headers={"Idempotency-Key": "order-2"}
+            )
+            assert response.status_code == 200 and len(calls) == 1  # Not hedged
+            assert hedged_requests() == hedged_before + 1
+
+            calls.clear()
+            failures_left[0] = 1
+            response = await product_client.patch("/products/1/deduct-stock")
+            assert response.status_code == 503 and len(calls) == 1
+
+            calls.clear()
+            start_deadline(2)
+            await product_client.get("/products/1")
+            assert 0 < int(calls[0][2]["x-request-deadline-ms"]) <= 2000
+
+            start_deadline(0)
+            with pytest.raises(DeadlineExceededError):
+                await product_client.get("/products/1")
+            assert len(calls) == 1
+
+    asyncio.run(call_product_service())
+
+
+def test_create_order_returns_504_when_deadline_is_exceeded(
+    client: TestClient, mock_httpx_client: AsyncMock
+):
+    """
+    Tests that a stock deduction cut off by the request deadline answers 504.
+    """
+    request = httpx.Request(
+        "POST", "http://product-service/products/deduct-stock:batch"
+    )
+    mock_httpx_client.request.side_effect = DeadlineExceededError(
+        "Request deadline passed before calling the Product Service.",
+        request=request,
+    )
+
+    response = client.post(
+        "/orders/",
+        json={
+            "user_id": 1,
+            "items": [{"product_id": 1, "quantity": 1, "price_at_purchase": 2.0}],
+        },
+        headers={"X-Request-Deadline-Ms": "1000"},
+    )
+    assert response.status_code == 504
+
+
+def test_create_order_confirms_deduction_with_lost_answer(
+    client: TestClient, db_session_for_test: Session, mock_httpx_client: AsyncMock
+):
+    """
+    Tests that a batch deduction whose answer was lost is sent again with the same
+    Idempotency-Key, and its stock queued for compensation only if it was applied.
+    """
+    confirmation_status = {}
+
+    async def product_service(method, url, json, headers):
+        request = httpx.Request(method, f"http://product-service{url}")
+        product_id = json["items"][0]["product_id"]
+        if product_id not in confirmation_status:
+            confirmation_status[product_id] = 200 if product_id == 31 else 400
+            raise httpx.ReadTimeout("Timed out", request=request)
+        return httpx.Response(
+            confirmation_status[product_id], json={"detail": "x"}, request=request
+        )
+
+    mock_httpx_client.request.side_effect = product_service
+    for product_id in (31, 32):
+        response = client.post(
+            "/orders/",
+            json={
+                "user_id": 1,
+                "items": [
+                    {"product_id": product_id, "quantity": 2, "price_at_purchase": 1.0}
+                ],
+            },
+        )
+        assert response.status_code == 503
+
+    calls = mock_httpx_client.request.await_args_list
+    assert len(calls) == 4
+    for sent, confirmed in (calls[0:2], calls[2:4]):
+        key = sent.kwargs["headers"]["Idempotency-Key"]
+        assert key.startswith("create-order-")
+        assert confirmed.kwargs["headers"]["Idempotency-Key"] == key
+        assert confirmed.kwargs["json"] == sent.kwargs["json"]
+    assert calls[0].kwargs["headers"] != calls[2].kwargs["headers"]
+
+    compensations = db_session_for_test.query(StockCompensation).all()
+    assert [(c.product_id, c.quantity) for c in compensations] == [(31, 2)]
+    assert db_session_for_test.query(Order).count() == 0
+
+
+def test_create_order_retry_reuses_downstream_key_of_client_key(
+    client: TestClient, db_session_for_test: Session, mock_httpx_client: AsyncMock
+):
+    """
+    Tests that the downstream key is derived from the client's Idempotency-Key, so a
+    client retry after an unconfirmed deduction replays it instead of deducting again,
+    while a deduction that was given back keeps its error for that key.
+    """
+    answers = {33: [503, 503, 200], 34: [503, 200]}
+
+    async def product_service(method, url, json, headers):
+        request = httpx.Request(method, f"http://product-service{url}")
+        status_code = answers[json["items"][0]["product_id"]].pop(0)
+        return httpx.Response(status_code, json=[], request=request)
+
+    mock_httpx_client.request.side_effect = product_service
+
+    def place_order(product_id: int, key: str):
+        return client.post(
+            "/orders/",
+            json={
+                "user_id": 2,
+                "items": [
+                    {"product_id": product_id, "quantity": 1, "price_at_purchase": 3.0}
+                ],
+            },
+            headers={"Idempotency-Key": key},
+        )
+
+    # Deduction and confirmation both unanswered: the key is released for a retry
+    assert place_order(33, "client-key-1").status_code == 503
+    assert place_order(33, "client-key-1").status_code == 201
+    keys = {
+        call.kwargs["headers"]["Idempotency-Key"]
+        for call in mock_httpx_client.request.await_args_list
+    }
+    assert keys == {"create-order-client-key-1"}
+
+    # Confirmed as applied and given back: the failure is replayed, not the deduction
+    assert place_order(34, "client-key-2").status_code == 503
+    replayed = place_order(34, "client-key-2")
+    assert replayed.status_code == 503
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+    assert mock_httpx_client.request.await_count == 5
+    compensations = db_session_for_test.query(StockCompensation).all()
+    assert [(c.product_id, c.quantity) for c in compensations] == [(34, 1)]
+
+
+def test_create_order_falls_back_to_concurrent_deductions(
+    client: TestClient,
+    db_session_for_test: Session,
+    mock_httpx_client: AsyncMock,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """
+    Tests that per-item deductions are used when the batch endpoint is missing, that
+    items deducted before a failure are handed to the rollback path, and that the batch
+    endpoint is probed again once BATCH_DEDUCTION_REPROBE_SECONDS have passed.
+    """
+    monkeypatch.setattr("app.main._batch_deduction_unavailable_until", 0.0)
+    rollback_mock = AsyncMock()
+    monkeypatch.setattr("app.main._rollback_stock_deductions", rollback_mock)
+
+    async def product_service(method, url, json, headers=None):
+        request = httpx.Request(method, f"http://product-service{url}")
+        if url == "/products/deduct-stock:batch":
+            return httpx.Response(
+                405, json={"detail": "Method Not Allowed"}, request=request
+            )
+        if url == "/products/3/deduct-stock":
+            return httpx.Response(
+                400, json={"detail": "Insufficient stock"}, request=request
+            )
+        return httpx.Response(200, json={}, request=request)
+
+    mock_httpx_client.request.side_effect = product_service
+    order_data = {
+        "user_id": 3,
+        "items": [
+            {"product_id": 1, "quantity": 1, "price_at_purchase": 1.0},
+            {"product_id": 2, "quantity": 1, "price_at_purchase": 1.0},
+            {"product_id": 3, "quantity": 9, "price_at_purchase": 1.0},
+        ],
+    }
+
+    response = client.post("/orders/", json=order_data)
+
+    assert response.status_code == 400
+    assert "Insufficient stock" in response.json()["detail"]
+    patched_urls = {
+        call.args[1]
+        for call in mock_httpx_client.request.await_args_list
+        if call.args[0] == "PATCH"
+    }
+    assert patched_urls == {f"/products/{i}/deduct-stock" for i in (1, 2, 3)}
+    rolled_back = rollback_mock.await_args.args[1]
+    assert sorted(item.product_id for item in rolled_back) == [1, 2]
+
+    def batch_calls():
+        return sum(
+            call.args[1] == "/products/deduct-stock:batch"
+            for call in mock_httpx_client.request.await_args_list
+        )
+
+    # The batch endpoint is skipped for a while, then probed again
+    client.post("/orders/", json=order_data)
+    assert batch_calls() == 1
+    monkeypatch.setattr(
+        "app.main._batch_deduction_unavailable_until", time.monotonic() - 1
+    )
+    client.post("/orders/", json=order_data)
+    assert batch_calls() == 2
+
+
+def test_rollback_stock_deductions_queues_compensations(db_session_for_test: Session):
+    """
+    Tests that failed-order rollbacks are stored durably as pending compensations.
+    """
+    items = [
+        OrderItemCreate(product_id=11, quantity=2, price_at_purchase=1.0),
+        OrderItemCreate(product_id=12, quantity=1, price_at_purchase=1.0),
+    ]
+
+    run_with_async_session(_rollback_stock_deductions, items)
+
+    queued = (
+        db_session_for_test.query(StockCompensation)
+        .filter(StockCompensation.product_id.in_([11, 12]))
+        .order_by(StockCompensation.product_id)
+        .all()
+    )
+    assert [(c.product_id, c.quantity, c.status) for c in queued] == [
+        (11, 2, "pending"),
+        (12, 1, "pending"),
+    ]
+
+
+def test_process_compensation_batch(db_session_for_test: Session):
+    """
+    Tests that due compensations are restocked in one batch call, each with its own
+    idempotency key, and settled, and that compensations for deleted products are
+    marked as failed instead of retried forever.
+    """
+    db_session_for_test.add_all(
+        [
+            StockCompensation(product_id=21, quantity=3),
+            StockCompensation(product_id=22, quantity=1),
+        ]
+    )
+    db_session_for_test.commit()
+    mock_client = AsyncMock()
+    mock_client.post.return_value = httpx.Response(
+        200,
+        json={"restocked": [], "missing_product_ids": [22]},
+        request=httpx.Request("POST", "http://product-service/products/restock:batch"),
+    )
+
+    processed = run_with_async_session(process_compensation_batch, mock_client)
+
+    assert processed == 2
+    sent_items = mock_client.post.await_args.kwargs["json"]["items"]
+    keys = dict(
+        db_session_for_test.query(
+            StockCompensation.product_id, StockCompensation.idempotency_key
+        ).all()
+    )
+    assert {"product_id": 21, "quantity_to_add": 3, "idempotency_key": keys[21]} in (
+        sent_items
+    )
+    assert keys[21] != keys[22]
+    statuses = dict(
+        db_session_for_test.query(
+            StockCompensation.product_id, StockCompensation.status
+        )
+        .filter(StockCompensation.product_id.in_([21, 22]))
+        .all()
+    )
+    assert statuses == {21: "completed", 22: "failed"}
+
+
+def test_process_compensation_batch_retries_when_unavailable(
+    db_session_for_test: Session,
+):
+    """
+    Tests that a network failure keeps compensations pending with a later retry time.
+    """
+    compensation = StockCompensation(product_id=31, quantity=1)
+    db_session_for_test.add(compensation)
+    db_session_for_test.commit()
+    mock_client = AsyncMock()
+    mock_client.post.side_effect = httpx.ConnectError("connection refused")
+
+    run_with_async_session(process_compensation_batch, mock_client)
+
+    db_session_for_test.refresh(compensation)
+    assert compensation.status == "pending"
+    assert compensation.attempts == 1
+    assert compensation.next_attempt_at > compensation.created_at
+
+
+def test_list_orders_cursor_pagination(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that a user's orders are listed newest first and can be paged with cursors.
+    """
+    for days_ago in (3, 1, 2):
+        db_session_for_test.add(
+            Order(
+                user_id=42,
+                status="confirmed",
+                total_amount=Decimal("1.00"),
+                order_date=datetime.now(timezone.utc) - timedelta(days=days_ago),
+            )
+        )
+    db_session_for_test.commit()
+
+    first_page = client.get("/orders/", params={"user_id": 42, "limit": 2})
+    assert first_page.status_code == 200
+    first_dates = [o["order_date"] for o in first_page.json()]
+    assert first_dates == sorted(first_dates, reverse=True)
+    next_cursor = first_page.headers["X-Next-Cursor"]
+
+    second_page = client.get(
+        "/orders/", params={"user_id": 42, "limit": 2, "cursor": next_cursor}
+    )
+    assert len(second_page.json()) == 1
+    assert second_page.json()[0]["order_date"] < first_dates[-1]
+    assert "X-Next-Cursor" not in second_page.headers
+
+    bad_cursor = client.get("/orders/", params={"cursor": "not-a-cursor"})
+    assert bad_cursor.status_code == 400
+    for values in (
+        [first_dates[-1], "x"],
+        [first_dates[-1], 2**40],
+        [first_dates[-1]],
+        [None, 1],
+    ):
+        forged = client.get(
+            "/orders/", params={"cursor": encode_cursor("order_date_desc", values)}
+        )
+        assert forged.status_code == 400
+
+
+def test_order_reads_and_status_update_include_items(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that single-order reads and status updates return the eager-loaded items.
+    """
+    order = Order(
+        user_id=7,
+        status="confirmed",
+        total_amount=Decimal("6.00"),
+        items=[
+            OrderItem(
+                product_id=5,
+                quantity=3,
+                price_at_purchase=Decimal("2.00"),
+                item_total=Decimal("6.00"),
+            )
+        ],
+    )
+    db_session_for_test.add(order)
+    db_session_for_test.commit()
+
+    fetched = client.get(f"/orders/{order.order_id}")
+    assert fetched.status_code == 200
+    assert [item["product_id"] for item in fetched.json()["items"]] == [5]
+
+    updated = client.patch(
+        f"/orders/{order.order_id}/status", params={"new_status": "shipped"}
+    )
+    assert updated.status_code == 200
+    assert updated.json()["status"] == "shipped"
+    assert updated.json()["updated_at"] is not None
+    assert len(updated.json()["items"]) == 1
+
+    items = client.get(f"/orders/{order.order_id}/items")
+    assert [item["quantity"] for item in items.json()] == [3]
+
+    assert client.delete(f"/orders/{order.order_id}").status_code == 204
+    assert client.get(f"/orders/{order.order_id}").status_code == 404
+
+
+def test_list_orders_loads_items_without_n_plus_one(
+    client: TestClient, db_session_for_test: Session, assert_max_queries
+):
+    """
+    Tests that a page of orders costs two queries with items and one as a summary.
+    """
+    for _ in range(3):
+        db_session_for_test.add(
+            Order(
+                user_id=8,
+                status="confirmed",
+                total_amount=Decimal("2.00"),
+                items=[
+                    OrderItem(
+                        product_id=product_id,
+                        quantity=1,
+                        price_at_purchase=Decimal("1.00"),
+                        item_total=Decimal("1.00"),
+                    )
+                    for product_id in (1, 2)
+                ],
+            )
+        )
+    db_session_for_test.commit()
+
+    with_items = client.get("/orders/", params={"user_id": 8})
+    assert [len(o["items"]) for o in with_items.json()] == [2, 2, 2]
+    assert_max_queries(with_items, 2)
+    assert "db;dur=" in with_items.headers["Server-Timing"]
+
+    summary = client.get("/orders/", params={"user_id": 8, "include_items": "false"})
+    assert [o["item_count"] for o in summary.json()] == [2, 2, 2]
+    assert all("items" not in o for o in summary.json())
+    assert_max_queries(summary, 1)
+
+    order_id = with_items.json()[0]["order_id"]
+    assert_max_queries(client.get(f"/orders/{order_id}"), 2)
@@ -0,0 +1,168 @@
+# week08/backend/product_service/app/bulk_import.py
+
+import csv
+import io
+import json
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from .schemas import ProductBulkImportError, ProductCreate
+
+JSON_CONTENT_TYPES = ("application/json",)
+NDJSON_CONTENT_TYPES = (
+    "application/x-ndjson",
+    "application/ndjson",
+    "application/jsonl",
+)
+CSV_CONTENT_TYPES = ("text/csv",)
+SUPPORTED_CONTENT_TYPES = JSON_CONTENT_TYPES + NDJSON_CONTENT_TYPES + CSV_CONTENT_TYPES
+
+# Optional columns whose empty CSV cells mean "not provided"
+_OPTIONAL_CSV_FIELDS = ("description", "image_url")
+# Characters of a JSON array body read at a time, and the most one row may take
+_JSON_READ_SIZE = 64 * 1024
+_JSON_MAX_ROW_SIZE = 1024 * 1024
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _json_rows(text_file: IO[str]) -> Iterator[Tuple[int, Any]]:
+    # The array is decoded one element at a time, so only the element being parsed
+    # (and one read ahead) is held in memory, however large the upload
+    buffer, position, eof = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, position, eof
+        chunk = "" if eof else text_file.read(_JSON_READ_SIZE)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+        return not eof
+
+    def next_char() -> str:
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not fill():
+                return ""
+
+    if next_char() != "[":
+        raise ValueError("JSON body must be an array of products.")
+    position += 1
+    if next_char() == "]":
+        position += 1
+    else:
+        row_number = 0
+        while True:
+            next_char()
+            # An element ending right at the end of the buffer may be cut short
+            # (a number, say), so it is only taken once the next character is read
+            while True:
+                try:
+                    row, end = _JSON_DECODER.raw_decode(buffer, position)
+                except json.JSONDecodeError as e:
+                    if len(buffer) - position > _JSON_MAX_ROW_SIZE:
+                        raise ValueError(
+                            f"Row {row_number + 1} of the JSON body exceeds {_JSON_MAX_ROW_SIZE} characters."
+                        )
+                    if fill():
+                        continue
+                    raise ValueError(
+                        f"Invalid JSON body in row {row_number + 1}: {e.msg}."
+                    )
+                if end < len(buffer) or eof:
+                    break
+                fill()
+            position = end
+            row_number += 1
+            yield row_number, row
+
+            separator = next_char()
+            position += 1
+            if separator == "]":
+                break
+            if separator != ",":
+                raise ValueError(
+                    f"Invalid JSON body: expected ',' or ']' after row {row_number}."
+                )
+    if next_char():
+        raise ValueError("Invalid JSON body: extra data after the array.")
+
+
+def _ndjson_rows(text_file: IO[str]) -> Iterator[Tuple[int, Any]]:
+    row_number = 0
+    for line in text_file:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            yield row_number, json.loads(line)
+        except ValueError as e:
+            yield row_number, ProductBulkImportError(
+                row=row_number,
+                errors=[{"field": None, "message": f"Invalid JSON: {e}"}],
+            )
+
+
+def _csv_rows(text_file: IO[str]) -> Iterator[Tuple[int, Any]]:
+    reader = csv.DictReader(text_file)
+    for row_number, row in enumerate(reader, start=1):
+        # DictReader collects cells beyond the header under the None key
+        extra = row.pop(None, None)
+        if extra is not None:
+            yield row_number, ProductBulkImportError(
+                row=row_number,
+                errors=[
+                    {
+                        "field": None,
+                        "message": f"Row has {len(extra)} more fields than the header.",
+                    }
+                ],
+            )
+            continue
+        for field in _OPTIONAL_CSV_FIELDS:
+            if row.get(field) == "":
+                row[field] = None
+        yield row_number, row
+
+
+def iter_products(
+    body: IO[bytes], content_type: str
+) -> Iterator[Tuple[int, Optional[ProductCreate], Optional[ProductBulkImportError]]]:
+    """
+    Parses an uploaded catalog and validates every row with ProductCreate.
+    Yields (row_number, product, error) with exactly one of product/error set, so
+    one bad row is reported without rejecting the rest of the file.
+    Raises ValueError if the body as a whole cannot be parsed.
+    """
+    text_file = io.TextIOWrapper(body, encoding="utf-8-sig", newline="")
+    if content_type in JSON_CONTENT_TYPES:
+        rows = _json_rows(text_file)
+    elif content_type in NDJSON_CONTENT_TYPES:
+        rows = _ndjson_rows(text_file)
+    else:
+        rows = _csv_rows(text_file)
+
+    for row_number, row in rows:
+        if isinstance(row, ProductBulkImportError):
+            yield row_number, None, row
+            continue
+        try:
+            yield row_number, ProductCreate.model_validate(row), None
+        except ValidationError as e:
+            yield row_number, None, ProductBulkImportError(
+                row=row_number, errors=_describe_errors(e)
+            )
+
+
+def _describe_errors(error: ValidationError) -> List[Dict[str, Optional[str]]]:
+    return [
+        {
+            "field": ".".join(str(part) for part in detail["loc"]) or None,
+            "message": detail["msg"],
+        }
+        for detail in error.errors()
+    ]
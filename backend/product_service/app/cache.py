@@ -0,0 +1,97 @@
+# week08/backend/product_service/app/cache.py
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries expire after ttl_seconds.
+    Every operation takes a lock, so it is also safe to use from worker threads.
+
+    Writers invalidate keys after committing. To stop a reader that loaded a row
+    before such a commit from re-inserting the stale value afterwards, readers take
+    the key's generation before querying and pass it to set(); the value is dropped
+    if the key was invalidated in between. Generations are kept per bucket of keys
+    (generation_buckets of them), so an invalidation only discards in-flight fills
+    of keys hashing to the same bucket.
+    """
+
+    def __init__(
+        self, max_entries: int, ttl_seconds: float, generation_buckets: int = 1024
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generations = [0] * generation_buckets
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def _bucket(self, key: Hashable) -> int:
+        return hash(key) % len(self._generations)
+
+    def generation(self, key: Hashable) -> int:
+        with self._lock:
+            return self._generations[self._bucket(key)]
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if (
+                generation is not None
+                and generation != self._generations[self._bucket(key)]
+            ):
+                return  # An invalidation raced with the read that produced value
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys: Hashable):
+        with self._lock:
+            for key in keys:
+                self._generations[self._bucket(key)] += 1
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generations = [generation + 1 for generation in self._generations]
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
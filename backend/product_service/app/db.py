@@ -1,10 +1,18 @@
 # week08/backend/product_service/app/db.py
 
+import logging
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
 
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
 
 POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
@@ -12,20 +20,152 @@ POSTGRES_DB = os.getenv("POSTGRES_DB", "products")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
 
+# Plain libpq URL (used by asyncpg.connect for LISTEN and by sync tooling such as tests)
 DATABASE_URL = (
     "postgresql://"
     f"{POSTGRES_USER}:{POSTGRES_PASSWORD}@"
     f"{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
+ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+# Connection pool sizing; the defaults match SQLAlchemy's own
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+# Recycle connections before server or load balancer idle timeouts close them
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Checkouts slower than this are logged, since they mean the pool is saturated
+DB_POOL_WAIT_WARNING_SECONDS = float(os.getenv("DB_POOL_WAIT_WARNING_SECONDS", "0.5"))
+
+
+class PoolWaitStats:
+    """Time spent waiting for connections to be checked out of the pool."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.slow_checkouts = 0
+        self.timeouts = 0
+
+    def record(self, waited_seconds: float):
+        self.checkouts += 1
+        self.total_wait_seconds += waited_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, waited_seconds)
+        if waited_seconds > DB_POOL_WAIT_WARNING_SECONDS:
+            self.slow_checkouts += 1
+
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that measures how long each checkout takes (waiting for a free
+    connection, opening a new one and the pre-ping) and warns about slow ones.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.wait_stats.timeouts += 1
+            logger.error(
+                f"Product Service: Timed out after {DB_POOL_TIMEOUT_SECONDS}s waiting for a DB connection. {self.status()}"
+            )
+            raise
+        waited = time.perf_counter() - start
+        self.wait_stats.record(waited)
+        if waited > DB_POOL_WAIT_WARNING_SECONDS:
+            logger.warning(
+                f"Product Service: Waited {waited:.3f}s for a DB connection. {self.status()}"
+            )
+        return connection
+
+
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=InstrumentedPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+    pool_recycle=DB_POOL_RECYCLE_SECONDS,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+# expire_on_commit=False: attributes stay loaded after commit, since lazy reloads
+# are not possible on an AsyncSession
+SessionLocal = async_sessionmaker(
+    bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+class QueryStats:
+    """Number of SQL statements and time spent executing them."""
+
+    __slots__ = ("count", "duration_seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.duration_seconds = 0.0
+
+
+# Stats of the request being handled; set per request by the timing middleware
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+def start_query_stats() -> QueryStats:
+    """
+    Starts collecting statement counts and DB time for the current request.
+    Tasks created afterwards inherit the context, so they add to the same stats.
+    """
+    stats = QueryStats()
+    _query_stats.set(stats)
+    return stats
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start_time = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration_seconds += time.perf_counter() - context._query_start_time
+
+
+def pool_diagnostics() -> Dict[str, Any]:
+    """Current pool usage, its configuration and checkout wait statistics."""
+    pool = engine.pool
+    wait_stats = pool.wait_stats
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "timeout_seconds": DB_POOL_TIMEOUT_SECONDS,
+        "recycle_seconds": DB_POOL_RECYCLE_SECONDS,
+        "pre_ping": DB_POOL_PRE_PING,
+        "wait_warning_seconds": DB_POOL_WAIT_WARNING_SECONDS,
+        "checkouts": wait_stats.checkouts,
+        "average_wait_seconds": (
+            wait_stats.total_wait_seconds / wait_stats.checkouts
+            if wait_stats.checkouts
+            else 0.0
+        ),
+        "max_wait_seconds": wait_stats.max_wait_seconds,
+        "slow_checkouts": wait_stats.slow_checkouts,
+        "timeouts": wait_stats.timeouts,
+    }
@@ -0,0 +1,74 @@
+# week08/backend/product_service/app/deadline.py
+
+import logging
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .metrics import REQUEST_DEADLINES_EXCEEDED
+
+logger = logging.getLogger(__name__)
+
+# Time budget in milliseconds the caller still has for a request (sent by the Order Service)
+REQUEST_DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+# Monotonic deadline of the request being handled; unset without the header
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def parse_deadline_header(value: Optional[str]) -> Optional[float]:
+    """Budget in seconds from an X-Request-Deadline-Ms value, or None if absent or invalid."""
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0) / 1000
+    except ValueError:
+        return None
+
+
+def start_deadline(budget_seconds: float):
+    """
+    Sets the deadline of the current request. Tasks created afterwards inherit it.
+    """
+    _deadline.set(time.monotonic() + budget_seconds)
+
+
+def remaining_seconds() -> Optional[float]:
+    """Time left before the current request's deadline, or None without a deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline():
+    """
+    Raises 504 once the current request's deadline has passed. Called right before
+    committing, so work the caller has given up on is rolled back instead.
+    """
+    remaining = remaining_seconds()
+    if remaining is not None and remaining <= 0:
+        REQUEST_DEADLINES_EXCEEDED.labels("aborted").inc()
+        logger.warning("Product Service: Request deadline exceeded, rolling back.")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request deadline exceeded.",
+        )
+
+
+async def apply_deadline_to_transaction(db: AsyncSession):
+    """
+    Caps every statement of the session's transaction at the time left before the
+    deadline (SET LOCAL statement_timeout), so a request stuck on a lock or a slow
+    query is cancelled by PostgreSQL instead of committing after its caller left.
+    """
+    check_deadline()
+    remaining = remaining_seconds()
+    if remaining is not None:
+        await db.execute(
+            text(f"SET LOCAL statement_timeout = {max(int(remaining * 1000), 1)}")
+        )
@@ -0,0 +1,245 @@
+# week08/backend/product_service/app/idempotency.py
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import timedelta
+from typing import Any, Dict, Optional, Set
+
+from fastapi import HTTPException, Response, status
+from sqlalchemy import and_, delete, func, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import SessionLocal
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_REPLAYED_HEADER = "Idempotent-Replayed"
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# How long a stored response can be replayed
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+# An in-progress key older than this belongs to a request that died, so it may be reclaimed
+IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS = int(
+    os.getenv("IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS", "60")
+)
+IDEMPOTENCY_KEY_CLEANUP_INTERVAL_SECONDS = float(
+    os.getenv("IDEMPOTENCY_KEY_CLEANUP_INTERVAL_SECONDS", "300")
+)
+IDEMPOTENCY_KEY_CLEANUP_BATCH_SIZE = int(
+    os.getenv("IDEMPOTENCY_KEY_CLEANUP_BATCH_SIZE", "1000")
+)
+
+
+def request_fingerprint(payload: Any) -> str:
+    """SHA-256 of the canonical JSON form of a request payload."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+async def begin_idempotent_request(
+    db: AsyncSession, scope: str, idempotency_key: str, payload: Any
+) -> Optional[Response]:
+    """
+    Claims idempotency_key for this request inside the session's transaction.
+    Returns None when the request should be executed; the caller then stores its
+    response with save_idempotent_response before committing. Returns the stored
+    response when the key was already used for the same request.
+    Raises 422 if the key was used for a different request and 409 while the first
+    request with the key is still running.
+    """
+    if not idempotency_key or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{IDEMPOTENCY_KEY_HEADER} must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters.",
+        )
+    request_hash = request_fingerprint(payload)
+
+    # A concurrent request with the same key waits on the primary key until this
+    # transaction ends, then sees the stored response. Expired and abandoned keys
+    # are taken over in the same statement.
+    claim_stmt = insert(IdempotencyKey).values(
+        scope=scope,
+        idempotency_key=idempotency_key,
+        request_hash=request_hash,
+        status="in_progress",
+        expires_at=func.now() + timedelta(seconds=IDEMPOTENCY_KEY_TTL_SECONDS),
+    )
+    claim_stmt = claim_stmt.on_conflict_do_update(
+        index_elements=[IdempotencyKey.scope, IdempotencyKey.idempotency_key],
+        set_={
+            "request_hash": claim_stmt.excluded.request_hash,
+            "status": "in_progress",
+            "response_status_code": None,
+            "response_body": None,
+            "created_at": func.now(),
+            "expires_at": claim_stmt.excluded.expires_at,
+        },
+        where=or_(
+            IdempotencyKey.expires_at <= func.now(),
+            and_(
+                IdempotencyKey.status == "in_progress",
+                IdempotencyKey.created_at
+                < func.now() - timedelta(seconds=IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS),
+            ),
+        ),
+    ).returning(IdempotencyKey.idempotency_key)
+    if (await db.execute(claim_stmt)).first() is not None:
+        return None
+
+    stored = (
+        await db.execute(
+            select(IdempotencyKey).where(
+                IdempotencyKey.scope == scope,
+                IdempotencyKey.idempotency_key == idempotency_key,
+            )
+        )
+    ).scalar_one_or_none()
+    if stored is not None and stored.request_hash != request_hash:
+        logger.warning(
+            f"Product Service: {IDEMPOTENCY_KEY_HEADER} '{idempotency_key}' reused with a different {scope} request."
+        )
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"{IDEMPOTENCY_KEY_HEADER} was already used for a different request.",
+        )
+    if stored is None or stored.status != "completed":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"A request with this {IDEMPOTENCY_KEY_HEADER} is still being processed.",
+            headers={"Retry-After": "1"},
+        )
+
+    logger.info(
+        f"Product Service: Replaying stored {scope} response for {IDEMPOTENCY_KEY_HEADER} '{idempotency_key}'."
+    )
+    return Response(
+        content=stored.response_body,
+        status_code=stored.response_status_code,
+        media_type="application/json",
+        headers={IDEMPOTENCY_REPLAYED_HEADER: "true"},
+    )
+
+
+async def save_idempotent_response(
+    db: AsyncSession, scope: str, idempotency_key: str, status_code: int, body: str
+):
+    """Stores the response for a claimed key; committed with the caller's transaction."""
+    await db.execute(
+        update(IdempotencyKey)
+        .where(
+            IdempotencyKey.scope == scope,
+            IdempotencyKey.idempotency_key == idempotency_key,
+        )
+        .values(
+            status="completed", response_status_code=status_code, response_body=body
+        )
+    )
+
+
+async def claim_idempotency_keys(
+    db: AsyncSession, scope: str, payloads: Dict[str, Any]
+) -> Set[str]:
+    """
+    Records the keys of individually idempotent items, such as the entries of a batch,
+    as completed inside the session's transaction. Returns the keys not seen before;
+    items whose key was already recorded were applied by an earlier request and must be
+    skipped. A concurrent request with the same key waits on the primary key until this
+    transaction ends.
+    Raises 409 if a key was already recorded for a different item.
+    """
+    if not payloads:
+        return set()
+    request_hashes = {
+        key: request_fingerprint(payload) for key, payload in payloads.items()
+    }
+    claim_stmt = (
+        insert(IdempotencyKey)
+        .values(
+            [
+                {
+                    "scope": scope,
+                    "idempotency_key": key,
+                    "request_hash": request_hash,
+                    "status": "completed",
+                    "expires_at": func.now()
+                    + timedelta(seconds=IDEMPOTENCY_KEY_TTL_SECONDS),
+                }
+                for key, request_hash in request_hashes.items()
+            ]
+        )
+        .on_conflict_do_nothing(
+            index_elements=[IdempotencyKey.scope, IdempotencyKey.idempotency_key]
+        )
+        .returning(IdempotencyKey.idempotency_key)
+    )
+    new_keys = set((await db.execute(claim_stmt)).scalars().all())
+
+    seen_keys = [key for key in request_hashes if key not in new_keys]
+    if seen_keys:
+        stored = await db.execute(
+            select(IdempotencyKey.idempotency_key, IdempotencyKey.request_hash).where(
+                IdempotencyKey.scope == scope,
+                IdempotencyKey.idempotency_key.in_(seen_keys),
+            )
+        )
+        reused_keys = sorted(
+            key for key, request_hash in stored if request_hash != request_hashes[key]
+        )
+        if reused_keys:
+            logger.warning(
+                f"Product Service: Idempotency keys reused with a different {scope} item: {reused_keys}."
+            )
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Idempotency keys already used for a different item: {', '.join(reused_keys)}.",
+            )
+    return new_keys
+
+
+async def delete_expired_idempotency_keys(
+    db: AsyncSession, batch_size: int = IDEMPOTENCY_KEY_CLEANUP_BATCH_SIZE
+) -> int:
+    """Deletes up to batch_size expired keys and commits. Returns the number deleted."""
+    expired = (
+        select(IdempotencyKey.scope, IdempotencyKey.idempotency_key)
+        .where(IdempotencyKey.expires_at <= func.now())
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    result = await db.execute(
+        delete(IdempotencyKey).where(
+            tuple_(IdempotencyKey.scope, IdempotencyKey.idempotency_key).in_(expired)
+        )
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def run_idempotency_key_cleanup():
+    """
+    Background task that deletes expired idempotency keys until cancelled.
+    """
+    logger.info("Product Service: Idempotency key cleanup started.")
+    while True:
+        deleted = 0
+        try:
+            async with SessionLocal() as db:
+                deleted = await delete_expired_idempotency_keys(db)
+            if deleted:
+                logger.info(
+                    f"Product Service: Deleted {deleted} expired idempotency keys."
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(
+                f"Product Service: Idempotency key cleanup failed: {e}", exc_info=True
+            )
+        # A full batch means more keys have probably expired, so delete again immediately
+        if deleted < IDEMPOTENCY_KEY_CLEANUP_BATCH_SIZE:
+            await asyncio.sleep(IDEMPOTENCY_KEY_CLEANUP_INTERVAL_SECONDS)
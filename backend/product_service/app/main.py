@@ -1,12 +1,19 @@
 # week08/backend/product_service/app/main.py
 
+import asyncio
+import csv
+import io
+import itertools
 import logging
 import os
+import re
 import sys
-import time
+import tempfile
+import zlib
+from collections import defaultdict
 from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import List, Optional
+from typing import Annotated, AsyncIterator, Dict, List, Literal, Optional
 from urllib.parse import urlparse
 
 # Azure Storage Imports
@@ -21,19 +28,94 @@ from fastapi import (
     FastAPI,
     File,
     Form,
+    Header,
     HTTPException,
+    Path,
     Query,
+    Request,
     Response,
     UploadFile,
     status,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import (
+    REAL,
+    Integer,
+    and_,
+    any_,
+    bindparam,
+    cast,
+    column,
+    false,
+    func,
+    insert,
+    literal,
+    or_,
+    select,
+    text,
+    tuple_,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.schema import CreateIndex
 
-from .db import Base, engine, get_db
-from .models import Product
-from .schemas import ProductCreate, ProductResponse, ProductUpdate, StockDeductRequest
+from .bulk_import import SUPPORTED_CONTENT_TYPES, iter_products
+from .cache import TTLCache
+from .deadline import (
+    REQUEST_DEADLINE_HEADER,
+    apply_deadline_to_transaction,
+    check_deadline,
+    parse_deadline_header,
+    start_deadline,
+)
+from .db import (
+    Base,
+    SessionLocal,
+    engine,
+    get_db,
+    pool_diagnostics,
+    start_query_stats,
+)
+from .idempotency import (
+    IDEMPOTENCY_KEY_HEADER,
+    IDEMPOTENCY_REPLAYED_HEADER,
+    begin_idempotent_request,
+    claim_idempotency_keys,
+    run_idempotency_key_cleanup,
+    save_idempotent_response,
+)
+from .metrics import (
+    REQUEST_DEADLINES_EXCEEDED,
+    register_collectors,
+    track_request_metrics,
+)
+from .models import (
+    PREFIX_SEARCH_CONFIG,
+    PREFIX_SEARCH_VECTOR_EXPRESSION,
+    SEARCH_CONFIG,
+    SEARCH_VECTOR_EXPRESSION,
+    Product,
+)
+from .notifications import ProductChangeListener, notify_product_changes
+from .pagination import decode_cursor, encode_cursor
+from .schemas import (
+    MAX_PRODUCT_ID,
+    ProductBulkImportResponse,
+    ProductCreate,
+    ProductResponse,
+    ProductUpdate,
+    StockBatchDeductRequest,
+    StockBatchRestockRequest,
+    StockBatchRestockResponse,
+    StockDeductRequest,
+    StockRestockRequest,
+)
 
 # --- Standard Logging Configuration ---
 logging.basicConfig(
@@ -90,6 +172,61 @@ else:
 
 RESTOCK_THRESHOLD = 5  # Threshold for restock notification
 
+# In-process cache of serialized GET /products/{product_id} responses
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", "10000"))
+PRODUCT_CACHE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "30"))
+product_cache = TTLCache(PRODUCT_CACHE_MAX_ENTRIES, PRODUCT_CACHE_TTL_SECONDS)
+# Evict entries changed by other workers/replicas via Postgres LISTEN/NOTIFY
+PRODUCT_CACHE_SYNC_ENABLED = (
+    os.getenv("PRODUCT_CACHE_SYNC_ENABLED", "true").lower() == "true"
+)
+product_change_listener = ProductChangeListener(product_cache)
+register_collectors(engine, product_cache)
+
+# Bulk import: rows per multi-row INSERT and how many rejected rows are itemised
+BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "1000"))
+BULK_IMPORT_MAX_REPORTED_ERRORS = int(
+    os.getenv("BULK_IMPORT_MAX_REPORTED_ERRORS", "1000")
+)
+
+# Background task deleting expired idempotency keys
+IDEMPOTENCY_KEY_CLEANUP_ENABLED = (
+    os.getenv("IDEMPOTENCY_KEY_CLEANUP_ENABLED", "true").lower() == "true"
+)
+
+# Maximum number of IDs accepted by GET /products/?ids=...
+PRODUCT_MULTI_GET_MAX_IDS = 100
+
+# Key values held by list cursors per sort order (the last row's sort key and product_id)
+CURSOR_VALUE_TYPES = {
+    "product_id": (int,),
+    "name": (str, int),
+    "relevance": (float, int),
+}
+
+# Product ID path parameter; larger IDs cannot be bound to the INTEGER column (422)
+ProductId = Annotated[int, Path(le=MAX_PRODUCT_ID)]
+
+# Scope of the per-item idempotency keys of batch restocks
+RESTOCK_IDEMPOTENCY_SCOPE = "restock:batch"
+
+# Catalog export: rows fetched per round trip from the server-side cursor
+PRODUCT_EXPORT_BATCH_SIZE = int(os.getenv("PRODUCT_EXPORT_BATCH_SIZE", "1000"))
+EXPORT_FIELDS = [
+    "product_id",
+    "name",
+    "description",
+    "price",
+    "stock_quantity",
+    "image_url",
+    "created_at",
+    "updated_at",
+]
+
+# Trigram index backing match=fuzzy; availability is detected at startup
+TRIGRAM_INDEX_NAME = "ix_products_week08_example_01_name_trgm"
+trigram_search_available = False
+
 # --- FastAPI Application Setup ---
 app = FastAPI(
     title="Product Service API",
@@ -104,12 +241,109 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "Link",
+        "X-Next-Cursor",
+        "X-Missing-Product-Ids",
+        "X-DB-Queries",
+        "Server-Timing",
+        IDEMPOTENCY_REPLAYED_HEADER,
+    ],
 )
 
 
+@app.middleware("http")
+async def request_deadline_middleware(request: Request, call_next):
+    """
+    Starts the deadline of requests carrying an X-Request-Deadline-Ms budget and
+    rejects them with 504 if it is already spent. Stock deductions enforce it inside
+    their transaction (see deadline.apply_deadline_to_transaction), so a deduction
+    that overruns is rolled back rather than committed after its caller gave up.
+    """
+    budget = parse_deadline_header(request.headers.get(REQUEST_DEADLINE_HEADER))
+    if budget is None:
+        return await call_next(request)
+    if budget <= 0:
+        REQUEST_DEADLINES_EXCEEDED.labels("rejected").inc()
+        logger.warning(
+            f"Product Service: Deadline of {request.method} {request.url.path} already exceeded."
+        )
+        return JSONResponse(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            content={"detail": "Request deadline already exceeded."},
+        )
+    start_deadline(budget)
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def db_query_stats_middleware(request: Request, call_next):
+    """
+    Reports how many SQL statements a request ran and their total DB time in the
+    X-DB-Queries and Server-Timing headers, so N+1 patterns and slow queries show up
+    in browser dev tools and tests.
+    """
+    stats = start_query_stats()
+    response = await call_next(request)
+    response.headers["X-DB-Queries"] = str(stats.count)
+    response.headers["Server-Timing"] = (
+        f'db;dur={stats.duration_seconds * 1000:.1f};desc="{stats.count} queries"'
+    )
+    return response
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    # Added last so it is the outermost middleware and times the whole request
+    return await track_request_metrics(request, call_next)
+
+
+def _upgrade_existing_schema(connection):
+    """
+    create_all only creates missing tables, so columns and indexes added after a
+    products table was first created are added here. Every statement is idempotent.
+    """
+    for column_name, expression in (
+        ("search_vector", SEARCH_VECTOR_EXPRESSION),
+        ("prefix_search_vector", PREFIX_SEARCH_VECTOR_EXPRESSION),
+    ):
+        connection.execute(
+            text(
+                f"ALTER TABLE {Product.__tablename__} ADD COLUMN IF NOT EXISTS {column_name} "
+                f"tsvector GENERATED ALWAYS AS ({expression}) STORED"
+            )
+        )
+    for index in Product.__table__.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+async def _ensure_trigram_index() -> bool:
+    """
+    Installs pg_trgm and the trigram GIN index on Product.name used by match=fuzzy.
+    Kept out of the model metadata because the extension may not be installable
+    (e.g. missing contrib package or privileges); fuzzy search is disabled then.
+    """
+    try:
+        async with engine.begin() as connection:
+            await connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            await connection.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX_NAME} "
+                    f"ON {Product.__tablename__} USING gin (name gin_trgm_ops)"
+                )
+            )
+        return True
+    except Exception as e:
+        logger.warning(
+            f"Product Service: pg_trgm is not available, fuzzy product search is disabled. Error: {e}"
+        )
+        return False
+
+
 # --- FastAPI Event Handlers ---
 @app.on_event("startup")
 async def startup_event():
+    global trigram_search_available
     max_retries = 10
     retry_delay_seconds = 5
     for i in range(max_retries):
@@ -117,18 +351,22 @@ async def startup_event():
             logger.info(
                 f"Product Service: Attempting to connect to PostgreSQL and create tables (attempt {i+1}/{max_retries})..."
             )
-            Base.metadata.create_all(bind=engine)
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+                await connection.run_sync(_upgrade_existing_schema)
+            trigram_search_available = await _ensure_trigram_index()
             logger.info(
                 "Product Service: Successfully connected to PostgreSQL and ensured tables exist."
             )
             break  # Exit loop if successful
-        except OperationalError as e:
+        except (OperationalError, OSError) as e:
+            # asyncpg reports refused connections as OSError rather than a DBAPI error
             logger.warning(f"Product Service: Failed to connect to PostgreSQL: {e}")
             if i < max_retries - 1:
                 logger.info(
                     f"Product Service: Retrying in {retry_delay_seconds} seconds..."
                 )
-                time.sleep(retry_delay_seconds)
+                await asyncio.sleep(retry_delay_seconds)
             else:
                 logger.critical(
                     f"Product Service: Failed to connect to PostgreSQL after {max_retries} attempts. Exiting application."
@@ -142,6 +380,39 @@ async def startup_event():
             sys.exit(1)
 
 
+@app.on_event("startup")
+async def startup_product_change_listener():
+    app.state.product_change_listener_task = None
+    if PRODUCT_CACHE_SYNC_ENABLED and product_cache.enabled:
+        app.state.product_change_listener_task = asyncio.create_task(
+            product_change_listener.run()
+        )
+    app.state.idempotency_key_cleanup_task = None
+    if IDEMPOTENCY_KEY_CLEANUP_ENABLED:
+        app.state.idempotency_key_cleanup_task = asyncio.create_task(
+            run_idempotency_key_cleanup()
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if app.state.product_change_listener_task is not None:
+        app.state.product_change_listener_task.cancel()
+        try:
+            await app.state.product_change_listener_task
+        except asyncio.CancelledError:
+            pass
+        logger.info("Product Service: Product change listener stopped.")
+    if app.state.idempotency_key_cleanup_task is not None:
+        app.state.idempotency_key_cleanup_task.cancel()
+        try:
+            await app.state.idempotency_key_cleanup_task
+        except asyncio.CancelledError:
+            pass
+        logger.info("Product Service: Idempotency key cleanup stopped.")
+    await engine.dispose()
+
+
 # --- Root Endpoint ---
 @app.get("/", status_code=status.HTTP_200_OK, summary="Root endpoint")
 async def read_root():
@@ -154,13 +425,36 @@ async def health_check():
     return {"status": "ok", "service": "product-service"}
 
 
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get(
+    "/diagnostics/db-pool",
+    status_code=status.HTTP_200_OK,
+    summary="DB connection pool usage and checkout wait times",
+)
+async def db_pool_diagnostics():
+    return pool_diagnostics()
+
+
+@app.get(
+    "/cache/stats",
+    status_code=status.HTTP_200_OK,
+    summary="In-process product cache statistics",
+)
+async def cache_stats():
+    return product_cache.stats()
+
+
 @app.post(
     "/products/",
     response_model=ProductResponse,
     status_code=status.HTTP_201_CREATED,
     summary="Create a new product",
 )
-async def create_product(product: ProductCreate, db: Session = Depends(get_db)):
+async def create_product(product: ProductCreate, db: AsyncSession = Depends(get_db)):
     """
     Creates a new product in the database.
     """
@@ -168,14 +462,16 @@ async def create_product(product: ProductCreate, db: Session = Depends(get_db)):
     try:
         db_product = Product(**product.model_dump())
         db.add(db_product)
-        db.commit()
-        db.refresh(db_product)
+        await db.flush()
+        await notify_product_changes(db, [db_product.product_id])
+        await db.commit()
+        await db.refresh(db_product)
         logger.info(
             f"Product Service: Product '{db_product.name}' (ID: {db_product.product_id}) created successfully."
         )
         return db_product
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Product Service: Error creating product: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -183,32 +479,357 @@ async def create_product(product: ProductCreate, db: Session = Depends(get_db)):
         )
 
 
+async def _insert_product_batch(db: AsyncSession, rows: List[dict]) -> List[int]:
+    # One multi-row INSERT ... RETURNING per page of rows; no per-row refresh
+    result = await db.execute(
+        insert(Product).returning(Product.product_id, sort_by_parameter_order=True),
+        rows,
+    )
+    return list(result.scalars().all())
+
+
+@app.post(
+    "/products/bulk",
+    response_model=ProductBulkImportResponse,
+    status_code=status.HTTP_200_OK,
+    summary="Import many products from a JSON array, NDJSON or CSV upload",
+)
+async def bulk_import_products(request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Imports a product catalog in one transaction. The body is a JSON array
+    (application/json), one product per line (application/x-ndjson) or CSV with a
+    header row (text/csv) using the ProductCreate field names.
+    Every row is validated; invalid rows are reported and skipped while valid rows
+    are inserted in batches of up to BULK_IMPORT_BATCH_SIZE. The body is spooled to
+    a temporary file and parsed row by row, so large uploads are not held in memory;
+    file I/O and parsing run in the thread pool to keep the event loop free.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type.lower() not in SUPPORTED_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Unsupported content type '{content_type}'. Use one of: {', '.join(SUPPORTED_CONTENT_TYPES)}.",
+        )
+    logger.info(f"Product Service: Starting bulk product import ({content_type}).")
+
+    product_ids: List[int] = []
+    errors = []
+    error_count = 0
+    with tempfile.TemporaryFile() as body:
+        async for chunk in request.stream():
+            await run_in_threadpool(body.write, chunk)
+        body.seek(0)
+
+        try:
+            rows = iter_products(body, content_type.lower())
+            while True:
+                page = await run_in_threadpool(
+                    list, itertools.islice(rows, BULK_IMPORT_BATCH_SIZE)
+                )
+                if not page:
+                    break
+                batch: List[dict] = []
+                for row_number, product, error in page:
+                    if error is not None:
+                        error_count += 1
+                        if len(errors) < BULK_IMPORT_MAX_REPORTED_ERRORS:
+                            errors.append(error)
+                        continue
+                    batch.append(product.model_dump())
+                if batch:
+                    product_ids.extend(await _insert_product_batch(db, batch))
+            await db.commit()
+        except ValueError as e:
+            # The upload as a whole is unreadable (e.g. not a JSON array, bad encoding)
+            await db.rollback()
+            logger.warning(f"Product Service: Bulk product import rejected: {e}")
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        except Exception as e:
+            await db.rollback()
+            logger.error(
+                f"Product Service: Error during bulk product import: {e}", exc_info=True
+            )
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Could not import products. No products were created.",
+            )
+
+    logger.info(
+        f"Product Service: Bulk import created {len(product_ids)} products; rejected {error_count} rows."
+    )
+    return ProductBulkImportResponse(
+        created_count=len(product_ids),
+        product_ids=product_ids,
+        error_count=error_count,
+        errors=errors,
+    )
+
+
+def _search_criteria(search: str, match: str):
+    """
+    Builds the WHERE criterion and, for ranked modes, the relevance expression for a search.
+    Returns (criterion, rank) where rank is None for unranked modes.
+    """
+    if match == "fuzzy":
+        # Trigram word similarity tolerates typos and matches fragments of longer names.
+        # The <% operator is served by the trigram GIN index; its cut-off is the
+        # pg_trgm.word_similarity_threshold setting applied by the caller.
+        return (
+            literal(search).op("<%")(Product.name),
+            func.word_similarity(search, Product.name),
+        )
+    if match == "substring":
+        # Legacy ILIKE matching; cannot use an index
+        search_pattern = f"%{search}%"
+        return (
+            Product.name.ilike(search_pattern)
+            | Product.description.ilike(search_pattern)
+        ), None
+
+    if match == "prefix":
+        # Every word must match as a prefix, e.g. "wire mou" -> 'wire':* & 'mou':*
+        terms = re.findall(r"\w+", search)
+        if not terms:
+            return false(), None
+        tsquery = func.to_tsquery(
+            PREFIX_SEARCH_CONFIG, " & ".join(f"{term}:*" for term in terms)
+        )
+        return (
+            Product.prefix_search_vector.op("@@")(tsquery),
+            func.ts_rank(Product.prefix_search_vector, tsquery),
+        )
+    if match == "phrase":
+        tsquery = func.phraseto_tsquery(SEARCH_CONFIG, search)
+    else:
+        # Web-search syntax: "quoted phrases", OR and -exclusions
+        tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, search)
+    return (
+        Product.search_vector.op("@@")(tsquery),
+        func.ts_rank(Product.search_vector, tsquery),
+    )
+
+
+def _parse_product_ids(raw_ids: List[str]) -> List[int]:
+    """
+    Accepts repeated (?ids=1&ids=2) and comma-separated (?ids=1,2) forms.
+    Duplicates are dropped, keeping the first occurrence's position.
+    """
+    product_ids: Dict[int, None] = {}
+    for part in ",".join(raw_ids).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if not (part.isascii() and part.isdigit()) or not (
+            1 <= int(part) <= MAX_PRODUCT_ID
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid product ID '{part}'.",
+            )
+        product_ids[int(part)] = None
+    if not product_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="ids must contain at least one product ID.",
+        )
+    if len(product_ids) > PRODUCT_MULTI_GET_MAX_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {PRODUCT_MULTI_GET_MAX_IDS} product IDs can be requested at once.",
+        )
+    return list(product_ids)
+
+
+async def _get_products_by_ids(db: AsyncSession, product_ids: List[int]) -> Response:
+    """
+    Returns the requested products in request order. Cached products are served from
+    the product cache and the rest are read with a single = ANY(:ids) query; IDs that
+    do not exist are listed in the X-Missing-Product-Ids header.
+    """
+    payloads: Dict[int, bytes] = {}
+    uncached_ids = []
+    for product_id in product_ids:
+        cached_payload = product_cache.get(product_id)
+        if cached_payload is not None:
+            payloads[product_id] = cached_payload
+        else:
+            uncached_ids.append(product_id)
+
+    if uncached_ids:
+        cache_generations = {
+            product_id: product_cache.generation(product_id)
+            for product_id in uncached_ids
+        }
+        # One array parameter keeps the statement text identical for any number of IDs
+        ids_param = bindparam("ids", uncached_ids, type_=ARRAY(Integer))
+        result = await db.execute(
+            select(Product).where(Product.product_id == any_(ids_param))
+        )
+        for product in result.scalars():
+            payload = ProductResponse.model_validate(product).model_dump_json().encode()
+            product_cache.set(
+                product.product_id, payload, cache_generations[product.product_id]
+            )
+            payloads[product.product_id] = payload
+
+    found_ids = [product_id for product_id in product_ids if product_id in payloads]
+    missing_ids = [
+        product_id for product_id in product_ids if product_id not in payloads
+    ]
+    logger.info(
+        f"Product Service: Retrieved {len(found_ids)} of {len(product_ids)} requested products ({len(product_ids) - len(uncached_ids)} from cache)."
+    )
+    response = Response(
+        content=b"[" + b",".join(payloads[i] for i in found_ids) + b"]",
+        media_type="application/json",
+    )
+    if missing_ids:
+        response.headers["X-Missing-Product-Ids"] = ",".join(map(str, missing_ids))
+    return response
+
+
 @app.get(
     "/products/",
     response_model=List[ProductResponse],
     summary="Retrieve a list of all products",
 )
-def list_products(
-    db: Session = Depends(get_db),
+async def list_products(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=100),
     search: Optional[str] = Query(None, max_length=255),
+    match: Literal["fulltext", "prefix", "phrase", "substring", "fuzzy"] = Query(
+        "fulltext",
+        description="How search is matched: full-text (web-search syntax), word prefixes, exact phrase, legacy substring, or typo-tolerant fuzzy name match.",
+    ),
+    similarity_threshold: float = Query(
+        0.3,
+        ge=0,
+        le=1,
+        description="Minimum name similarity for match=fuzzy.",
+    ),
+    sort_by: Optional[Literal["product_id", "name", "relevance"]] = Query(
+        None,
+        description="Sort key; product_id breaks ties. Defaults to relevance for ranked searches, otherwise product_id.",
+    ),
+    cursor: Optional[str] = Query(
+        None,
+        max_length=1024,
+        description="Opaque cursor from a previous page's X-Next-Cursor/Link header.",
+    ),
+    ids: Optional[List[str]] = Query(
+        None,
+        description=f"Fetch these product IDs (comma-separated or repeated, at most {PRODUCT_MULTI_GET_MAX_IDS}) in request order; missing IDs are listed in X-Missing-Product-Ids.",
+    ),
 ):
     """
-    Lists products with optional pagination and search by name/description.
+    Lists products with optional pagination and search by name/description,
+    or fetches specific products by ID with ids=.
+    Searches use the full-text index (or the trigram index for match=fuzzy) and are
+    ranked by relevance unless match=substring.
+    Pages can be fetched with skip/limit or, for deep paging, with keyset cursors:
+    when more rows may follow, the response carries X-Next-Cursor and a Link rel="next" header.
     """
     logger.info(
-        f"Product Service: Listing products with skip={skip}, limit={limit}, search='{search}'"
+        f"Product Service: Listing products with skip={skip}, limit={limit}, search='{search}', match={match}, sort_by={sort_by}, cursor={'yes' if cursor else 'no'}"
     )
-    query = db.query(Product)
+    if ids is not None:
+        if search or cursor or skip or sort_by:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="ids cannot be combined with search, sort_by, skip or cursor.",
+            )
+        return await _get_products_by_ids(db, _parse_product_ids(ids))
+
+    if cursor and skip:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either skip or cursor, not both.",
+        )
+
+    query = select(Product)
+    rank = None
     if search:
-        search_pattern = f"%{search}%"
-        logger.info(f"Product Service: Applying search filter for term: {search}")
-        query = query.filter(
-            (Product.name.ilike(search_pattern))
-            | (Product.description.ilike(search_pattern))
+        logger.info(
+            f"Product Service: Applying {match} search filter for term: {search}"
+        )
+        if match == "fuzzy":
+            if not trigram_search_available:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Fuzzy search is not available: pg_trgm is not installed.",
+                )
+            # Transaction-local, so pooled connections keep the default threshold
+            await db.execute(
+                select(
+                    func.set_config(
+                        "pg_trgm.word_similarity_threshold",
+                        str(similarity_threshold),
+                        True,
+                    )
+                )
+            )
+        criterion, rank = _search_criteria(search, match)
+        query = query.where(criterion)
+
+    if sort_by is None:
+        sort_by = "relevance" if rank is not None else "product_id"
+    if sort_by == "relevance" and rank is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="sort_by=relevance requires a search with a ranked match mode.",
+        )
+
+    if cursor:
+        try:
+            last_values = decode_cursor(cursor, sort_by, CURSOR_VALUE_TYPES[sort_by])
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        if sort_by == "product_id":
+            query = query.where(Product.product_id > last_values[0])
+        elif sort_by == "relevance":
+            # Rank is descending but product_id ascending, so no row-value comparison here.
+            # Compare as REAL so the rank round-trips exactly through the cursor.
+            last_rank = cast(last_values[0], REAL)
+            query = query.where(
+                or_(
+                    rank < last_rank,
+                    and_(rank == last_rank, Product.product_id > last_values[1]),
+                )
+            )
+        else:
+            # Row-value comparison lets Postgres serve the page from the (name, product_id) index
+            query = query.where(
+                tuple_(Product.name, Product.product_id) > tuple_(*last_values)
+            )
+
+    if sort_by == "product_id":
+        query = query.order_by(Product.product_id)
+    elif sort_by == "relevance":
+        query = query.add_columns(rank.label("rank")).order_by(
+            rank.desc(), Product.product_id
+        )
+    else:
+        query = query.order_by(Product.name, Product.product_id)
+    rows = (await db.execute(query.offset(skip).limit(limit))).all()
+    products = [row[0] for row in rows]
+
+    if len(products) == limit:
+        last = products[-1]
+        if sort_by == "product_id":
+            key_values = [last.product_id]
+        elif sort_by == "relevance":
+            key_values = [rows[-1].rank, last.product_id]
+        else:
+            key_values = [last.name, last.product_id]
+        next_cursor = encode_cursor(sort_by, key_values)
+        next_url = request.url.remove_query_params("skip").include_query_params(
+            cursor=next_cursor
         )
-    products = query.offset(skip).limit(limit).all()
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
 
     logger.info(
         f"Product Service: Retrieved {len(products)} products (skip={skip}, limit={limit})."
@@ -216,14 +837,106 @@ def list_products(
     return products
 
 
+async def _export_product_chunks(export_format: str) -> AsyncIterator[bytes]:
+    """
+    Streams the catalog from a server-side cursor, one encoded chunk per fetched
+    batch, so memory use does not grow with the catalog size. Uses its own session
+    because request-scoped sessions are closed before a streamed body is sent.
+    """
+    query = (
+        select(*(getattr(Product, field) for field in EXPORT_FIELDS))
+        .order_by(Product.product_id)
+        .execution_options(yield_per=PRODUCT_EXPORT_BATCH_SIZE)
+    )
+    exported = 0
+    try:
+        async with SessionLocal() as db:
+            result = await db.stream(query)
+            if export_format == "csv":
+                yield (",".join(EXPORT_FIELDS) + "\r\n").encode()
+            async for rows in result.partitions():
+                products = [ProductResponse.model_validate(row) for row in rows]
+                if export_format == "csv":
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    for product in products:
+                        values = product.model_dump(mode="json")
+                        writer.writerow(values[field] for field in EXPORT_FIELDS)
+                    yield buffer.getvalue().encode()
+                else:
+                    yield "".join(
+                        product.model_dump_json() + "\n" for product in products
+                    ).encode()
+                exported += len(products)
+    except Exception as e:
+        # Headers are already sent, so the client sees a truncated body
+        logger.error(
+            f"Product Service: Product export failed after {exported} rows: {e}",
+            exc_info=True,
+        )
+        raise
+    logger.info(f"Product Service: Exported {exported} products as {export_format}.")
+
+
+async def _gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00")
+    return False
+
+
+@app.get(
+    "/products/export",
+    summary="Stream the full product catalog as NDJSON or CSV",
+    response_class=StreamingResponse,
+)
+async def export_products(
+    request: Request,
+    export_format: Literal["ndjson", "csv"] = Query(
+        "ndjson", alias="format", description="Output format."
+    ),
+):
+    """
+    Streams every product ordered by product_id, for search indexers and BI dumps.
+    The body is gzip-compressed when the client sends Accept-Encoding: gzip.
+    """
+    logger.info(f"Product Service: Starting product export as {export_format}.")
+    chunks = _export_product_chunks(export_format)
+    headers = {
+        "Content-Disposition": f'attachment; filename="products.{export_format}"',
+        "Vary": "Accept-Encoding",
+    }
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        chunks = _gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
 @app.get(
     "/products/{product_id}",
     response_model=ProductResponse,
     summary="Retrieve a single product by ID",
 )
-def get_product(product_id: int, db: Session = Depends(get_db)):
+async def get_product(product_id: ProductId, db: AsyncSession = Depends(get_db)):
+    cached_payload = product_cache.get(product_id)
+    if cached_payload is not None:
+        # Served from the in-process cache without touching the DB pool
+        return Response(content=cached_payload, media_type="application/json")
+
     logger.info(f"Product Service: Fetching product with ID: {product_id}")
-    product = db.query(Product).filter(Product.product_id == product_id).first()
+    cache_generation = product_cache.generation(product_id)
+    product = await db.get(Product, product_id)
     if not product:
         logger.warning(f"Product Service: Product with ID {product_id} not found.")
         raise HTTPException(
@@ -232,7 +945,9 @@ def get_product(product_id: int, db: Session = Depends(get_db)):
     logger.info(
         f"Product Service: Retrieved product with ID {product_id}. Name: {product.name}"
     )
-    return product
+    payload = ProductResponse.model_validate(product).model_dump_json().encode()
+    product_cache.set(product_id, payload, cache_generation)
+    return Response(content=payload, media_type="application/json")
 
 
 @app.put(
@@ -241,12 +956,12 @@ def get_product(product_id: int, db: Session = Depends(get_db)):
     summary="Update an existing product by ID",
 )
 async def update_product(
-    product_id: int, product: ProductUpdate, db: Session = Depends(get_db)
+    product_id: ProductId, product: ProductUpdate, db: AsyncSession = Depends(get_db)
 ):
     logger.info(
         f"Product Service: Updating product with ID: {product_id} with data: {product.model_dump(exclude_unset=True)}"
     )
-    db_product = db.query(Product).filter(Product.product_id == product_id).first()
+    db_product = await db.get(Product, product_id)
     if not db_product:
         logger.warning(
             f"Product Service: Attempted to update non-existent product with ID {product_id}."
@@ -261,12 +976,14 @@ async def update_product(
 
     try:
         db.add(db_product)  # Mark for update
-        db.commit()
-        db.refresh(db_product)
+        await notify_product_changes(db, [product_id])
+        await db.commit()
+        product_cache.invalidate(product_id)
+        await db.refresh(db_product)
         logger.info(f"Product Service: Product {product_id} updated successfully.")
         return db_product
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Product Service: Error updating product {product_id}: {e}", exc_info=True
         )
@@ -281,13 +998,13 @@ async def update_product(
     status_code=status.HTTP_204_NO_CONTENT,
     summary="Delete a product by ID",
 )
-def delete_product(product_id: int, db: Session = Depends(get_db)):
+async def delete_product(product_id: ProductId, db: AsyncSession = Depends(get_db)):
     """
     Deletes a product record from the database.
     Does NOT delete the image from Azure Blob Storage.
     """
     logger.info(f"Product Service: Attempting to delete product with ID: {product_id}")
-    product = db.query(Product).filter(Product.product_id == product_id).first()
+    product = await db.get(Product, product_id)
     if not product:
         logger.warning(
             f"Product Service: Attempted to delete non-existent product with ID {product_id}."
@@ -297,13 +1014,15 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
         )
 
     try:
-        db.delete(product)
-        db.commit()
+        await db.delete(product)
+        await notify_product_changes(db, [product_id])
+        await db.commit()
+        product_cache.invalidate(product_id)
         logger.info(
             f"Product Service: Product {product_id} deleted successfully. Name: {product.name}"
         )
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Product Service: Error deleting product {product_id}: {e}", exc_info=True
         )
@@ -320,7 +1039,9 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
     summary="Upload an image for a product to Azure Blob Storage",
 )
 async def upload_product_image(
-    product_id: int, file: UploadFile = File(...), db: Session = Depends(get_db)
+    product_id: ProductId,
+    file: UploadFile = File(...),
+    db: AsyncSession = Depends(get_db),
 ):
     """
     Uploads an image file to Azure Blob Storage and updates the product's image_url in the database.
@@ -333,7 +1054,7 @@ async def upload_product_image(
             detail="Azure Blob Storage is not configured or available.",
         )
 
-    db_product = db.query(Product).filter(Product.product_id == product_id).first()
+    db_product = await db.get(Product, product_id)
     if not db_product:
         logger.warning(
             f"Product Service: Product with ID {product_id} not found for image upload."
@@ -370,7 +1091,9 @@ async def upload_product_image(
 
         # Upload the file content directly
         # Use stream=True for large files
-        blob_client.upload_blob(
+        # The Azure SDK client is blocking, so keep it off the event loop
+        await run_in_threadpool(
+            blob_client.upload_blob,
             file.file,
             overwrite=True,
             content_settings=ContentSettings(content_type=file.content_type),
@@ -392,8 +1115,10 @@ async def upload_product_image(
         # Update the product in the database with the image URL (including SAS token)
         db_product.image_url = image_url
         db.add(db_product)
-        db.commit()
-        db.refresh(db_product)
+        await notify_product_changes(db, [product_id])
+        await db.commit()
+        product_cache.invalidate(product_id)
+        await db.refresh(db_product)
 
         logger.info(
             f"Product Service: Image uploaded and product {product_id} updated with SAS URL: {image_url}"
@@ -401,7 +1126,7 @@ async def upload_product_image(
         return db_product
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Product Service: Error uploading image for product {product_id}: {e}",
             exc_info=True,
@@ -419,59 +1144,387 @@ async def upload_product_image(
     summary="Deduct stock quantity for a product",
 )
 async def deduct_product_stock(
-    product_id: int, request: StockDeductRequest, db: Session = Depends(get_db)
+    product_id: ProductId,
+    request: StockDeductRequest,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER),
 ):
     """
     Deducts a specified quantity from a product's stock.
     Returns 404 if product not found, 400 if insufficient stock.
+    A retry with the same Idempotency-Key gets the first response back without
+    deducting again; failed deductions are not stored and can be retried.
     """
     logger.info(
         f"Product Service: Attempting to deduct {request.quantity_to_deduct} from stock for product ID: {product_id}"
     )
-    db_product = db.query(Product).filter(Product.product_id == product_id).first()
+    await apply_deadline_to_transaction(db)
+    if idempotency_key is not None:
+        replay = await begin_idempotent_request(
+            db,
+            "deduct-stock",
+            idempotency_key,
+            {"product_id": product_id, **request.model_dump()},
+        )
+        if replay is not None:
+            return replay
+    # Single conditional UPDATE: the row lock is held only for the statement itself and
+    # concurrent deductions can never drive stock below zero (no read-modify-write race).
+    deduct_stmt = (
+        update(Product)
+        .where(
+            Product.product_id == product_id,
+            Product.stock_quantity >= request.quantity_to_deduct,
+        )
+        .values(stock_quantity=Product.stock_quantity - request.quantity_to_deduct)
+        .returning(Product)
+    )
 
-    if not db_product:
-        logger.warning(
-            f"Product Service: Stock deduction failed: Product with ID {product_id} not found."
+    try:
+        db_product = (await db.execute(deduct_stmt)).scalar_one_or_none()
+        if db_product is not None:
+            product_response = ProductResponse.model_validate(db_product)
+            if idempotency_key is not None:
+                # Stored in the deduction's transaction: both commit or neither does
+                await save_idempotent_response(
+                    db,
+                    "deduct-stock",
+                    idempotency_key,
+                    status.HTTP_200_OK,
+                    product_response.model_dump_json(),
+                )
+            await notify_product_changes(db, [product_id])
+            check_deadline()
+            await db.commit()
+            product_cache.invalidate(product_id)
+    except Exception as e:
+        await db.rollback()
+        check_deadline()  # Cancelled by the deadline's statement_timeout, or too late
+        logger.error(
+            f"Product Service: Error deducting stock for product {product_id}: {e}",
+            exc_info=True,
         )
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Product not found"
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not deduct stock.",
         )
 
-    if db_product.stock_quantity < request.quantity_to_deduct:
+    if db_product is None:
+        # The UPDATE matched nothing: find out whether the product is missing or short on stock.
+        existing = (
+            await db.execute(
+                select(Product.name, Product.stock_quantity).where(
+                    Product.product_id == product_id
+                )
+            )
+        ).first()
+        if not existing:
+            logger.warning(
+                f"Product Service: Stock deduction failed: Product with ID {product_id} not found."
+            )
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Product not found"
+            )
         logger.warning(
-            f"Product Service: Stock deduction failed for product {product_id}. Insufficient stock: {db_product.stock_quantity} available, {request.quantity_to_deduct} requested."
+            f"Product Service: Stock deduction failed for product {product_id}. Insufficient stock: {existing.stock_quantity} available, {request.quantity_to_deduct} requested."
         )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Insufficient stock for product '{db_product.name}'. Only {db_product.stock_quantity} available.",
+            detail=f"Insufficient stock for product '{existing.name}'. Only {existing.stock_quantity} available.",
+        )
+
+    logger.info(
+        f"Product Service: Stock for product {product_id} updated to {product_response.stock_quantity}. Deducted {request.quantity_to_deduct}."
+    )
+
+    # Optional: Log or trigger alert if stock falls below threshold
+    if product_response.stock_quantity < RESTOCK_THRESHOLD:
+        logger.warning(
+            f"Product Service: ALERT! Stock for product '{product_response.name}' (ID: {product_response.product_id}) is low: {product_response.stock_quantity}."
         )
 
-    # Perform deduction
-    db_product.stock_quantity -= request.quantity_to_deduct
+    return product_response
+
+
+@app.post(
+    "/products/deduct-stock:batch",
+    response_model=List[ProductResponse],
+    summary="Deduct stock for several products in one transaction",
+)
+async def deduct_product_stock_batch(
+    request: StockBatchDeductRequest,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER),
+):
+    """
+    Deducts stock for every requested product, all or nothing.
+    Rows are locked in ascending product_id order so concurrent batches cannot deadlock.
+    Returns 404 if any product is not found, 400 if any product has insufficient stock.
+    A retry with the same Idempotency-Key gets the first response back without
+    deducting again.
+    """
+    quantities: Dict[int, int] = defaultdict(int)
+    for item in request.items:
+        quantities[item.product_id] += item.quantity_to_deduct
+    product_ids = sorted(quantities)
+    logger.info(
+        f"Product Service: Attempting batch stock deduction for product IDs: {product_ids}"
+    )
+    await apply_deadline_to_transaction(db)
+    if idempotency_key is not None:
+        replay = await begin_idempotent_request(
+            db, "deduct-stock:batch", idempotency_key, request.model_dump()
+        )
+        if replay is not None:
+            return replay
 
     try:
-        db.add(db_product)
-        db.commit()
-        db.refresh(db_product)
-        logger.info(
-            f"Product Service: Stock for product {product_id} updated to {db_product.stock_quantity}. Deducted {request.quantity_to_deduct}."
+        locked_rows = (
+            await db.execute(
+                select(Product.product_id, Product.name, Product.stock_quantity)
+                .where(Product.product_id.in_(product_ids))
+                .order_by(Product.product_id)
+                .with_for_update()
+            )
+        ).all()
+    except Exception as e:
+        await db.rollback()
+        check_deadline()
+        logger.error(
+            f"Product Service: Error locking products for batch stock deduction: {e}",
+            exc_info=True,
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not deduct stock.",
         )
 
-        # Optional: Log or trigger alert if stock falls below threshold
-        if db_product.stock_quantity < RESTOCK_THRESHOLD:
+    found = {row.product_id: row for row in locked_rows}
+    missing_ids = [product_id for product_id in product_ids if product_id not in found]
+    if missing_ids:
+        logger.warning(
+            f"Product Service: Batch stock deduction failed: Products not found: {missing_ids}."
+        )
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Products not found: {', '.join(map(str, missing_ids))}",
+        )
+
+    for row in locked_rows:
+        if row.stock_quantity < quantities[row.product_id]:
             logger.warning(
-                f"Product Service: ALERT! Stock for product '{db_product.name}' (ID: {db_product.product_id}) is low: {db_product.stock_quantity}."
+                f"Product Service: Batch stock deduction failed for product {row.product_id}. Insufficient stock: {row.stock_quantity} available, {quantities[row.product_id]} requested."
+            )
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Insufficient stock for product '{row.name}'. Only {row.stock_quantity} available.",
             )
 
-        return db_product
+    # One UPDATE ... FROM (VALUES ...) for the whole batch; the rows are already locked above.
+    deductions = values(
+        column("product_id", Integer), column("quantity", Integer), name="deductions"
+    ).data(sorted(quantities.items()))
+    deduct_stmt = (
+        update(Product)
+        .where(Product.product_id == deductions.c.product_id)
+        .values(stock_quantity=Product.stock_quantity - deductions.c.quantity)
+        .returning(Product)
+        .execution_options(synchronize_session=False)
+    )
+
+    try:
+        db_products = (await db.execute(deduct_stmt)).scalars().all()
+        product_responses = sorted(
+            (ProductResponse.model_validate(p) for p in db_products),
+            key=lambda p: p.product_id,
+        )
+        if idempotency_key is not None:
+            await save_idempotent_response(
+                db,
+                "deduct-stock:batch",
+                idempotency_key,
+                status.HTTP_200_OK,
+                "[" + ",".join(p.model_dump_json() for p in product_responses) + "]",
+            )
+        await notify_product_changes(db, product_ids)
+        check_deadline()
+        await db.commit()
+        product_cache.invalidate(*product_ids)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
+        check_deadline()
         logger.error(
-            f"Product Service: Error deducting stock for product {product_id}: {e}",
-            exc_info=True,
+            f"Product Service: Error during batch stock deduction: {e}", exc_info=True
         )
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Could not deduct stock.",
         )
+
+    logger.info(
+        f"Product Service: Batch stock deduction successful for product IDs: {product_ids}."
+    )
+    for product in product_responses:
+        if product.stock_quantity < RESTOCK_THRESHOLD:
+            logger.warning(
+                f"Product Service: ALERT! Stock for product '{product.name}' (ID: {product.product_id}) is low: {product.stock_quantity}."
+            )
+
+    return product_responses
+
+
+# --- Endpoints for Stock Restock (compensation of earlier deductions) ---
+@app.patch(
+    "/products/{product_id}/restock",
+    response_model=ProductResponse,
+    summary="Add stock quantity back to a product",
+)
+async def restock_product(
+    product_id: ProductId,
+    request: StockRestockRequest,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Adds a specified quantity to a product's stock, e.g. to compensate a deduction
+    for an order that could not be completed. Returns 404 if product not found.
+    """
+    logger.info(
+        f"Product Service: Attempting to restock {request.quantity_to_add} for product ID: {product_id}"
+    )
+    restock_stmt = (
+        update(Product)
+        .where(Product.product_id == product_id)
+        .values(stock_quantity=Product.stock_quantity + request.quantity_to_add)
+        .returning(Product)
+    )
+
+    try:
+        db_product = (await db.execute(restock_stmt)).scalar_one_or_none()
+        if db_product is not None:
+            product_response = ProductResponse.model_validate(db_product)
+            await notify_product_changes(db, [product_id])
+            await db.commit()
+            product_cache.invalidate(product_id)
+    except Exception as e:
+        await db.rollback()
+        logger.error(
+            f"Product Service: Error restocking product {product_id}: {e}",
+            exc_info=True,
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not restock product.",
+        )
+
+    if db_product is None:
+        logger.warning(
+            f"Product Service: Restock failed: Product with ID {product_id} not found."
+        )
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Product not found"
+        )
+
+    logger.info(
+        f"Product Service: Stock for product {product_id} updated to {product_response.stock_quantity}. Added {request.quantity_to_add}."
+    )
+    return product_response
+
+
+@app.post(
+    "/products/restock:batch",
+    response_model=StockBatchRestockResponse,
+    summary="Add stock back to several products in one transaction",
+)
+async def restock_product_batch(
+    request: StockBatchRestockRequest, db: AsyncSession = Depends(get_db)
+):
+    """
+    Adds stock back to every requested product in one transaction.
+    Products that no longer exist are skipped and reported in missing_product_ids,
+    so callers draining a compensation queue can settle them instead of retrying forever.
+    Items carrying an idempotency_key are applied only once: when a retried batch
+    repeats them, they are skipped. A key may appear only once per batch (422) and
+    must not have been used for a different item before (409).
+    """
+    logger.info(
+        f"Product Service: Attempting batch restock for product IDs: {sorted({item.product_id for item in request.items})}"
+    )
+    keyed_items = {}
+    for item in request.items:
+        if item.idempotency_key is None:
+            continue
+        if item.idempotency_key in keyed_items:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Idempotency key '{item.idempotency_key}' appears more than once in the batch.",
+            )
+        keyed_items[item.idempotency_key] = item.model_dump()
+
+    try:
+        new_keys = await claim_idempotency_keys(
+            db, RESTOCK_IDEMPOTENCY_SCOPE, keyed_items
+        )
+        quantities: Dict[int, int] = defaultdict(int)
+        for item in request.items:
+            if (
+                item.idempotency_key is not None
+                and item.idempotency_key not in new_keys
+            ):
+                continue  # Applied by an earlier request
+            quantities[item.product_id] += item.quantity_to_add
+        product_ids = sorted(quantities)
+
+        product_responses = []
+        if product_ids:
+            # Lock in ascending product_id order, like batch deductions, to avoid deadlocks
+            await db.execute(
+                select(Product.product_id)
+                .where(Product.product_id.in_(product_ids))
+                .order_by(Product.product_id)
+                .with_for_update()
+            )
+            restocks = values(
+                column("product_id", Integer),
+                column("quantity", Integer),
+                name="restocks",
+            ).data(sorted(quantities.items()))
+            restock_stmt = (
+                update(Product)
+                .where(Product.product_id == restocks.c.product_id)
+                .values(stock_quantity=Product.stock_quantity + restocks.c.quantity)
+                .returning(Product)
+                .execution_options(synchronize_session=False)
+            )
+            db_products = (await db.execute(restock_stmt)).scalars().all()
+            product_responses = sorted(
+                (ProductResponse.model_validate(p) for p in db_products),
+                key=lambda p: p.product_id,
+            )
+            await notify_product_changes(db, product_ids)
+        await db.commit()
+        product_cache.invalidate(*product_ids)
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Product Service: Error during batch restock: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not restock products.",
+        )
+
+    restocked_ids = {product.product_id for product in product_responses}
+    missing_ids = [
+        product_id for product_id in product_ids if product_id not in restocked_ids
+    ]
+    if missing_ids:
+        logger.warning(
+            f"Product Service: Batch restock skipped missing products: {missing_ids}."
+        )
+    logger.info(
+        f"Product Service: Batch restock successful for product IDs: {sorted(restocked_ids)}."
+    )
+    return StockBatchRestockResponse(
+        restocked=product_responses, missing_product_ids=missing_ids
+    )
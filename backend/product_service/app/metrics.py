@@ -0,0 +1,141 @@
+# week08/backend/product_service/app/metrics.py
+
+import time
+
+from fastapi import Request
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+
+from .cache import TTLCache
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of HTTP requests by route template.",
+    ["method", "route", "status_code"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests currently being handled.", ["method"]
+)
+REQUEST_EXCEPTIONS = Counter(
+    "http_request_exceptions_total",
+    "Requests that ended in an unhandled exception.",
+    ["method", "route"],
+)
+REQUEST_DEADLINES_EXCEEDED = Counter(
+    "http_request_deadlines_exceeded_total",
+    "Requests answered with 504 because the caller's deadline ran out (rejected on arrival or aborted before commit).",
+    ["outcome"],
+)
+
+
+def _route_template(request: Request) -> str:
+    # The matched route's path keeps label cardinality bounded (/products/{product_id})
+    route = request.scope.get("route")
+    return getattr(route, "path", "<unmatched>")
+
+
+async def track_request_metrics(request: Request, call_next):
+    """
+    HTTP middleware body recording latency per route template and in-flight requests.
+    """
+    method = request.method
+    REQUESTS_IN_PROGRESS.labels(method).inc()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        REQUEST_EXCEPTIONS.labels(method, _route_template(request)).inc()
+        raise
+    finally:
+        REQUESTS_IN_PROGRESS.labels(method).dec()
+    REQUEST_LATENCY.labels(
+        method, _route_template(request), str(response.status_code)
+    ).observe(time.perf_counter() - start)
+    return response
+
+
+class DatabasePoolCollector:
+    """
+    Reads the SQLAlchemy pool counters at scrape time, so no bookkeeping runs per checkout.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def collect(self):
+        pool = self.engine.pool
+        for name, documentation, value in (
+            ("db_pool_size", "Configured size of the DB pool.", pool.size()),
+            (
+                "db_pool_checked_out_connections",
+                "DB connections currently checked out of the pool.",
+                pool.checkedout(),
+            ),
+            (
+                "db_pool_checked_in_connections",
+                "Idle DB connections held in the pool.",
+                pool.checkedin(),
+            ),
+            (
+                "db_pool_overflow_connections",
+                "DB connections open beyond the pool size (negative while the pool is not yet full).",
+                pool.overflow(),
+            ),
+        ):
+            yield GaugeMetricFamily(name, documentation, value=value)
+        wait_stats = pool.wait_stats
+        yield CounterMetricFamily(
+            "db_pool_checkouts",
+            "DB connections checked out of the pool.",
+            value=wait_stats.checkouts,
+        )
+        yield CounterMetricFamily(
+            "db_pool_checkout_wait_seconds",
+            "Total time spent waiting to check out DB connections.",
+            value=wait_stats.total_wait_seconds,
+        )
+        yield CounterMetricFamily(
+            "db_pool_checkout_timeouts",
+            "Checkouts that gave up after the pool timeout.",
+            value=wait_stats.timeouts,
+        )
+
+
+class ProductCacheCollector:
+    """
+    Exposes the in-process product cache counters kept by TTLCache.
+    """
+
+    def __init__(self, cache: TTLCache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        yield CounterMetricFamily(
+            "product_cache_hits", "Product cache lookups served.", value=stats["hits"]
+        )
+        yield CounterMetricFamily(
+            "product_cache_misses",
+            "Product cache lookups that went to the DB.",
+            value=stats["misses"],
+        )
+        yield CounterMetricFamily(
+            "product_cache_evictions",
+            "Product cache entries evicted by the size bound.",
+            value=stats["evictions"],
+        )
+        yield GaugeMetricFamily(
+            "product_cache_hit_ratio",
+            "Share of product cache lookups served since start.",
+            value=stats["hit_ratio"],
+        )
+        yield GaugeMetricFamily(
+            "product_cache_entries",
+            "Entries in the product cache.",
+            value=stats["entries"],
+        )
+
+
+def register_collectors(engine, cache: TTLCache):
+    REGISTRY.register(DatabasePoolCollector(engine))
+    REGISTRY.register(ProductCacheCollector(cache))
@@ -1,11 +1,39 @@
 # week08/backend/product_service/app/models.py
 
-from sqlalchemy import Column, DateTime, Integer, Numeric, String, Text
+from sqlalchemy import (
+    Column,
+    Computed,
+    DateTime,
+    Index,
+    Integer,
+    Numeric,
+    String,
+    Text,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 from sqlalchemy.sql import func
 
 from .db import Base
 
 
+def _search_vector_expression(config: str) -> str:
+    return (
+        f"setweight(to_tsvector('{config}', coalesce(name, '')), 'A') || "
+        f"setweight(to_tsvector('{config}', coalesce(description, '')), 'B')"
+    )
+
+
+# Text search configuration and document used for product full-text search.
+# Name matches are weighted above description matches when ranking.
+SEARCH_CONFIG = "english"
+SEARCH_VECTOR_EXPRESSION = _search_vector_expression(SEARCH_CONFIG)
+# Prefix search matches what was typed against unstemmed words, stop words included:
+# stemming would turn "runnin:*" into 'runnin' while "Running" is stored as 'run'
+PREFIX_SEARCH_CONFIG = "simple"
+PREFIX_SEARCH_VECTOR_EXPRESSION = _search_vector_expression(PREFIX_SEARCH_CONFIG)
+
+
 class Product(Base):
     # Name of the database table
     __tablename__ = "products_week08_example_01"
@@ -17,7 +45,55 @@ class Product(Base):
     image_url = Column(String(2048), nullable=True)  # URL can be long
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    # Maintained by Postgres; deferred so regular reads never load it
+    search_vector = deferred(
+        Column(TSVECTOR, Computed(SEARCH_VECTOR_EXPRESSION, persisted=True))
+    )
+    prefix_search_vector = deferred(
+        Column(TSVECTOR, Computed(PREFIX_SEARCH_VECTOR_EXPRESSION, persisted=True))
+    )
+
+    __table_args__ = (
+        # Serves keyset pagination ordered by (name, product_id)
+        Index("ix_products_week08_example_01_name_product_id", "name", "product_id"),
+        Index(
+            "ix_products_week08_example_01_search_vector",
+            "search_vector",
+            postgresql_using="gin",
+        ),
+        Index(
+            "ix_products_week08_example_01_prefix_search_vector",
+            "prefix_search_vector",
+            postgresql_using="gin",
+        ),
+    )
 
     def __repr__(self):
         # A helpful representation when debugging
         return f"<Product(id={self.product_id}, name='{self.name}', stock={self.stock_quantity}, image_url='{self.image_url[:30] if self.image_url else 'None'}...')>"
+
+
+class IdempotencyKey(Base):
+    """
+    Responses stored per client-supplied Idempotency-Key, so a retried request is
+    answered from here instead of being executed twice. Rows expire after a TTL.
+    """
+
+    __tablename__ = "idempotency_keys_week08_example_01"
+
+    # Endpoint the key was used on; the same key may be reused on other endpoints
+    scope = Column(String(50), primary_key=True)
+    idempotency_key = Column(String(255), primary_key=True)
+    # SHA-256 of the request, to reject a key reused with a different request
+    request_hash = Column(String(64), nullable=False)
+    # in_progress -> completed; in-progress rows are only visible while a request runs
+    status = Column(String(20), nullable=False, default="in_progress")
+    response_status_code = Column(Integer, nullable=True)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey(scope='{self.scope}', key='{self.idempotency_key}', status='{self.status}')>"
@@ -0,0 +1,93 @@
+# week08/backend/product_service/app/notifications.py
+
+import asyncio
+import logging
+from typing import Iterable, List
+
+import asyncpg
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import TTLCache
+from .db import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_CHANGES_CHANNEL = "product_changes"
+# NOTIFY payloads are limited to 8000 bytes, so large batches are split
+MAX_IDS_PER_NOTIFICATION = 500
+
+
+async def notify_product_changes(db: AsyncSession, product_ids: Iterable[int]):
+    """
+    Queues a NOTIFY with the changed product IDs on the session's transaction.
+    Postgres delivers it only when the transaction commits, so listeners never
+    evict for a write that was rolled back.
+    """
+    ids = sorted(set(product_ids))
+    for start in range(0, len(ids), MAX_IDS_PER_NOTIFICATION):
+        payload = ",".join(map(str, ids[start : start + MAX_IDS_PER_NOTIFICATION]))
+        await db.execute(select(func.pg_notify(PRODUCT_CHANGES_CHANNEL, payload)))
+
+
+def _parse_product_ids(payload: str) -> List[int]:
+    return [int(part) for part in payload.split(",") if part.strip().isdigit()]
+
+
+class ProductChangeListener:
+    """
+    Keeps a dedicated LISTEN connection open and evicts changed products from the
+    local cache, so every worker and replica drops stale entries right after a
+    write commits anywhere. After (re)connecting the whole cache is cleared,
+    because notifications sent while disconnected are lost.
+    """
+
+    def __init__(
+        self,
+        cache: TTLCache,
+        reconnect_max_delay_seconds: float = 30,
+        health_check_interval_seconds: float = 10,
+    ):
+        self.cache = cache
+        self.reconnect_max_delay_seconds = reconnect_max_delay_seconds
+        self.health_check_interval_seconds = health_check_interval_seconds
+        self.connected = False
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self.cache.invalidate(*_parse_product_ids(payload))
+
+    async def run(self):
+        delay = 1.0
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(DATABASE_URL)
+                await connection.add_listener(
+                    PRODUCT_CHANGES_CHANNEL, self._on_notification
+                )
+                self.cache.clear()
+                self.connected = True
+                delay = 1.0
+                logger.info(
+                    f"Product Service: Listening for product changes on '{PRODUCT_CHANGES_CHANNEL}'."
+                )
+                # An idle connection only notices a dropped socket when it is used,
+                # so probe it periodically instead of waiting on it forever
+                while True:
+                    await asyncio.sleep(self.health_check_interval_seconds)
+                    await asyncio.wait_for(
+                        connection.execute("SELECT 1"),
+                        timeout=self.health_check_interval_seconds,
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(
+                    f"Product Service: Product change listener disconnected, retrying in {delay:.0f}s. Error: {e}"
+                )
+            finally:
+                self.connected = False
+                if connection is not None:
+                    connection.terminate()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.reconnect_max_delay_seconds)
@@ -0,0 +1,48 @@
+# week08/backend/product_service/app/pagination.py
+
+import base64
+import binascii
+import json
+from typing import Any, List, Sequence
+
+# Integer key values must fit the 32-bit INTEGER columns they are compared with
+_INTEGER_MIN, _INTEGER_MAX = -(2**31), 2**31 - 1
+
+
+def encode_cursor(sort: str, values: List[Any]) -> str:
+    """
+    Encodes the sort key and the last row's key values into an opaque, URL-safe cursor.
+    """
+    payload = json.dumps({"s": sort, "v": values}, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def _has_type(value: Any, value_type: type) -> bool:
+    if isinstance(value, bool):
+        return False
+    if value_type is int:
+        return isinstance(value, int) and _INTEGER_MIN <= value <= _INTEGER_MAX
+    if value_type is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, value_type)
+
+
+def decode_cursor(cursor: str, sort: str, value_types: Sequence[type]) -> List[Any]:
+    """
+    Decodes a cursor produced by encode_cursor for the given sort key.
+    Raises ValueError if the cursor is malformed, was issued for another sort key or
+    does not hold one value of each of value_types, so forged cursors cannot reach SQL.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError("Malformed cursor.") from e
+    if not isinstance(payload, dict) or not isinstance(payload.get("v"), list):
+        raise ValueError("Malformed cursor.")
+    if payload.get("s") != sort:
+        raise ValueError(f"Cursor was not issued for sort '{sort}'.")
+    values = payload["v"]
+    if len(values) != len(value_types) or not all(map(_has_type, values, value_types)):
+        raise ValueError("Malformed cursor.")
+    return values
@@ -1,9 +1,12 @@
 # week08/backend/product_service/app/schemas.py
 
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel, ConfigDict, Field
 
+# product_id is a 32-bit INTEGER column; larger IDs cannot be bound as parameters
+MAX_PRODUCT_ID = 2**31 - 1
+
 
 class ProductBase(BaseModel):
     name: str = Field(..., min_length=1, max_length=255)
@@ -40,3 +43,77 @@ class StockDeductRequest(BaseModel):
     quantity_to_deduct: int = Field(
         ..., gt=0, description="Quantity of product to deduct from stock."
     )
+
+
+class StockDeductItem(BaseModel):
+    product_id: int = Field(
+        ..., ge=1, le=MAX_PRODUCT_ID, description="ID of the product to deduct from."
+    )
+    quantity_to_deduct: int = Field(
+        ..., gt=0, description="Quantity of product to deduct from stock."
+    )
+
+
+class StockBatchDeductRequest(BaseModel):
+    items: List[StockDeductItem] = Field(
+        ...,
+        min_length=1,
+        description="Products and quantities to deduct, applied all or nothing.",
+    )
+
+
+class StockRestockRequest(BaseModel):
+    quantity_to_add: int = Field(
+        ..., gt=0, description="Quantity of product to add back to stock."
+    )
+
+
+class StockRestockItem(BaseModel):
+    product_id: int = Field(
+        ..., ge=1, le=MAX_PRODUCT_ID, description="ID of the product to restock."
+    )
+    quantity_to_add: int = Field(
+        ..., gt=0, description="Quantity of product to add back to stock."
+    )
+    idempotency_key: Optional[str] = Field(
+        None,
+        min_length=1,
+        max_length=255,
+        description="Applies the item only once, however often it is sent.",
+    )
+
+
+class StockBatchRestockRequest(BaseModel):
+    items: List[StockRestockItem] = Field(
+        ..., min_length=1, description="Products and quantities to add back to stock."
+    )
+
+
+class StockBatchRestockResponse(BaseModel):
+    restocked: List[ProductResponse]
+    missing_product_ids: List[int] = Field(
+        default_factory=list,
+        description="Requested products that no longer exist and were skipped.",
+    )
+
+
+class ProductBulkImportFieldError(BaseModel):
+    field: Optional[str] = None
+    message: str
+
+
+class ProductBulkImportError(BaseModel):
+    row: int = Field(..., description="1-based position of the row in the upload.")
+    errors: List[ProductBulkImportFieldError]
+
+
+class ProductBulkImportResponse(BaseModel):
+    created_count: int
+    product_ids: List[int] = Field(
+        ..., description="IDs of the created products, in upload order."
+    )
+    error_count: int
+    errors: List[ProductBulkImportError] = Field(
+        ...,
+        description="Rejected rows, capped at the first BULK_IMPORT_MAX_REPORTED_ERRORS.",
+    )
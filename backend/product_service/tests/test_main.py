@@ -1,18 +1,28 @@
 # week08/backend/product_service/tests/test_main.py
 
+import asyncio
+import csv
+import io
+import json
 import logging
 import os
 import time
+from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock, patch
 
+import httpx
 import pytest
-from app.db import SessionLocal, engine, get_db
-from app.main import app
-from app.models import Base, Product
+from app.cache import TTLCache
+from app.db import DATABASE_URL
+from app.main import app, product_cache, product_change_listener
+from app.models import Base, IdempotencyKey, Product
+from app.notifications import PRODUCT_CHANGES_CHANNEL
+from app.pagination import encode_cursor
 
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 
 # Suppress noisy logs from SQLAlchemy/FastAPI during tests for cleaner output
 logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
@@ -21,6 +31,11 @@ logging.getLogger("uvicorn.error").setLevel(logging.WARNING)
 logging.getLogger("fastapi").setLevel(logging.WARNING)
 logging.getLogger("app.main").setLevel(logging.WARNING)  # Suppress app's own info logs
 
+# The app talks to Postgres through its async engine; tests set up and inspect the
+# database through a plain synchronous engine on the same database.
+engine = create_engine(DATABASE_URL)
+TestSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
 
 # --- Pytest Fixtures ---
 @pytest.fixture(scope="session", autouse=True)
@@ -64,22 +79,28 @@ def setup_database_for_tests():
 
 @pytest.fixture(scope="function")
 def db_session_for_test():
-    connection = engine.connect()
-    transaction = connection.begin()
-    db = SessionLocal(bind=connection)
-
-    def override_get_db():
-        yield db
-
-    app.dependency_overrides[get_db] = override_get_db
-
+    db = TestSessionLocal()
     try:
         yield db
     finally:
-        transaction.rollback()
         db.close()
-        connection.close()
-        app.dependency_overrides.pop(get_db, None)
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clean_database():
+    # Requests commit through the app's own sessions, so each test starts from empty
+    # tables instead of rolling back a wrapping transaction
+    yield
+    with engine.begin() as connection:
+        connection.execute(text(f"TRUNCATE TABLE {Product.__tablename__}"))
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_product_cache():
+    # Test data is deleted after each test, so cached payloads must not outlive it
+    product_cache.clear()
+    yield
+    product_cache.clear()
 
 
 @pytest.fixture(scope="module")
@@ -99,6 +120,24 @@ def client():
     del os.environ["AZURE_SAS_TOKEN_EXPIRY_HOURS"]
 
 
+@pytest.fixture(scope="function")
+def assert_max_queries():
+    """
+    Returns a checker that fails when a response ran more SQL statements than allowed,
+    using the X-DB-Queries header the app sets on every response.
+    """
+
+    def check(response, max_queries: int):
+        queries = int(response.headers["X-DB-Queries"])
+        assert queries <= max_queries, (
+            f"{response.request.method} {response.request.url.path} ran {queries} "
+            f"SQL statements, expected at most {max_queries}"
+        )
+        return queries
+
+    return check
+
+
 @pytest.fixture(scope="function", autouse=True)
 def mock_azure_blob_storage():
     """
@@ -252,3 +291,832 @@ def test_delete_product_success(client: TestClient, db_session_for_test: Session
         .first()
     )
     assert deleted_product_in_db is None
+
+
+def test_deduct_stock_success(client: TestClient, db_session_for_test: Session):
+    """
+    Tests that stock is deducted atomically and the updated product is returned.
+    """
+    create_resp = client.post(
+        "/products/",
+        json={"name": "Stock Product", "price": 3.5, "stock_quantity": 10},
+    )
+    product_id = create_resp.json()["product_id"]
+
+    response = client.patch(
+        f"/products/{product_id}/deduct-stock", json={"quantity_to_deduct": 4}
+    )
+    assert response.status_code == 200
+    assert response.json()["product_id"] == product_id
+    assert response.json()["stock_quantity"] == 6
+
+    db_product = (
+        db_session_for_test.query(Product)
+        .filter(Product.product_id == product_id)
+        .first()
+    )
+    assert db_product.stock_quantity == 6
+
+
+def test_deduct_stock_insufficient(client: TestClient, db_session_for_test: Session):
+    """
+    Tests that a deduction larger than the available stock returns 400 and leaves stock untouched.
+    """
+    create_resp = client.post(
+        "/products/",
+        json={"name": "Scarce Product", "price": 7.0, "stock_quantity": 2},
+    )
+    product_id = create_resp.json()["product_id"]
+
+    response = client.patch(
+        f"/products/{product_id}/deduct-stock", json={"quantity_to_deduct": 3}
+    )
+    assert response.status_code == 400
+    assert "Only 2 available" in response.json()["detail"]
+
+    get_response = client.get(f"/products/{product_id}")
+    assert get_response.json()["stock_quantity"] == 2
+
+
+def test_deduct_stock_not_found(client: TestClient, db_session_for_test: Session):
+    """
+    Tests that deducting stock for a non-existent product returns 404.
+    """
+    response = client.patch(
+        "/products/999999/deduct-stock", json={"quantity_to_deduct": 1}
+    )
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Product not found"
+
+
+def test_out_of_range_product_ids_are_rejected(client: TestClient):
+    """
+    Tests that product IDs beyond the INTEGER column's range answer 422 instead of
+    failing to bind in the database.
+    """
+    too_large = 2**31
+    assert client.get(f"/products/{too_large}").status_code == 422
+    assert (
+        client.patch(
+            f"/products/{too_large}/deduct-stock", json={"quantity_to_deduct": 1}
+        ).status_code
+        == 422
+    )
+    assert (
+        client.post(
+            "/products/deduct-stock:batch",
+            json={"items": [{"product_id": too_large, "quantity_to_deduct": 1}]},
+        ).status_code
+        == 422
+    )
+    assert client.get(f"/products/{too_large - 1}").status_code == 404
+
+
+def test_concurrent_deductions_never_oversell(client: TestClient):
+    """
+    Tests that deductions running concurrently on the async engine never drive stock below zero.
+    """
+    product_id = client.post(
+        "/products/",
+        json={"name": "Limited Edition", "price": 50.0, "stock_quantity": 5},
+    ).json()["product_id"]
+
+    async def deduct_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as async_client:
+            return await asyncio.gather(
+                *(
+                    async_client.patch(
+                        f"/products/{product_id}/deduct-stock",
+                        json={"quantity_to_deduct": 1},
+                    )
+                    for _ in range(8)
+                )
+            )
+
+    # Run on the app's own event loop, where its async engine pool lives
+    responses = client.portal.call(deduct_concurrently)
+    status_codes = sorted(response.status_code for response in responses)
+    assert status_codes == [200] * 5 + [400] * 3
+    assert client.get(f"/products/{product_id}").json()["stock_quantity"] == 0
+
+
+def test_deduct_stock_batch_success(client: TestClient, db_session_for_test: Session):
+    """
+    Tests that a batch deduction updates every product and merges duplicate product IDs.
+    """
+    first_id = client.post(
+        "/products/", json={"name": "Batch A", "price": 1.0, "stock_quantity": 10}
+    ).json()["product_id"]
+    second_id = client.post(
+        "/products/", json={"name": "Batch B", "price": 2.0, "stock_quantity": 5}
+    ).json()["product_id"]
+
+    response = client.post(
+        "/products/deduct-stock:batch",
+        json={
+            "items": [
+                {"product_id": second_id, "quantity_to_deduct": 2},
+                {"product_id": first_id, "quantity_to_deduct": 3},
+                {"product_id": second_id, "quantity_to_deduct": 1},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    stock_by_id = {p["product_id"]: p["stock_quantity"] for p in response.json()}
+    assert stock_by_id == {first_id: 7, second_id: 2}
+
+
+def test_deduct_stock_batch_is_all_or_nothing(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that one insufficient item fails the whole batch without deducting anything.
+    """
+    plenty_id = client.post(
+        "/products/", json={"name": "Plenty", "price": 1.0, "stock_quantity": 10}
+    ).json()["product_id"]
+    scarce_id = client.post(
+        "/products/", json={"name": "Scarce", "price": 1.0, "stock_quantity": 1}
+    ).json()["product_id"]
+
+    response = client.post(
+        "/products/deduct-stock:batch",
+        json={
+            "items": [
+                {"product_id": plenty_id, "quantity_to_deduct": 5},
+                {"product_id": scarce_id, "quantity_to_deduct": 2},
+            ]
+        },
+    )
+    assert response.status_code == 400
+    assert client.get(f"/products/{plenty_id}").json()["stock_quantity"] == 10
+
+    missing_response = client.post(
+        "/products/deduct-stock:batch",
+        json={"items": [{"product_id": 999999, "quantity_to_deduct": 1}]},
+    )
+    assert missing_response.status_code == 404
+
+
+def test_deduct_stock_with_idempotency_key_runs_once(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that retries with the same Idempotency-Key replay the first response, that
+    reusing a key for a different request is rejected and that expired keys are reusable.
+    """
+    product_id = client.post(
+        "/products/", json={"name": "Retry Product", "price": 2.0, "stock_quantity": 10}
+    ).json()["product_id"]
+    url = f"/products/{product_id}/deduct-stock"
+    headers = {"Idempotency-Key": "deduct-1"}
+
+    first = client.patch(url, json={"quantity_to_deduct": 3}, headers=headers)
+    retry = client.patch(url, json={"quantity_to_deduct": 3}, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert retry.json()["stock_quantity"] == 7
+
+    mismatch = client.patch(url, json={"quantity_to_deduct": 1}, headers=headers)
+    assert mismatch.status_code == 422
+
+    # Failed deductions are not stored, so the key can be retried
+    too_many = client.patch(
+        url, json={"quantity_to_deduct": 50}, headers={"Idempotency-Key": "deduct-2"}
+    )
+    assert too_many.status_code == 400
+    retried = client.patch(
+        url, json={"quantity_to_deduct": 50}, headers={"Idempotency-Key": "deduct-2"}
+    )
+    assert retried.status_code == 400
+    assert "Idempotent-Replayed" not in retried.headers
+
+    batch = {"items": [{"product_id": product_id, "quantity_to_deduct": 2}]}
+    batch_headers = {"Idempotency-Key": "batch-1"}
+    first_batch = client.post(
+        "/products/deduct-stock:batch", json=batch, headers=batch_headers
+    )
+    retry_batch = client.post(
+        "/products/deduct-stock:batch", json=batch, headers=batch_headers
+    )
+    assert first_batch.status_code == retry_batch.status_code == 200
+    assert retry_batch.json() == first_batch.json()
+    assert retry_batch.json()[0]["stock_quantity"] == 5
+
+    # An expired key is treated as new
+    db_session_for_test.query(IdempotencyKey).update(
+        {IdempotencyKey.expires_at: datetime.now(timezone.utc) - timedelta(seconds=1)}
+    )
+    db_session_for_test.commit()
+    after_expiry = client.patch(url, json={"quantity_to_deduct": 3}, headers=headers)
+    assert after_expiry.status_code == 200
+    assert "Idempotent-Replayed" not in after_expiry.headers
+    assert after_expiry.json()["stock_quantity"] == 2
+
+
+def test_deduct_stock_respects_request_deadline(client: TestClient):
+    """
+    Tests that a deduction whose caller's deadline is already spent is rejected with 504
+    without touching stock, while one with time left goes through.
+    """
+    create_resp = client.post(
+        "/products/",
+        json={"name": "Deadline Product", "price": 4.0, "stock_quantity": 5},
+    )
+    product_id = create_resp.json()["product_id"]
+
+    expired = client.patch(
+        f"/products/{product_id}/deduct-stock",
+        json={"quantity_to_deduct": 1},
+        headers={"X-Request-Deadline-Ms": "0"},
+    )
+    assert expired.status_code == 504
+    assert client.get(f"/products/{product_id}").json()["stock_quantity"] == 5
+
+    response = client.patch(
+        f"/products/{product_id}/deduct-stock",
+        json={"quantity_to_deduct": 1},
+        headers={"X-Request-Deadline-Ms": "5000"},
+    )
+    assert response.status_code == 200
+    assert response.json()["stock_quantity"] == 4
+
+
+def test_overrunning_deduction_is_rolled_back(
+    client: TestClient, db_session_for_test: Session, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Tests that deductions running past their deadline answer 504 without committing:
+    one stuck on a row lock is cancelled by the statement timeout, and one that is
+    merely slow is stopped right before its commit.
+    """
+    create_resp = client.post(
+        "/products/",
+        json={"name": "Overrun Product", "price": 4.0, "stock_quantity": 5},
+    )
+    product_id = create_resp.json()["product_id"]
+
+    db_session_for_test.execute(
+        text(
+            "SELECT 1 FROM products_week08_example_01 WHERE product_id = :id FOR UPDATE"
+        ),
+        {"id": product_id},
+    )
+    started = time.perf_counter()
+    blocked = client.post(
+        "/products/deduct-stock:batch",
+        json={"items": [{"product_id": product_id, "quantity_to_deduct": 1}]},
+        headers={"X-Request-Deadline-Ms": "300"},
+    )
+    db_session_for_test.rollback()
+    assert blocked.status_code == 504
+    assert time.perf_counter() - started < 2
+
+    async def slow_notify(db, product_ids):
+        await asyncio.sleep(0.3)
+
+    monkeypatch.setattr("app.main.notify_product_changes", slow_notify)
+    slow = client.patch(
+        f"/products/{product_id}/deduct-stock",
+        json={"quantity_to_deduct": 1},
+        headers={"X-Request-Deadline-Ms": "100", "Idempotency-Key": "overrun-1"},
+    )
+    assert slow.status_code == 504
+    assert client.get(f"/products/{product_id}").json()["stock_quantity"] == 5
+    assert (
+        db_session_for_test.query(IdempotencyKey)
+        .filter(IdempotencyKey.idempotency_key == "overrun-1")
+        .count()
+        == 0
+    )
+
+
+def test_restock_product(client: TestClient, db_session_for_test: Session):
+    """
+    Tests that stock can be added back to a single product, and 404 for unknown products.
+    """
+    product_id = client.post(
+        "/products/", json={"name": "Restock Me", "price": 4.0, "stock_quantity": 1}
+    ).json()["product_id"]
+
+    response = client.patch(
+        f"/products/{product_id}/restock", json={"quantity_to_add": 4}
+    )
+    assert response.status_code == 200
+    assert response.json()["stock_quantity"] == 5
+
+    missing_response = client.patch(
+        "/products/999999/restock", json={"quantity_to_add": 1}
+    )
+    assert missing_response.status_code == 404
+
+
+def test_restock_product_batch_reports_missing(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that a batch restock updates existing products and reports missing ones.
+    """
+    product_id = client.post(
+        "/products/", json={"name": "Batch Restock", "price": 4.0, "stock_quantity": 0}
+    ).json()["product_id"]
+
+    response = client.post(
+        "/products/restock:batch",
+        json={
+            "items": [
+                {"product_id": product_id, "quantity_to_add": 2},
+                {"product_id": 999999, "quantity_to_add": 1},
+                {"product_id": product_id, "quantity_to_add": 1},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    response_data = response.json()
+    assert [p["stock_quantity"] for p in response_data["restocked"]] == [3]
+    assert response_data["missing_product_ids"] == [999999]
+
+
+def test_restock_product_batch_applies_keyed_items_once(client: TestClient):
+    """
+    Tests that restock items with an idempotency key are applied once, so a batch
+    retried after a lost answer does not restock twice, while new items still apply.
+    Keys repeated within a batch or reused for a different item are rejected.
+    """
+    product_id = client.post(
+        "/products/", json={"name": "Keyed Restock", "price": 4.0, "stock_quantity": 0}
+    ).json()["product_id"]
+    first_batch = {
+        "items": [
+            {"product_id": product_id, "quantity_to_add": 2, "idempotency_key": "c-1"},
+            {"product_id": product_id, "quantity_to_add": 3, "idempotency_key": "c-2"},
+        ]
+    }
+
+    response = client.post("/products/restock:batch", json=first_batch)
+    assert response.json()["restocked"][0]["stock_quantity"] == 5
+
+    retried = client.post("/products/restock:batch", json=first_batch)
+    assert retried.status_code == 200
+    assert retried.json() == {"restocked": [], "missing_product_ids": []}
+
+    mixed = client.post(
+        "/products/restock:batch",
+        json={
+            "items": [
+                *first_batch["items"],
+                {
+                    "product_id": product_id,
+                    "quantity_to_add": 4,
+                    "idempotency_key": "c-3",
+                },
+            ]
+        },
+    )
+    assert mixed.json()["restocked"][0]["stock_quantity"] == 9
+
+    duplicated = client.post(
+        "/products/restock:batch",
+        json={
+            "items": [
+                {"product_id": product_id, "quantity_to_add": 1, "idempotency_key": k}
+                for k in ("c-4", "c-4")
+            ]
+        },
+    )
+    assert duplicated.status_code == 422
+    reused = client.post(
+        "/products/restock:batch",
+        json={
+            "items": [
+                {"product_id": product_id, "quantity_to_add": 1, "idempotency_key": k}
+                for k in ("c-5", "c-1")
+            ]
+        },
+    )
+    assert reused.status_code == 409
+    assert "c-1" in reused.json()["detail"]
+    assert client.get(f"/products/{product_id}").json()["stock_quantity"] == 9
+
+
+def test_bulk_import_products_json_and_ndjson(
+    client: TestClient, db_session_for_test: Session, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Tests that bulk import creates valid rows in upload order and reports invalid ones.
+    The JSON array is read in small pieces, so rows span several reads.
+    """
+    monkeypatch.setattr("app.bulk_import._JSON_READ_SIZE", 7)
+    response = client.post(
+        "/products/bulk",
+        json=[
+            {"name": "Bulk One", "price": 1.5, "stock_quantity": 10},
+            {"name": "", "price": -1, "stock_quantity": 1},
+            {"name": "Bulk Two", "price": 2.5, "stock_quantity": 0},
+        ],
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result["created_count"] == 2
+    assert result["error_count"] == 1
+    assert result["errors"][0]["row"] == 2
+    assert {e["field"] for e in result["errors"][0]["errors"]} == {"name", "price"}
+    names = [client.get(f"/products/{i}").json()["name"] for i in result["product_ids"]]
+    assert names == ["Bulk One", "Bulk Two"]
+
+    ndjson = '{"name": "Line One", "price": 3, "stock_quantity": 1}\n\nnot json\n'
+    response = client.post(
+        "/products/bulk",
+        content=ndjson,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    result = response.json()
+    assert result["created_count"] == 1
+    assert result["errors"][0]["row"] == 2
+    assert "Invalid JSON" in result["errors"][0]["errors"][0]["message"]
+    assert db_session_for_test.query(Product).count() == 3
+
+
+def test_bulk_import_products_csv(client: TestClient):
+    """
+    Tests CSV bulk import, including quoted fields, empty optional columns and rows
+    with more fields than the header.
+    """
+    csv_body = (
+        "name,description,price,stock_quantity,image_url\n"
+        '"Desk, Oak","Solid oak desk",199.99,4,\n'
+        "Chair,,49.5,12,http://example.com/chair.png\n"
+        "Broken,,abc,1,\n"
+        "Extra,,1.5,3,,x,y\n"
+    )
+    response = client.post(
+        "/products/bulk", content=csv_body, headers={"Content-Type": "text/csv"}
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result["created_count"] == 2
+    assert [e["row"] for e in result["errors"]] == [3, 4]
+    assert "2 more fields" in result["errors"][1]["errors"][0]["message"]
+    desk = client.get(f"/products/{result['product_ids'][0]}").json()
+    assert desk["name"] == "Desk, Oak"
+    assert desk["image_url"] is None
+
+    unsupported = client.post(
+        "/products/bulk", content="x", headers={"Content-Type": "text/plain"}
+    )
+    assert unsupported.status_code == 415
+    not_an_array = client.post("/products/bulk", json={"name": "x"})
+    assert not_an_array.status_code == 400
+    truncated = client.post(
+        "/products/bulk",
+        content='[{"name": "A", "price": 1, "stock_quantity": 1}, {"name"',
+        headers={"Content-Type": "application/json"},
+    )
+    assert truncated.status_code == 400
+    assert "row 2" in truncated.json()["detail"]
+
+
+def test_export_products_streams_ndjson_csv_and_gzip(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Tests that the export streams every product across several cursor batches, as
+    NDJSON or CSV, gzip-compressed only when the client accepts it.
+    """
+    monkeypatch.setattr("app.main.PRODUCT_EXPORT_BATCH_SIZE", 2)
+    client.post(
+        "/products/bulk",
+        json=[
+            {"name": f"Export {i}", "price": 1.0 + i, "stock_quantity": i}
+            for i in range(5)
+        ],
+    )
+
+    ndjson = client.get("/products/export", headers={"Accept-Encoding": "gzip"})
+    assert ndjson.status_code == 200
+    assert ndjson.headers["content-encoding"] == "gzip"
+    lines = [json.loads(line) for line in ndjson.text.splitlines()]
+    assert [p["name"] for p in lines] == [f"Export {i}" for i in range(5)]
+
+    plain_csv = client.get(
+        "/products/export",
+        params={"format": "csv"},
+        headers={"Accept-Encoding": "identity"},
+    )
+    assert "content-encoding" not in plain_csv.headers
+    assert plain_csv.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(plain_csv.text)))
+    assert len(rows) == 5
+    assert rows[4]["name"] == "Export 4"
+    assert float(rows[4]["price"]) == 5.0
+
+
+def test_get_products_by_ids(client: TestClient, assert_max_queries):
+    """
+    Tests the multi-get: request order, duplicates, missing IDs, cache use and limits.
+    """
+    created_ids = client.post(
+        "/products/bulk",
+        json=[
+            {"name": name, "price": 1.0, "stock_quantity": 1}
+            for name in ("Multi A", "Multi B", "Multi C")
+        ],
+    ).json()["product_ids"]
+    first_id, second_id, third_id = created_ids
+    client.get(f"/products/{second_id}")  # Warm the cache for one product
+
+    response = client.get(
+        "/products/", params={"ids": f"{third_id},999999,{first_id},{second_id}"}
+    )
+    assert response.status_code == 200
+    assert [p["name"] for p in response.json()] == ["Multi C", "Multi A", "Multi B"]
+    assert response.headers["X-Missing-Product-Ids"] == "999999"
+    assert_max_queries(response, 1)
+
+    repeated = client.get("/products/", params=[("ids", first_id), ("ids", first_id)])
+    assert [p["product_id"] for p in repeated.json()] == [first_id]
+    assert "X-Missing-Product-Ids" not in repeated.headers
+    assert_max_queries(repeated, 0)
+
+    too_many = ",".join(str(i) for i in range(1, 102))
+    assert client.get("/products/", params={"ids": too_many}).status_code == 400
+    assert client.get("/products/", params={"ids": "1,abc"}).status_code == 400
+    assert client.get("/products/", params={"ids": "99999999999999"}).status_code == 400
+    assert client.get("/products/", params={"ids": "²"}).status_code == 400
+    assert (
+        client.get("/products/", params={"ids": "1", "search": "x"}).status_code == 400
+    )
+
+
+def test_list_products_cursor_pagination(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests keyset pagination: following X-Next-Cursor walks every product exactly once.
+    """
+    for name in ["Cursor C", "Cursor A", "Cursor B"]:
+        client.post(
+            "/products/", json={"name": name, "price": 1.0, "stock_quantity": 1}
+        )
+
+    first_page = client.get("/products/", params={"limit": 2, "sort_by": "name"})
+    assert first_page.status_code == 200
+    assert [p["name"] for p in first_page.json()] == ["Cursor A", "Cursor B"]
+    next_cursor = first_page.headers["X-Next-Cursor"]
+    assert 'rel="next"' in first_page.headers["Link"]
+
+    second_page = client.get(
+        "/products/", params={"limit": 2, "sort_by": "name", "cursor": next_cursor}
+    )
+    assert [p["name"] for p in second_page.json()] == ["Cursor C"]
+    assert "X-Next-Cursor" not in second_page.headers
+
+    mismatched = client.get("/products/", params={"cursor": next_cursor})
+    assert mismatched.status_code == 400
+
+    # Forged cursors with values of the wrong type are rejected before reaching SQL
+    for sort_by, values in (
+        ("product_id", ["abc"]),
+        ("product_id", [None]),
+        ("product_id", [2**40]),
+        ("name", [1, "x"]),
+        ("name", ["Cursor A"]),
+    ):
+        forged = client.get(
+            "/products/",
+            params={"sort_by": sort_by, "cursor": encode_cursor(sort_by, values)},
+        )
+        assert forged.status_code == 400
+        assert forged.json()["detail"] == "Malformed cursor."
+
+
+def test_list_products_full_text_search(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests ranked full-text search and its prefix, phrase and substring match modes.
+    """
+    products = [
+        {"name": "Wireless Mouse", "description": "Ergonomic mouse for gaming"},
+        {
+            "name": "Gaming Keyboard",
+            "description": "Mechanical keyboard, works with any mouse",
+        },
+        {"name": "USB Cable", "description": "Braided cable"},
+        {"name": "Theater Popcorn Maker", "description": "Makes popcorn"},
+        {"name": "Running Shoes", "description": "Lightweight trainers"},
+    ]
+    for product in products:
+        client.post("/products/", json={**product, "price": 9.99, "stock_quantity": 3})
+
+    ranked = client.get("/products/", params={"search": "mouse"})
+    assert ranked.status_code == 200
+    # Name matches outrank description-only matches
+    assert [p["name"] for p in ranked.json()] == ["Wireless Mouse", "Gaming Keyboard"]
+
+    prefix = client.get("/products/", params={"search": "wire mou", "match": "prefix"})
+    assert [p["name"] for p in prefix.json()] == ["Wireless Mouse"]
+    # Prefixes are not stemmed or dropped as stop words: "the" and "runnin" still match
+    stop_word = client.get("/products/", params={"search": "the", "match": "prefix"})
+    assert [p["name"] for p in stop_word.json()] == ["Theater Popcorn Maker"]
+    stemmed = client.get("/products/", params={"search": "runnin", "match": "prefix"})
+    assert [p["name"] for p in stemmed.json()] == ["Running Shoes"]
+
+    phrase = client.get(
+        "/products/", params={"search": "mechanical keyboard", "match": "phrase"}
+    )
+    assert [p["name"] for p in phrase.json()] == ["Gaming Keyboard"]
+
+    substring = client.get(
+        "/products/", params={"search": "raided", "match": "substring"}
+    )
+    assert [p["name"] for p in substring.json()] == ["USB Cable"]
+
+    first_page = client.get("/products/", params={"search": "mouse", "limit": 1})
+    second_page = client.get(
+        "/products/",
+        params={
+            "search": "mouse",
+            "limit": 1,
+            "cursor": first_page.headers["X-Next-Cursor"],
+        },
+    )
+    assert [p["name"] for p in second_page.json()] == ["Gaming Keyboard"]
+
+
+def test_list_products_fuzzy_search(client: TestClient, db_session_for_test: Session):
+    """
+    Tests typo-tolerant fuzzy name search when pg_trgm is installed in the test database.
+    """
+    import app.main as main_module
+
+    if not main_module.trigram_search_available:
+        pytest.skip("pg_trgm is not installed in the test database.")
+
+    client.post(
+        "/products/",
+        json={"name": "Bluetooth Speaker", "price": 30.0, "stock_quantity": 2},
+    )
+    client.post(
+        "/products/", json={"name": "Desk Lamp", "price": 15.0, "stock_quantity": 2}
+    )
+
+    response = client.get("/products/", params={"search": "blutooth", "match": "fuzzy"})
+    assert response.status_code == 200
+    assert [p["name"] for p in response.json()] == ["Bluetooth Speaker"]
+
+    strict = client.get(
+        "/products/",
+        params={"search": "blutooth", "match": "fuzzy", "similarity_threshold": 1},
+    )
+    assert strict.json() == []
+
+
+def test_list_products_fuzzy_search_unavailable(
+    client: TestClient, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Tests that fuzzy search reports 503 when the trigram extension is missing.
+    """
+    monkeypatch.setattr("app.main.trigram_search_available", False)
+    response = client.get("/products/", params={"search": "lamp", "match": "fuzzy"})
+    assert response.status_code == 503
+
+
+def test_get_product_is_cached_and_invalidated(
+    client: TestClient, db_session_for_test: Session
+):
+    """
+    Tests that repeated reads are served from the cache and that writes invalidate it.
+    """
+    product_id = client.post(
+        "/products/", json={"name": "Hot Product", "price": 2.0, "stock_quantity": 8}
+    ).json()["product_id"]
+
+    first = client.get(f"/products/{product_id}")
+    stats_before = client.get("/cache/stats").json()
+    second = client.get(f"/products/{product_id}")
+    stats_after = client.get("/cache/stats").json()
+    assert first.json() == second.json()
+    assert stats_after["hits"] == stats_before["hits"] + 1
+
+    client.patch(f"/products/{product_id}/deduct-stock", json={"quantity_to_deduct": 3})
+    assert client.get(f"/products/{product_id}").json()["stock_quantity"] == 5
+
+    client.put(f"/products/{product_id}", json={"name": "Renamed Hot Product"})
+    assert client.get(f"/products/{product_id}").json()["name"] == "Renamed Hot Product"
+
+
+def test_product_reads_report_db_queries(client: TestClient, assert_max_queries):
+    """
+    Tests the per-request query count header: lists and lookups cost one query and
+    cached lookups none.
+    """
+    for name in ["Counted A", "Counted B", "Counted C"]:
+        client.post(
+            "/products/", json={"name": name, "price": 1.0, "stock_quantity": 1}
+        )
+
+    listing = client.get("/products/")
+    assert len(listing.json()) == 3
+    assert_max_queries(listing, 1)
+    assert "db;dur=" in listing.headers["Server-Timing"]
+
+    product_id = listing.json()[0]["product_id"]
+    assert_max_queries(client.get(f"/products/{product_id}"), 1)
+    assert assert_max_queries(client.get(f"/products/{product_id}"), 0) == 0
+
+
+def test_metrics_endpoint_reports_routes_pool_and_cache(client: TestClient):
+    """
+    Tests that /metrics exposes latency per route template, pool gauges and cache counters.
+    """
+    product_id = client.post(
+        "/products/", json={"name": "Metered", "price": 1.0, "stock_quantity": 1}
+    ).json()["product_id"]
+    client.get(f"/products/{product_id}")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert (
+        'http_request_duration_seconds_count{method="GET",route="/products/{product_id}",status_code="200"}'
+        in body
+    )
+    assert f"/products/{product_id}" not in body
+    assert "db_pool_checked_out_connections" in body
+    assert "product_cache_hit_ratio" in body
+
+
+def test_db_pool_diagnostics_and_slow_checkout_warning(
+    client: TestClient,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+):
+    """
+    Tests that pool usage and checkout waits are reported and slow checkouts are logged.
+    """
+    monkeypatch.setattr("app.db.DB_POOL_WAIT_WARNING_SECONDS", 0)
+    with caplog.at_level(logging.WARNING, logger="app.db"):
+        client.get("/products/")
+
+    assert any("for a DB connection" in record.message for record in caplog.records)
+    diagnostics = client.get("/diagnostics/db-pool").json()
+    assert diagnostics["checkouts"] >= 1
+    assert diagnostics["slow_checkouts"] >= 1
+    assert diagnostics["checked_out"] == 0
+    assert diagnostics["pool_size"] >= 1
+
+
+def test_ttl_cache_expiry_and_lru_bound():
+    """
+    Tests TTL expiry, LRU eviction and the stale-write guard of the cache itself.
+    """
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    cache.get(1)  # 1 becomes most recently used
+    cache.set(3, "c")
+    assert cache.get(2) is None
+    assert cache.get(1) == "a"
+
+    generation = cache.generation(1)
+    other_generation = cache.generation(2)
+    cache.invalidate(1)
+    cache.set(1, "stale", generation)
+    assert cache.get(1) is None
+    # Invalidating key 1 does not discard a fill of another key
+    cache.set(2, "fresh", other_generation)
+    assert cache.get(2) == "fresh"
+
+    expiring = TTLCache(max_entries=2, ttl_seconds=0.01)
+    expiring.set(1, "a")
+    time.sleep(0.02)
+    assert expiring.get(1) is None
+
+
+def test_product_change_notification_evicts_cache(client: TestClient):
+    """
+    Tests that a NOTIFY committed by another worker evicts the local cache entry.
+    """
+    deadline = time.monotonic() + 5
+    while not product_change_listener.connected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert product_change_listener.connected
+
+    product_cache.set(424242, b'{"cached": true}')
+    with engine.connect() as connection:
+        connection.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": PRODUCT_CHANGES_CHANNEL, "payload": "424242"},
+        )
+        connection.commit()
+
+    while product_cache.get(424242) is not None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert product_cache.get(424242) is None
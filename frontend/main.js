@@ -304,6 +304,24 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // Fetch details for many products with one request and add them to productsCache
+    async function fetchProductsByIds(productIds) {
+        const uncachedIds = [...new Set(productIds)].filter(id => !(id in productsCache));
+        // The Product Service accepts at most 100 IDs per request
+        for (let start = 0; start < uncachedIds.length; start += 100) {
+            const batch = uncachedIds.slice(start, start + 100);
+            const response = await fetch(`${PRODUCT_API_BASE_URL}/products/?ids=${batch.join(',')}`);
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
+            }
+            const products = await response.json();
+            products.forEach(product => {
+                productsCache[product.product_id] = product;
+            });
+        }
+    }
+
     // Fetch and display orders
     async function fetchOrders() {
         orderListDiv.innerHTML = '<p>Loading orders...</p>';
@@ -322,6 +340,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
 
+            // Product names for all order items, in a single Product Service call
+            try {
+                await fetchProductsByIds(orders.flatMap(order => order.items.map(item => item.product_id)));
+            } catch (error) {
+                console.warn('Could not load product details for orders:', error);
+            }
+
             orders.forEach(order => {
                 const orderCard = document.createElement('div');
                 orderCard.className = 'order-card';
@@ -339,7 +364,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     <ul class="order-items">
                         ${order.items.map(item => `
                             <li>
-                                <span>Product ID: ${item.product_id}</span> - Qty: ${item.quantity} @ ${formatCurrency(item.price_at_purchase)} (Total: ${formatCurrency(item.item_total)})
+                                <span>${productsCache[item.product_id] ? `${productsCache[item.product_id].name} ` : ''}(Product ID: ${item.product_id})</span> - Qty: ${item.quantity} @ ${formatCurrency(item.price_at_purchase)} (Total: ${formatCurrency(item.item_total)})
                             </li>
                         `).join('')}
                     </ul>